@@ -0,0 +1,99 @@
+# compares forest.AncestorIndex with the DistanceSkipList it replaced for get_nth_parent_hash on a share-chain-sized
+# tracker, including the cost of building the index as shares arrive oldest first (startup) or newest first (download)
+# usage: python dev/bench_ancestors.py [SHARES] [LOOKUPS]
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from p2pool.util import forest
+
+class DistanceSkipList(forest.TrackerSkipList):
+    def get_delta(self, element):
+        return element, 1, self.previous(element)
+    
+    def combine_deltas(self, (from_hash1, dist1, to_hash1), (from_hash2, dist2, to_hash2)):
+        if to_hash1 != from_hash2:
+            raise AssertionError()
+        return from_hash1, dist1 + dist2, to_hash2
+    
+    def initial_solution(self, start, (n,)):
+        return 0, start
+    
+    def apply_delta(self, (dist1, to_hash1), (from_hash2, dist2, to_hash2), (n,)):
+        if to_hash1 != from_hash2:
+            raise AssertionError()
+        return dist1 + dist2, to_hash2
+    
+    def judge(self, (dist, hash), (n,)):
+        if dist > n:
+            return 1
+        elif dist == n:
+            return 0
+        else:
+            return -1
+    
+    def finalize(self, (dist, hash), (n,)):
+        assert dist == n
+        return hash
+
+class FakeShare(object):
+    def __init__(self, hash, previous_hash):
+        self.hash = hash
+        self.previous_hash = previous_hash
+
+def build(shares, order):
+    start = time.time()
+    tracker = forest.Tracker()
+    for i in order:
+        tracker.add(FakeShare(i, i - 1 if i else None))
+    return tracker, time.time() - start
+
+def run(name, index, queries):
+    start = time.time()
+    for item_hash, n in queries:
+        index(item_hash, n)
+    first = time.time() - start
+    
+    start = time.time()
+    for item_hash, n in queries:
+        index(item_hash, n)
+    again = time.time() - start
+    
+    worst = 0
+    for item_hash, n in queries[:1000]:
+        start = time.time()
+        index(item_hash, n)
+        worst = max(worst, time.time() - start)
+    
+    print '  %-16s first %7.1f us/lookup  again %7.1f us/lookup  worst %7.1f us' % (name, first/len(queries)*1e6, again/len(queries)*1e6, worst*1e6)
+
+def main():
+    shares = int(sys.argv[1]) if len(sys.argv) > 1 else 17280
+    lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    
+    for order_name, order in [('oldest first', range(shares)), ('newest first', range(shares)[::-1])]:
+        tracker, elapsed = build(shares, order)
+        print '%i shares added %s: %.2f s (includes the AncestorIndex)' % (shares, order_name, elapsed)
+    
+    random.seed(0)
+    queries = []
+    for i in xrange(lookups):
+        a = random.randrange(shares)
+        queries.append((a, random.randrange(a + 1)))
+    
+    print '%i random lookups' % (lookups,)
+    run('DistanceSkipList', DistanceSkipList(tracker), queries)
+    run('AncestorIndex', tracker.get_nth_parent_hash, queries)
+    
+    # the pattern think() and generate_transaction use: fixed distances back from successive heads
+    queries = [(a, n) for a in xrange(shares - 1000, shares) for n in [99, shares//2 - 1]]
+    print 'fixed distances from %i successive heads' % (1000,)
+    run('DistanceSkipList', DistanceSkipList(tracker), queries)
+    run('AncestorIndex', tracker.get_nth_parent_hash, queries)
+
+if __name__ == '__main__':
+    main()
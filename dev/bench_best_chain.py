@@ -0,0 +1,61 @@
+# compares reading the recent best chain out of data.BestChain with walking it with tracker.get_chain, and reports
+# what keeping the window up to date costs while following a growing chain with occasional reorgs
+# usage: python dev/bench_best_chain.py [SHARES] [CHAIN_LENGTH]
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from p2pool import data, stats
+from p2pool.util import forest
+
+class FakeShare(object):
+    def __init__(self, hash, previous_hash):
+        self.hash = hash
+        self.previous_hash = previous_hash
+        self.timestamp = hash*30
+        self.target = 2**256//100000
+        self.desired_version = 17
+        self.share_data = dict(stale_info=random.choice([None, None, None, 'orphan', 'doa']), pubkey_hash=random.randrange(300))
+        self.new_transaction_hashes = []
+
+def timeit(name, f, n):
+    start = time.time()
+    for i in xrange(n):
+        f()
+    print '    %-40s %8.1f us' % (name, (time.time() - start)/n*1e6)
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 17280
+    chain_length = int(sys.argv[2]) if len(sys.argv) > 2 else 8640
+    
+    random.seed(0)
+    tracker = forest.Tracker()
+    best_chain = data.BestChain(tracker, 2*chain_length)
+    
+    # every 20th share is on a one-share fork that is best until the next share arrives
+    start = time.time()
+    for i in xrange(n):
+        tracker.add(FakeShare(2*i, 2*(i - 1) if i else None))
+        if i % 20 == 0 and i:
+            tracker.add(FakeShare(2*i + 1, 2*(i - 1)))
+            best_chain.set_head(2*i + 1)
+        best_chain.set_head(2*i)
+    print '%i shares, following the head: %.1f us/share' % (n, (time.time() - start)/n*1e6)
+    
+    head = 2*(n - 1)
+    height = tracker.get_height(head)
+    for length, use in [(120, 'forget_old_txs'), (24*60*60//30, 'recent_blocks'), (min(height, 2*chain_length), 'save_shares, user_stales')]:
+        print 'last %i shares (%s)' % (length, use)
+        timeit('tracker.get_chain', lambda: [share.hash for share in tracker.get_chain(head, length)], 20)
+        timeit('BestChain.get_slice', lambda: best_chain.hashes[best_chain.get_slice(length)], 20)
+    length = min(height, 2*chain_length) # what the window holds
+    print 'per-user stale counts over the last %i shares' % (length,)
+    timeit('data.get_user_stale_props', lambda: data.get_user_stale_props(tracker, head, length + 1), 5) # walks lookbehind - 1 shares
+    timeit('stats.get_user_stats', lambda: stats.get_user_stats(best_chain, length), 5)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+# times the share removal part of Node.clean_tracker, the old rescanning loops against OkayTracker.eat_heads and
+# drop_tails, on a chain with old stale forks and young single-share forks hanging off its recent part like during
+# fork spam. the young ones can't be removed yet, but the old loops look at them again for every share they remove
+# from the deepest old fork
+# usage: python dev/bench_clean_tracker.py [OLD_FORKS] [YOUNG_FORKS] [CHAIN_LENGTH]
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from p2pool import data
+from p2pool.util import math
+
+class FakeShare(object):
+    def __init__(self, hash, previous_hash, time_seen):
+        self.hash = hash
+        self.previous_hash = previous_hash
+        self.time_seen = time_seen
+        self.target = self.max_target = 2**240
+        self.desired_version = 16
+        self.share_data = dict(stale_info=None)
+
+def old_clean(tracker, keep_hashes, now, min_height):
+    removed = 0
+    for i in xrange(1000):
+        to_remove = set()
+        for share_hash, tail in tracker.heads.iteritems():
+            if share_hash in keep_hashes or tracker.items[share_hash].time_seen > now - 300:
+                continue
+            if share_hash not in tracker.verified.items and max(tracker.items[after_tail_hash].time_seen for after_tail_hash in tracker.reverse.get(tail)) > now - 120:
+                continue
+            to_remove.add(share_hash)
+        if not to_remove:
+            break
+        for share_hash in to_remove:
+            if share_hash in tracker.verified.items:
+                tracker.verified.remove(share_hash)
+            tracker.remove(share_hash)
+        removed += len(to_remove)
+    for i in xrange(1000):
+        to_remove = set()
+        for tail, heads in tracker.tails.iteritems():
+            if min(tracker.get_height(head) for head in heads) < min_height:
+                continue
+            to_remove.update(tracker.reverse.get(tail, set()))
+        if not to_remove:
+            break
+        for aftertail in to_remove:
+            if aftertail in tracker.verified.items:
+                tracker.verified.remove(aftertail)
+            tracker.remove(aftertail)
+        removed += len(to_remove)
+    return removed
+
+def new_clean(tracker, keep_hashes, now, min_height):
+    return len(tracker.eat_heads(keep_hashes, now)) + len(tracker.drop_tails(min_height))
+
+def make_tracker(forks, young_forks, chain_length, now):
+    random.seed(0)
+    tracker = data.OkayTracker(math.Object(CHAIN_LENGTH=chain_length))
+    n = 2*chain_length + 20
+    for i in xrange(n):
+        share = FakeShare(i, i - 1 if i else None, now - 30*(n - i))
+        tracker.add(share)
+        tracker.verified.add(share)
+    for i in xrange(forks):
+        previous_hash = random.randrange(n - 500, n - 1)
+        for j in xrange(random.randrange(1, 20)):
+            share = FakeShare(n + 100*i + j, previous_hash, now - 1000)
+            tracker.add(share)
+            if random.randrange(2):
+                tracker.verified.add(share)
+            previous_hash = share.hash
+    for i in xrange(young_forks):
+        tracker.add(FakeShare(n + 100*forks + i, random.randrange(n - 500, n - 1), now - 60))
+    return tracker, n - 1
+
+def main():
+    forks = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    young_forks = int(sys.argv[2]) if len(sys.argv) > 2 else 3000
+    chain_length = int(sys.argv[3]) if len(sys.argv) > 3 else 8640
+    now = time.time()
+    
+    print '%i old forks of 1-19 shares and %i young single-share forks off a %i share chain' % (forks, young_forks, 2*chain_length + 20)
+    for name, clean in [('old loops', old_clean), ('indexed', new_clean)]:
+        tracker, head = make_tracker(forks, young_forks, chain_length, now)
+        new_clean(tracker, set([head]), now - 10**6, 10**9) # builds the head index outside of the timing
+        start = time.time()
+        removed = clean(tracker, set([head]), now, 2*chain_length + 10)
+        first = time.time() - start
+        start = time.time()
+        clean(tracker, set([head]), now, 2*chain_length + 10)
+        second = time.time() - start
+        print '    %-10s removing %i shares: %8.1f ms  next cycle: %8.1f ms' % (name, removed, first*1e3, second*1e3)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+# times the forest.Tracker operations that go through delta arithmetic on a synthetic tracker: adding items,
+# get_height/get_work on items whose deltas aren't cached yet and on ones that are, and removing the oldest half like
+# clean_tracker does, forks as heads first and then the main chain from its tail, and pruning the oldest half in order
+# with the forks still hanging off it
+# usage: python dev/bench_forest.py [ITEMS]
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from p2pool.util import forest
+
+class FakeItem(object):
+    def __init__(self, hash, previous_hash):
+        self.hash = hash
+        self.previous_hash = previous_hash
+        self.target = random.randrange(2**220, 2**224)
+
+delta_type = forest.get_attributedelta_type(dict(forest.AttributeDelta.attrs,
+    work=lambda item: 2**256//(item.target + 1),
+    min_work=lambda item: 2**256//(2**224 + 1),
+))
+
+def make_items(n):
+    # a main chain with a one-item fork off every 20th item
+    random.seed(0)
+    items = []
+    for i in xrange(n):
+        if i % 20 == 19:
+            items.append(FakeItem(i, i - 2))
+        else:
+            items.append(FakeItem(i, i - 1 - (i % 20 == 0 and i > 0) if i else None))
+    return items
+
+def timeit(name, f, n):
+    start = time.time()
+    f()
+    print '    %-40s %8.2f us' % (name, (time.time() - start)/n*1e6)
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    items = make_items(n)
+    hashes = [item.hash for item in items]
+    random.seed(1)
+    random.shuffle(hashes)
+    
+    print '%i items, per operation' % (n,)
+    tracker = forest.Tracker(delta_type=delta_type)
+    def add():
+        for item in items:
+            tracker.add(item)
+    timeit('add', add, n)
+    def get_heights():
+        for item_hash in hashes:
+            tracker.get_height(item_hash)
+    timeit('get_height, deltas not cached', get_heights, n)
+    timeit('get_height, deltas cached', get_heights, n)
+    def get_works():
+        for item_hash in hashes:
+            tracker.get_work(item_hash)
+    timeit('get_work, deltas cached', get_works, n)
+    view = forest.TrackerView(tracker, delta_type)
+    def get_deltas():
+        for item_hash in hashes:
+            view.get_delta_to_last(item_hash)
+    timeit('get_delta_to_last, new view', get_deltas, n)
+    def remove():
+        for item in sorted(items[:n//2], key=lambda item: item.hash % 20 != 19):
+            tracker.remove(item.hash)
+    timeit('remove oldest half', remove, n//2)
+    timeit('get_height after removals', lambda: [tracker.get_height(item_hash) for item_hash in hashes if item_hash in tracker.items], n//2)
+    
+    # pruning from the tails while the forks are still there, so most removals uncover a tail with several children
+    tracker = forest.Tracker(items, delta_type=delta_type)
+    def prune():
+        for item in items[:n//2]:
+            tracker.remove(item.hash)
+    timeit('remove oldest half, forks still there', prune, n//2)
+
+if __name__ == '__main__':
+    main()
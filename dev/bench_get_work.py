@@ -0,0 +1,114 @@
+# times WorkerBridge.get_work for miners on different payout addresses right after the best share changes, like the
+# burst of requests that follows every new share, on a share chain paying a few hundred addresses and a block template
+# with a few thousand transactions that earlier shares already introduced
+# usage: python dev/bench_get_work.py [ADDRESSES...]
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import p2pool
+from p2pool import data, work
+from p2pool.bitcoin import data as bitcoin_data, networks
+from p2pool.util import math, variable
+
+net = math.Object(
+    NAME='bench',
+    PARENT=networks.nets['bitcoin'],
+    SHARE_PERIOD=30,
+    CHAIN_LENGTH=400,
+    REAL_CHAIN_LENGTH=400,
+    TARGET_LOOKBEHIND=200,
+    SPREAD=3,
+    IDENTIFIER='1dfc2a6e6f4d4d7c'.decode('hex'),
+    PREFIX='5c1d67b2cc0a9c3e'.decode('hex'),
+    MIN_TARGET=0,
+    MAX_TARGET=2**256 - 1, # so that the shares made here don't need any proof of work
+    PERSIST=False,
+)
+block_target = 2**256//2**60
+
+def make_share(tracker, previous_share_hash, pubkey_hash, txs):
+    previous_share = tracker.items[previous_share_hash] if previous_share_hash is not None else None
+    share_info, gentx, other_transaction_hashes, get_share = data.Share.generate_transaction(
+        tracker=tracker,
+        share_data=dict(
+            previous_share_hash=previous_share_hash,
+            coinbase='\x01\x02',
+            nonce=random.randrange(2**32),
+            pubkey_hash=pubkey_hash,
+            subsidy=5000000000,
+            donation=655,
+            stale_info=None,
+            desired_version=16,
+        ),
+        block_target=block_target,
+        desired_timestamp=previous_share.timestamp + net.SHARE_PERIOD if previous_share is not None else 1500000000,
+        desired_target=2**256 - 1,
+        ref_merkle_link=dict(branch=[], index=0),
+        desired_other_transaction_hashes_and_fees=[(bitcoin_data.get_tx_hash(tx), 1000) for tx in txs],
+        net=net,
+        known_txs=dict((bitcoin_data.get_tx_hash(tx), tx) for tx in txs),
+    )
+    return get_share(dict(
+        version=0x20000000,
+        previous_block=random.randrange(1, 2**256),
+        merkle_root=bitcoin_data.check_merkle_link(bitcoin_data.get_txid(gentx), bitcoin_data.calculate_merkle_link([None] + other_transaction_hashes, 0)),
+        timestamp=share_info['timestamp'],
+        bits=bitcoin_data.FloatingInteger.from_target_upper_bound(block_target),
+        nonce=0,
+    ))
+
+def main():
+    address_counts = map(int, sys.argv[1:]) or [1, 100, 1000]
+    p2pool.DEBUG = False
+    random.seed(0)
+    txs = [bitcoin_data.tx_type.unpack(bitcoin_data.tx_type.pack(dict(version=1, tx_ins=[dict(previous_output=None, script='', sequence=None)],
+        tx_outs=[dict(value=i, script=os.urandom(200))], lock_time=0))) for i in xrange(2000)]
+    
+    tracker = data.OkayTracker(net)
+    previous_share_hash = None
+    for i in xrange(net.CHAIN_LENGTH):
+        share = make_share(tracker, previous_share_hash, random.randrange(300), txs)
+        tracker.add(share)
+        previous_share_hash = share.hash
+    
+    bitcoind_work = variable.Variable(dict(
+        version=0x20000000,
+        previous_block=random.randrange(2**256),
+        bits=bitcoin_data.FloatingInteger.from_target_upper_bound(block_target),
+        coinbaseflags='',
+        height=400000,
+        time=int(time.time()),
+        transactions=txs,
+        transaction_fees=[1000]*len(txs),
+        merkle_link=bitcoin_data.calculate_merkle_link([None] + [bitcoin_data.get_tx_hash(tx) for tx in txs], 0),
+        subsidy=net.PARENT.SUBSIDY_FUNC(400000) + 1000*len(txs),
+        last_update=time.time(),
+        rules=[],
+    ))
+    node = math.Object(net=net, tracker=tracker, bitcoind_work=bitcoind_work, best_block_header=variable.Variable(None),
+        best_share_var=variable.Variable(previous_share_hash), p2p_node=None)
+    wb = work.WorkerBridge(node, 0, 0, [], 0, math.Object(donation_percentage=0, worker_fee=0), None, None)
+    
+    print '%i share chain, %i transactions in the block template, ms per get_work' % (net.CHAIN_LENGTH, len(txs))
+    for n in address_counts:
+        first = rest = 0
+        for i in xrange(3): # a new best share each time
+            share = make_share(tracker, node.best_share_var.value, random.randrange(300), txs)
+            tracker.add(share)
+            node.best_share_var.set(share.hash)
+            start = time.time()
+            wb.get_work(random.randrange(2**160), None, None)
+            first += time.time() - start
+            start = time.time()
+            for j in xrange(n - 1):
+                wb.get_work(random.randrange(2**160), None, None)
+            rest += time.time() - start
+        print '    %4i addresses: first get_work %8.2f  others %8.2f  all of them %9.1f' % (n, first/3*1e3, rest/3/max(1, n - 1)*1e3, (first + rest)/3*1e3)
+
+if __name__ == '__main__':
+    main()
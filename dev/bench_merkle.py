@@ -0,0 +1,44 @@
+# times the merkle functions that get_work, get_share and Share.check call on a block template's transaction hashes:
+# merkle_hash and calculate_merkle_link for the coinbase on a new list and on one they were just called with, and the
+# root with a new coinbase hash in place of the first one
+# usage: python dev/bench_merkle.py [TRANSACTIONS] [CALLS]
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import p2pool
+from p2pool.bitcoin import data as bitcoin_data
+from p2pool.util import pack
+
+def timeit(name, f, n):
+    start = time.time()
+    for i in xrange(n):
+        f()
+    print '    %-45s %8.2f ms' % (name, (time.time() - start)/n*1e3)
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    calls = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    p2pool.DEBUG = False # like a node started without --debug, which would check every link against merkle_hash
+    random.seed(0)
+    hashes = [random.randrange(2**256) for i in xrange(n)]
+    
+    print '%i transactions, per call' % (n,)
+    def new_list():
+        hashes[-1] = random.randrange(2**256)
+    timeit('merkle_hash, new list', lambda: (new_list(), bitcoin_data.merkle_hash(hashes)), calls)
+    timeit('merkle_hash, same list', lambda: bitcoin_data.merkle_hash(hashes), calls)
+    timeit('calculate_merkle_link, new list', lambda: (new_list(), bitcoin_data.calculate_merkle_link([None] + hashes, 0)), calls)
+    timeit('calculate_merkle_link, same list', lambda: bitcoin_data.calculate_merkle_link([None] + hashes, 0), calls)
+    link = bitcoin_data.calculate_merkle_link([None] + hashes, 0)
+    timeit('check_merkle_link, new coinbase', lambda: bitcoin_data.check_merkle_link(random.randrange(2**256), link), calls)
+    if hasattr(bitcoin_data, 'get_merkle_tree'):
+        tree = bitcoin_data.get_merkle_tree([0] + hashes)
+        timeit('MerkleTree.get_root, new coinbase', lambda: tree.get_root(0, pack.IntType(256).pack(random.randrange(2**256))), calls)
+
+if __name__ == '__main__':
+    main()
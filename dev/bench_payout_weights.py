@@ -0,0 +1,56 @@
+# compares data.CumulativeWeights with the old WeightsSkipList while following a growing share chain,
+# making the get_cumulative_weights calls generate_transaction and get_expected_payouts make for each new share
+# usage: python dev/bench_payout_weights.py [SHARES] [REAL_CHAIN_LENGTH]
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from p2pool import data
+from p2pool.bitcoin import data as bitcoin_data
+from p2pool.util import forest
+
+class FakeShare(object):
+    def __init__(self, hash, previous_hash, new_script, donation, target):
+        self.hash = hash
+        self.previous_hash = previous_hash
+        self.new_script = new_script
+        self.share_data = dict(donation=donation)
+        self.target = target
+
+def run(name, weights_type, shares, real_chain_length, block_attempts_per_share):
+    tracker = forest.Tracker()
+    get_cumulative_weights = weights_type(tracker)
+    results = []
+    t = 0
+    for height, share in enumerate(shares, 1):
+        tracker.add(share)
+        desired_weight = 65535*3*block_attempts_per_share*bitcoin_data.target_to_average_attempts(share.target)
+        start = time.time()
+        if share.previous_hash is not None:
+            results.append(get_cumulative_weights(share.previous_hash, max(0, min(height - 1, real_chain_length) - 1), desired_weight))
+        results.append(get_cumulative_weights(share.hash, min(height, real_chain_length), desired_weight))
+        t += time.time() - start
+    print '    %-17s %7.1f us/share' % (name, t/len(shares)*1e6)
+    return results
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 17280
+    real_chain_length = int(sys.argv[2]) if len(sys.argv) > 2 else 8640
+    
+    random.seed(0)
+    scripts = ['script%i' % (i,) for i in xrange(300)]
+    target = 2**256//100000
+    shares = [FakeShare(i, i - 1 if i else None, random.choice(scripts), random.choice([0, 0, 0, 50]), target) for i in xrange(n)]
+    
+    for block_attempts_per_share, limit in [(3000, 'REAL_CHAIN_LENGTH'), (1000, 'weight')]:
+        print '%i shares, window limited by %s' % (n, limit)
+        a = run('WeightsSkipList', data.WeightsSkipList, shares, real_chain_length, block_attempts_per_share)
+        b = run('CumulativeWeights', data.CumulativeWeights, shares, real_chain_length, block_attempts_per_share)
+        assert a == b
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+# times hashing a batch of received share headers with the litecoin network's scrypt PoW, one by one on the reactor
+# thread against helper.get_pow_hashes spreading them over the reactor's thread pool. besides the total, it reports
+# the longest the reactor went without running a timer that is due every millisecond, which is how long peers and
+# miners would have been kept waiting. needs ltc_scrypt built from litecoin_scrypt/ with getPoWHashes
+# usage: python dev/bench_pow.py [HEADERS] [THREADS]
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from twisted.internet import defer, reactor, task
+
+from p2pool.bitcoin import helper, networks
+
+@defer.inlineCallbacks
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    net = networks.nets['litecoin']
+    headers = [os.urandom(80) for i in xrange(n)]
+    
+    print '%i headers, %i threads, ltc_scrypt.getPoWHashes %s, ms' % (n, reactor.getThreadPool().max,
+        'found' if hasattr(__import__('ltc_scrypt'), 'getPoWHashes') else 'missing')
+    for name, f in [('POW_FUNC on the reactor', lambda: defer.succeed(map(net.POW_FUNC, headers))), ('get_pow_hashes', lambda: helper.get_pow_hashes(net, headers))]:
+        ticks = []
+        t = task.LoopingCall(lambda: ticks.append(time.time()))
+        t.start(.001)
+        yield task.deferLater(reactor, .05, lambda: None)
+        start = time.time()
+        res = yield f()
+        yield task.deferLater(reactor, .01, lambda: None)
+        t.stop()
+        total = time.time() - start
+        assert res == map(net.POW_FUNC, headers)
+        print '    %-25s total: %8.1f  longest reactor stall: %8.1f' % (name, total*1e3, max(b - a for a, b in zip(ticks, ticks[1:]))*1e3)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2:
+        reactor.suggestThreadPoolSize(int(sys.argv[2]))
+    reactor.callWhenRunning(lambda: main().addBoth(lambda _: reactor.stop()))
+    reactor.run()
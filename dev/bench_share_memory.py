@@ -0,0 +1,53 @@
+# reports how many bytes each share object takes, counting everything reachable from it that isn't shared with
+# the network definition or the share classes. objects shared between shares (like interned scripts) count once
+# usage: python dev/bench_share_memory.py [SHARES]
+
+import gc
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import p2pool
+from p2pool import data
+from p2pool.test import test_data
+
+def get_reachable_size(roots, seen):
+    total = 0
+    stack = list(roots)
+    while stack:
+        x = stack.pop()
+        if id(x) in seen or isinstance(x, (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType)):
+            continue
+        seen.add(id(x))
+        total += sys.getsizeof(x)
+        stack.extend(gc.get_referents(x))
+    return total
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    p2pool.DEBUG = False
+    net = test_data.testnet
+    
+    generated = test_data.generate_shares(data.OkayTracker(net), n, pubkey_hashes=50)
+    packed = [share.as_share_header() for share in generated]
+    del generated
+    
+    shared = set()
+    get_reachable_size([net, data.Share, data.NewShare], shared)
+    
+    shares = [data.load_share(header['share'], net, None) for header in packed]
+    for share in shares:
+        share.pow_hash # some objects are only made once this is needed
+    print '%i shares' % (n,)
+    print '    loaded:             %5i bytes/share' % (get_reachable_size(shares, set(shared))//n,)
+    
+    shares = [data.load_share_header(header, net) for header in packed]
+    print '    from_header:        %5i bytes/share' % (get_reachable_size(shares, set(shared))//n,)
+    for share in shares:
+        share.materialize()
+    print '    from_header, used:  %5i bytes/share' % (get_reachable_size(shares, set(shared))//n,)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+# measures the cost of main.save_shares' ShareStore calls with a chain spread over many share files
+# usage: python dev/bench_share_store.py [SHARES]
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from p2pool import data
+
+class FakeShare(object):
+    def __init__(self, hash):
+        self.hash = hash
+        self._packed = os.urandom(700)
+    
+    def as_share(self):
+        return dict(type=data.Share.VERSION, contents=self._packed)
+    
+    def as_share_header(self):
+        return dict(hash=self.hash, previous_hash=None, target=2**256-1, max_target=2**256-1, timestamp=0, share=self.as_share())
+
+class LinearScanShareStore(data.ShareStore):
+    # what ShareStore did before it kept a hash -> filename index and an open tail file
+    def _add_record(self, type_id, contents):
+        filenames, next = self.get_filenames_and_next()
+        if filenames and os.path.getsize(filenames[-1]) < self.MAX_FILE_SIZE:
+            filename = filenames[-1]
+        else:
+            filename = next
+        with open(filename, 'ab') as f:
+            if not f.tell():
+                f.write(data.SHARE_FILE_HEADER)
+            f.write(data.share_record_type.pack(dict(type=type_id, contents=contents)))
+        return filename
+    
+    def add_share(self, share):
+        for filename, (share_hashes, verified_hashes) in self.known.iteritems():
+            if share.hash in share_hashes:
+                break
+        else:
+            filename = self._add_record(6, data.share_header_record_type.pack(share.as_share_header()))
+            self.share_filenames[share.hash] = filename
+            self.known.setdefault(filename, (set(), set()))[0].add(share.hash)
+        self.known_desired.setdefault(filename, (set(), set()))[0].add(share.hash)
+    
+    def add_verified_hash(self, share_hash):
+        for filename, (share_hashes, verified_hashes) in self.known.iteritems():
+            if share_hash in verified_hashes:
+                break
+        else:
+            filename = self._add_record(2, data.pack.IntType(256).pack(share_hash))
+            self.verified_filenames[share_hash] = filename
+            self.known.setdefault(filename, (set(), set()))[1].add(share_hash)
+        self.known_desired.setdefault(filename, (set(), set()))[1].add(share_hash)
+
+def save_shares(ss, shares):
+    start = time.time()
+    for share in shares:
+        ss.add_share(share)
+        ss.add_verified_hash(share.hash)
+    return time.time() - start
+
+def run(store_type, shares):
+    dirname = tempfile.mkdtemp()
+    try:
+        ss = store_type(os.path.join(dirname, 'shares.'), None, None, None)
+        ss.MAX_FILE_SIZE = len(shares)*730//12 # spread the chain over ~12 files
+        first = save_shares(ss, shares)
+        again = min(save_shares(ss, shares) for i in xrange(3))
+        return len(ss.known), first, again
+    finally:
+        shutil.rmtree(dirname)
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    shares = [FakeShare(random.randrange(2**256)) for i in xrange(n)]
+    for store_type in [LinearScanShareStore, data.ShareStore]:
+        files, first, again = run(store_type, shares)
+        print '%-22s %i shares in %i files: initial write %.3fs, periodic save_shares %.3fs' % (store_type.__name__, n, files, first, again)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+# times what main does between launch and handing out the first work, with and without a tracker snapshot: loading
+# the share store, building the tracker, decoding the recent shares, the first think and the first get_work
+# usage: python dev/bench_startup.py [CHAIN_LENGTH]
+
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import p2pool
+from p2pool import data, node as p2pool_node, work
+from p2pool.bitcoin import data as bitcoin_data
+from p2pool.test import test_data
+from p2pool.util import math, variable
+
+block_target = 2**256//2**40
+
+def start(net, datadir, use_snapshot):
+    times = []
+    def lap(name):
+        times.append((name, time.time()))
+    lap('launch')
+    
+    shares = {}
+    known_verified = set()
+    ss = data.ShareStore(os.path.join(datadir, 'shares.'), net, lambda share: shares.__setitem__(share.hash, share), known_verified.add, lazy=True)
+    lap('load store')
+    
+    snapshot = None
+    if use_snapshot:
+        with open(os.path.join(datadir, 'tracker_snapshot'), 'rb') as f:
+            snapshot = json.loads(f.read())
+    n = p2pool_node.Node(None, None, shares.values(), known_verified, net, snapshot)
+    del snapshot
+    lap('build tracker')
+    
+    assert n.tracker.materialize_shares(n.get_recent_share_hashes()) == []
+    lap('decode recent')
+    
+    bitcoind_work = variable.Variable(dict(
+        version=0x20000000,
+        previous_block=random.randrange(2**256),
+        bits=bitcoin_data.FloatingInteger.from_target_upper_bound(block_target),
+        coinbaseflags='',
+        height=400000,
+        time=int(time.time()),
+        transactions=[],
+        transaction_fees=[],
+        merkle_link=bitcoin_data.calculate_merkle_link([None], 0),
+        subsidy=net.PARENT.SUBSIDY_FUNC(400000),
+        last_update=time.time(),
+        rules=[],
+    ))
+    best, desired, decorated_heads, bad_peer_addresses = n.tracker.think(lambda block_hash: 0, bitcoind_work.value['previous_block'], bitcoind_work.value['bits'], {})
+    lap('think')
+    
+    wb_node = math.Object(net=net, tracker=n.tracker, bitcoind_work=bitcoind_work, best_block_header=variable.Variable(None),
+        best_block_pow_hash=None, best_share_var=variable.Variable(best), p2p_node=None)
+    wb = work.WorkerBridge(wb_node, 0, 0, [], 0, math.Object(donation_percentage=0, worker_fee=0), None, None)
+    wb.get_work(random.randrange(2**160), None, None)
+    lap('first get_work')
+    return n, [(name, t - times[i][1]) for i, (name, t) in enumerate(times[1:])], times[-1][1] - times[0][1]
+
+def main():
+    chain_length = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    p2pool.DEBUG = False
+    random.seed(0)
+    net = math.Object(**dict(test_data.testnet.__dict__, CHAIN_LENGTH=chain_length, REAL_CHAIN_LENGTH=chain_length, PERSIST=False))
+    shares = test_data.generate_shares(data.OkayTracker(net), 2*chain_length, net=net) # what save_shares keeps
+    
+    datadir = tempfile.mkdtemp()
+    try:
+        ss = data.ShareStore(os.path.join(datadir, 'shares.'), net, lambda share: None, lambda share_hash: None)
+        for share in shares:
+            ss.add_share(share)
+            ss.add_verified_hash(share.hash)
+        del ss, shares
+        
+        n, laps, total = start(net, datadir, False)
+        with open(os.path.join(datadir, 'tracker_snapshot'), 'wb') as f:
+            f.write(json.dumps(n.get_tracker_snapshot()))
+        del n
+        
+        print '%i stored shares, CHAIN_LENGTH %i, ms from launch to the first get_work' % (2*chain_length, chain_length)
+        for use_snapshot in [False, True]:
+            best = min((start(net, datadir, use_snapshot)[1:] for i in xrange(3)), key=lambda (laps, total): total)
+            laps, total = best
+            print '    %-16s %s  total: %8.1f' % ('with snapshot' if use_snapshot else 'without snapshot', '  '.join('%s: %7.1f' % (name, t*1e3) for name, t in laps), total*1e3)
+    finally:
+        shutil.rmtree(datadir)
+
+if __name__ == '__main__':
+    main()
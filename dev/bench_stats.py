@@ -0,0 +1,94 @@
+# times p2pool.stats, with NumPy if it can be imported and with its plain loops, against walking tracker.get_chain
+# for each statistic separately the way the web endpoints used to
+# usage: python dev/bench_stats.py [SHARES]
+
+from __future__ import division
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from p2pool import data, stats
+from p2pool.bitcoin import data as bitcoin_data
+from p2pool.util import forest
+
+class FakeShare(object):
+    def __init__(self, hash, previous_hash):
+        self.hash = hash
+        self.previous_hash = previous_hash
+        self.timestamp = 1400000000 + hash*30 + random.randrange(-20, 20)
+        self.target = random.randrange(2**220, 2**224)
+        self.desired_version = random.choice([16, 17])
+        self.share_data = dict(stale_info=random.choice([None, None, None, 'orphan', 'doa']), pubkey_hash=random.randrange(300))
+
+def walk_pool_rates(tracker, head, lookbehinds):
+    res = {}
+    for lookbehind in lookbehinds:
+        chain = list(tracker.get_chain(head, lookbehind))
+        stale_count = sum(1 for share in chain if share.share_data['stale_info'] is not None)
+        res[lookbehind] = sum(bitcoin_data.target_to_average_attempts(share.target) for share in chain[:-1])/max(1, chain[0].timestamp - chain[-1].timestamp), stale_count/(lookbehind + stale_count)
+    return res
+
+def walk_user_stats(tracker, head, length):
+    res = {}
+    for share in tracker.get_chain(head, length):
+        count, stale_count, doa_count, work = res.get(share.share_data['pubkey_hash'], (0, 0, 0, 0))
+        res[share.share_data['pubkey_hash']] = count + 1, stale_count + (share.share_data['stale_info'] is not None), doa_count + (share.share_data['stale_info'] == 'doa'), work + bitcoin_data.target_to_average_attempts(share.target)
+    return res
+
+def walk_version_votes(tracker, head, length):
+    res = {}
+    for share in tracker.get_chain(head, length):
+        res[share.desired_version] = res.get(share.desired_version, 0) + bitcoin_data.target_to_average_attempts(share.target)
+    return res
+
+def walk_difficulty_history(tracker, head, length, period):
+    res = {}
+    for share in tracker.get_chain(head, length):
+        count, total = res.get(share.timestamp//period, (0, 0))
+        res[share.timestamp//period] = count + 1, total + bitcoin_data.target_to_difficulty(share.target)
+    return [(p*period, count, total/count) for p, (count, total) in sorted(res.iteritems())]
+
+def walk_share_intervals(tracker, head, length):
+    timestamps = [share.timestamp for share in tracker.get_chain(head, length)]
+    intervals = sorted(a - b for a, b in zip(timestamps, timestamps[1:]))
+    return sum(intervals)/len(intervals), [intervals[int(q*(len(intervals) - 1) + .5)] for q in [.1, .5, .9]]
+
+def timeit(f, n=10):
+    start = time.time()
+    for i in xrange(n):
+        f()
+    return (time.time() - start)/n*1e6
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 8640
+    
+    random.seed(0)
+    tracker = forest.Tracker(FakeShare(i, i - 1 if i else None) for i in xrange(n))
+    head = n - 1
+    best_chain = data.BestChain(tracker, n)
+    best_chain.set_head(head)
+    lookbehinds = [20, 120, n]
+    
+    tests = [
+        ('pool rates, %i windows' % (len(lookbehinds),), lambda: walk_pool_rates(tracker, head, lookbehinds), lambda: stats.get_pool_rates(best_chain, lookbehinds)),
+        ('user stats', lambda: walk_user_stats(tracker, head, n), lambda: stats.get_user_stats(best_chain, n)),
+        ('version votes', lambda: walk_version_votes(tracker, head, n), lambda: stats.get_version_votes(best_chain, n)),
+        ('difficulty history', lambda: walk_difficulty_history(tracker, head, n, 3600), lambda: stats.get_difficulty_history(best_chain, n, 3600)),
+        ('share intervals', lambda: walk_share_intervals(tracker, head, n), lambda: stats.get_share_intervals(best_chain, n)),
+    ]
+    
+    numpy = stats.numpy
+    print '%i shares, us per call' % (n,)
+    print '    %-22s %10s %10s %10s' % ('', 'get_chain', 'loops', 'numpy')
+    for name, walk, f in tests:
+        stats.numpy = None
+        loops = timeit(f)
+        stats.numpy = numpy
+        print '    %-22s %10.1f %10.1f %10s' % (name, timeit(walk), loops, '%.1f' % (timeit(f),) if numpy is not None else 'n/a')
+
+if __name__ == '__main__':
+    main()
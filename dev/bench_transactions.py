@@ -0,0 +1,69 @@
+# times what happens to the transactions of a block template: parsing them, then looking up their hashes and sizes
+# the way get_work, generate_transaction and the p2p code do, from the cached values on bitcoin.data.Transaction
+# against packing plain dicts of them again like before. also times helper.TemplateTransactions on the next poll's
+# template, which has CHANGED_PERCENT of the transactions replaced, against parsing it all again
+# usage: python dev/bench_transactions.py [TRANSACTIONS] [SEGWIT_PERCENT] [CHANGED_PERCENT]
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from p2pool.bitcoin import data as bitcoin_data, helper
+
+def make_tx(segwit):
+    tx = dict(
+        version=2,
+        tx_ins=[dict(previous_output=dict(hash=random.randrange(2**256), index=random.randrange(4)), script=os.urandom(random.choice([0, 107])), sequence=None) for i in xrange(random.randrange(1, 4))],
+        tx_outs=[dict(value=random.randrange(10**8), script=bitcoin_data.pubkey_hash_to_script2(random.randrange(2**160))) for i in xrange(random.randrange(1, 4))],
+        lock_time=0,
+    )
+    if segwit:
+        tx = dict(tx, marker=0, flag=1, witness=[[os.urandom(72), os.urandom(33)] for tx_in in tx['tx_ins']])
+    return bitcoin_data.tx_type.pack(tx)
+
+def timeit(f, n):
+    start = time.time()
+    for i in xrange(n):
+        f()
+    return (time.time() - start)/n*1e3
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    segwit_percent = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    changed_percent = int(sys.argv[3]) if len(sys.argv) > 3 else 2
+    random.seed(0)
+    packed = [make_tx(random.randrange(100) < segwit_percent) for i in xrange(n)]
+    txs = map(bitcoin_data.tx_type.unpack, packed)
+    dicts = map(dict, txs)
+    
+    print '%i transactions, %i%% segwit, ms per pass over all of them' % (n, segwit_percent)
+    print '    %-30s %8.2f' % ('tx_type.unpack', timeit(lambda: map(bitcoin_data.tx_type.unpack, packed), 5))
+    tests = [
+        ('hash (get_work, remember_tx)', lambda tx: bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx)), bitcoin_data.get_tx_hash),
+        ('size (remembered tx limits)', bitcoin_data.tx_type.packed_size, bitcoin_data.get_tx_size),
+        ('stripped size', bitcoin_data.tx_id_type.packed_size, bitcoin_data.get_stripped_tx_size),
+        ('txid and wtxid (segwit_data)', lambda tx: bitcoin_data.get_wtxid(tx, bitcoin_data.get_txid(tx)), lambda tx: bitcoin_data.get_wtxid(tx, bitcoin_data.get_txid(tx))),
+    ]
+    print '    %-30s %8s %8s' % ('', 'packing', 'cached')
+    for name, old, new in tests:
+        assert map(old, dicts) == map(new, txs)
+        print '    %-30s %8.2f %8.2f' % (name, timeit(lambda: map(old, dicts), 5), timeit(lambda: map(new, txs), 5))
+    
+    datas = [x.encode('hex') for x in packed]
+    next_datas = [data if random.randrange(100) >= changed_percent else make_tx(random.randrange(100) < segwit_percent).encode('hex') for data in datas]
+    def ingest_next():
+        template_txs = helper.TemplateTransactions()
+        template_txs.ingest(datas)
+        start = time.time()
+        res, new_count = template_txs.ingest(next_datas)
+        return time.time() - start, new_count
+    times, new_counts = zip(*[ingest_next() for i in xrange(5)])
+    print 'next template, %i of %i transactions new, ms' % (new_counts[0], n)
+    print '    %-30s %8.2f' % ('parsing all of it', timeit(lambda: [bitcoin_data.tx_type.unpack(data.decode('hex')) for data in next_datas], 5))
+    print '    %-30s %8.2f' % ('TemplateTransactions.ingest', sum(times)/len(times)*1e3)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+# compares how generate_transaction finds the shares that already introduced the transactions it wants to include:
+# reading the new_transaction_hashes of the last 100 shares on every call the way it used to, against
+# data.RecentTransactionRefs while following a growing share chain with a few get_work calls per share
+# usage: python dev/bench_tx_refs.py [TXS_PER_SHARE] [MEMPOOL_TXS] [GET_WORKS_PER_SHARE]
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from p2pool import data
+from p2pool.util import forest
+
+class FakeShare(object):
+    def __init__(self, hash, previous_hash, new_transaction_hashes):
+        self.hash = hash
+        self.previous_hash = previous_hash
+        self.new_transaction_hashes = new_transaction_hashes
+
+def old_refs(tracker, previous_share_hash, desired_tx_hashes):
+    tx_hash_to_this = {}
+    for i, share in enumerate(tracker.get_chain(previous_share_hash, min(tracker.get_height(previous_share_hash), 100))):
+        for j, tx_hash in enumerate(share.new_transaction_hashes):
+            if tx_hash not in tx_hash_to_this:
+                tx_hash_to_this[tx_hash] = [1+i, j] # share_count, tx_count
+    return [tx_hash_to_this.get(tx_hash) for tx_hash in desired_tx_hashes]
+
+def new_refs(tracker, previous_share_hash, desired_tx_hashes):
+    tx_refs = tracker.get_transaction_refs(previous_share_hash, min(tracker.get_height(previous_share_hash), 100))
+    res = []
+    for tx_hash in desired_tx_hashes:
+        if tx_hash in tx_refs.refs:
+            position, tx_count = tx_refs.refs[tx_hash]
+            res.append([tx_refs.top - position + 1, tx_count])
+        else:
+            res.append(None)
+    return res
+
+def main():
+    txs_per_share = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    mempool_txs = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    get_works = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+    n = 300
+    
+    random.seed(0)
+    # each share introduces the next txs_per_share transactions, and the mempool holds the most recent ones
+    shares = [FakeShare(i, i - 1 if i else None, range(i*txs_per_share, (i + 1)*txs_per_share)) for i in xrange(n)]
+    
+    print '%i new transactions per share, %i wanted transactions, %i get_works per share, us per call' % (txs_per_share, mempool_txs, get_works)
+    results = []
+    for name, f in [('get_chain every call', old_refs), ('RecentTransactionRefs', new_refs)]:
+        tracker = forest.Tracker()
+        tracker.get_transaction_refs = data.RecentTransactionRefs(tracker)
+        new_share_time = get_work_time = 0
+        res = []
+        for i, share in enumerate(shares):
+            tracker.add(share)
+            desired = range(max(0, (i + 1)*txs_per_share - mempool_txs + 100), (i + 1)*txs_per_share + 100)
+            start = time.time()
+            res.append(f(tracker, share.hash, desired)) # Share.check of the share after this one
+            new_share_time += time.time() - start
+            start = time.time()
+            for j in xrange(get_works):
+                res.append(f(tracker, share.hash, desired))
+            get_work_time += time.time() - start
+        results.append(res)
+        print '    %-25s first call after a new share: %8.1f  later calls: %8.1f' % (name, new_share_time/n*1e6, get_work_time/n/get_works*1e6)
+    assert results[0] == results[1]
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+# times OkayTracker.think catching up on verifying a long chain below a verified head, like after startup, checking
+# everything in one call against limiting it with max_checks, and the same for imported shares. the longest call is how
+# long the reactor is held up
+# usage: python dev/bench_verify_batch.py [CHAIN_LENGTH]
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import p2pool
+from p2pool import data
+from p2pool.test import test_data
+from p2pool.util import math
+
+def run(t):
+    times = []
+    while True:
+        start = time.time()
+        t.think(lambda block_hash: 0, None, None, {})
+        times.append(time.time() - start)
+        if not t.verify_backlog:
+            break
+    return times
+
+def main():
+    chain_length = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    p2pool.DEBUG = False
+    net = math.Object(**dict(test_data.testnet.__dict__, CHAIN_LENGTH=chain_length, REAL_CHAIN_LENGTH=chain_length))
+    shares = test_data.generate_shares(data.OkayTracker(net), 2*chain_length + 10, net=net)
+    
+    print '%i shares below a verified head, ms' % (chain_length - 1,)
+    for max_checks in [None, 100, 20]:
+        t = data.OkayTracker(net)
+        for share in shares:
+            t.add(share)
+        t.verified.add(shares[-1])
+        t.max_checks = max_checks
+        times = run(t)
+        assert len(t.verified.items) == chain_length
+        print '    max_checks %-5s %4i calls  longest: %8.1f  total: %8.1f' % (max_checks, len(times), max(times)*1e3, sum(times)*1e3)
+    
+    print '%i imported shares given to verify_shares, ms' % (len(shares),)
+    for max_checks in [None, 20]:
+        t = data.OkayTracker(net)
+        for share in shares:
+            t.add(share)
+        t.max_checks = max_checks
+        t.verify_shares([share.hash for share in shares])
+        times = run(t)
+        assert len(t.verified.items) == len(shares) # the chain starts at the first share, so all of them can be checked
+        print '    max_checks %-5s %4i calls  longest: %8.1f  total: %8.1f' % (max_checks, len(times), max(times)*1e3, sum(times)*1e3)
+
+if __name__ == '__main__':
+    main()
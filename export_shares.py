@@ -0,0 +1,5 @@
+#!/usr/bin/env python
+
+from p2pool import main
+
+main.export_shares()
@@ -1,6 +1,7 @@
 #include <Python.h>
 
 //#include "scrypt.h"
+void scrypt_1024_1_1_256(const char *input, char *output);
 
 static PyObject *scrypt_getpowhash(PyObject *self, PyObject *args)
 {
@@ -12,15 +13,70 @@ static PyObject *scrypt_getpowhash(PyObject *self, PyObject *args)
     Py_INCREF(input);
     output = PyMem_Malloc(32);
 
+    Py_BEGIN_ALLOW_THREADS
     scrypt_1024_1_1_256((char *)PyString_AsString((PyObject*) input), output);
+    Py_END_ALLOW_THREADS
     Py_DECREF(input);
     value = Py_BuildValue("s#", output, 32);
     PyMem_Free(output);
     return value;
 }
 
+static PyObject *scrypt_getpowhashes(PyObject *self, PyObject *args)
+{
+    char *input, *output;
+    PyObject *headers, *seq, *item, *value = NULL;
+    Py_ssize_t count, i;
+    if (!PyArg_ParseTuple(args, "O", &headers))
+        return NULL;
+    seq = PySequence_Fast(headers, "expected a sequence of 80 byte headers");
+    if (seq == NULL)
+        return NULL;
+    count = PySequence_Fast_GET_SIZE(seq);
+    input = PyMem_Malloc(80*count + 1);
+    output = PyMem_Malloc(32*count + 1);
+    if (input == NULL || output == NULL) {
+        PyErr_NoMemory();
+        goto done;
+    }
+
+    // copied out first so that the hashing doesn't touch any Python objects while other threads run
+    for (i = 0; i < count; i++) {
+        item = PySequence_Fast_GET_ITEM(seq, i);
+        if (!PyString_Check(item) || PyString_GET_SIZE(item) != 80) {
+            PyErr_SetString(PyExc_ValueError, "headers must be 80 byte strings");
+            goto done;
+        }
+        memcpy(input + 80*i, PyString_AS_STRING(item), 80);
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    for (i = 0; i < count; i++)
+        scrypt_1024_1_1_256(input + 80*i, output + 32*i);
+    Py_END_ALLOW_THREADS
+
+    value = PyList_New(count);
+    if (value == NULL)
+        goto done;
+    for (i = 0; i < count; i++) {
+        item = PyString_FromStringAndSize(output + 32*i, 32);
+        if (item == NULL) {
+            Py_CLEAR(value);
+            goto done;
+        }
+        PyList_SET_ITEM(value, i, item);
+    }
+
+done:
+    PyMem_Free(input);
+    PyMem_Free(output);
+    Py_DECREF(seq);
+    return value;
+}
+
 static PyMethodDef ScryptMethods[] = {
     { "getPoWHash", scrypt_getpowhash, METH_VARARGS, "Returns the proof of work hash using scrypt" },
+    { "getPoWHashes", scrypt_getpowhashes, METH_VARARGS, "Returns the proof of work hashes of a list of headers using scrypt, without holding the GIL while hashing" },
     { NULL, NULL, 0, NULL }
 };
 
@@ -5,7 +5,7 @@ import random
 import warnings
 
 import p2pool
-from p2pool.util import math, pack
+from p2pool.util import math, memoize, pack
 
 def hash256(data):
     return pack.IntType(256).unpack(hashlib.sha256(hashlib.sha256(data).digest()).digest())
@@ -115,6 +115,25 @@ tx_id_type = pack.ComposedType([
     ('lock_time', pack.IntType(32))
 ])
 
+class Transaction(dict):
+    '''a transaction as tx_type reads it. keeps the data it was read from and the hashes and sizes that come from it,
+    so that they don't have to be packed again. read-only, since those would be wrong after a change'''
+    __slots__ = 'packed stripped_size hash txid wtxid'.split(' ')
+    
+    def __init__(self, fields, packed, stripped=None):
+        dict.__init__(self, fields)
+        self.packed = packed
+        self.hash = hash256(packed)
+        if stripped is None: # not a segwit transaction, so it's packed the same either way
+            self.stripped_size, self.txid, self.wtxid = len(packed), self.hash, self.hash
+        else:
+            self.stripped_size, self.txid = len(stripped), hash256(stripped)
+            self.wtxid = self.hash if any(len(w) > 0 for w in fields['witness']) else self.txid
+    
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('transactions are read-only, copy them with dict() to make a changed one')
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _read_only
+
 class TransactionType(pack.Type):
     _int_type = pack.IntType(32)
     _varint_type = pack.VarIntType()
@@ -137,23 +156,30 @@ class TransactionType(pack.Type):
     ])
 
     def read(self, file):
+        data, start = file
         version, file = self._int_type.read(file)
         marker, file = self._varint_type.read(file)
         if marker == 0:
             next, file = self._wtx_type.read(file)
+            tx_outs_end = file[1]
             witness = [None]*len(next['tx_ins'])
             for i in xrange(len(next['tx_ins'])):
                 witness[i], file = self._witness_type.read(file)
             locktime, file = self._int_type.read(file)
-            return dict(version=version, marker=marker, flag=next['flag'], tx_ins=next['tx_ins'], tx_outs=next['tx_outs'], witness=witness, lock_time=locktime), file
+            end = file[1]
+            # the stripped form leaves out the marker, flag and witnesses
+            return Transaction(dict(version=version, marker=marker, flag=next['flag'], tx_ins=next['tx_ins'], tx_outs=next['tx_outs'], witness=witness, lock_time=locktime),
+                data[start:end], data[start:start + 4] + data[start + 6:tx_outs_end] + data[end - 4:end]), file
         else:
             tx_ins = [None]*marker
             for i in xrange(marker):
                 tx_ins[i], file = tx_in_type.read(file)
             next, file = self._ntx_type.read(file)
-            return dict(version=version, tx_ins=tx_ins, tx_outs=next['tx_outs'], lock_time=next['lock_time']), file
+            return Transaction(dict(version=version, tx_ins=tx_ins, tx_outs=next['tx_outs'], lock_time=next['lock_time']), data[start:file[1]]), file
     
     def write(self, file, item):
+        if isinstance(item, Transaction):
+            return file, item.packed
         if is_segwit_tx(item):
             assert len(item['tx_ins']) == len(item['witness'])
             res = self._write_type.pack(item)
@@ -230,49 +256,77 @@ merkle_record_type = pack.ComposedType([
     ('right', pack.IntType(256)),
 ])
 
+def _hash_pair(left, right):
+    if left is None or right is None:
+        return None
+    return hashlib.sha256(hashlib.sha256(left + right).digest()).digest()
+
+class MerkleTree(object):
+    '''every level of the merkle tree of a list of packed 32 byte hashes. a leaf can be None, like the coinbase
+    transaction's before it's known, which makes the nodes above it None too'''
+    __slots__ = ['levels']
+    
+    def __init__(self, leaves):
+        level = list(leaves)
+        self.levels = [level]
+        while len(level) > 1:
+            level = [_hash_pair(level[i], level[i + 1] if i + 1 < len(level) else level[i]) for i in xrange(0, len(level), 2)]
+            self.levels.append(level)
+    
+    def get_link(self, index):
+        '''the packed hashes that the leaf at index is hashed with on the way up'''
+        branch = []
+        for level in self.levels[:-1]:
+            branch.append(level[index ^ 1] if index ^ 1 < len(level) else level[index])
+            index >>= 1
+        return branch
+    
+    def get_root(self, index=0, leaf=None):
+        '''the packed root, or what it would be with leaf at index instead, which only hashes the nodes above it'''
+        if leaf is None:
+            return self.levels[-1][0]
+        for level in self.levels[:-1]:
+            if index ^ 1 >= len(level): # the last node of an odd level is hashed with itself
+                leaf = _hash_pair(leaf, leaf)
+            elif index & 1:
+                leaf = _hash_pair(level[index ^ 1], leaf)
+            else:
+                leaf = _hash_pair(leaf, level[index ^ 1])
+            index >>= 1
+        return leaf
+
+_merkle_trees = memoize.LRUDict(10)
+
+def get_merkle_tree(hashes):
+    '''MerkleTree of a list of hashes as integers, shared with recent calls for the same list'''
+    key = tuple(hashes)
+    tree = _merkle_trees.get(key)
+    if tree is None:
+        tree = _merkle_trees[key] = MerkleTree(None if h is None else pack.IntType(256).pack(h) for h in key)
+    return tree
+
 def merkle_hash(hashes):
     if not hashes:
         return 0
-    hash_list = list(hashes)
-    while len(hash_list) > 1:
-        hash_list = [hash256(merkle_record_type.pack(dict(left=left, right=right)))
-            for left, right in zip(hash_list[::2], hash_list[1::2] + [hash_list[::2][-1]])]
-    return hash_list[0]
+    return pack.IntType(256).unpack(get_merkle_tree(hashes).get_root())
 
 def calculate_merkle_link(hashes, index):
-    # XXX optimize this
-    
-    hash_list = [(lambda _h=h: _h, i == index, []) for i, h in enumerate(hashes)]
-    
-    while len(hash_list) > 1:
-        hash_list = [
-            (
-                lambda _left=left, _right=right: hash256(merkle_record_type.pack(dict(left=_left(), right=_right()))),
-                left_f or right_f,
-                (left_l if left_f else right_l) + [dict(side=1, hash=right) if left_f else dict(side=0, hash=left)],
-            )
-            for (left, left_f, left_l), (right, right_f, right_l) in
-                zip(hash_list[::2], hash_list[1::2] + [hash_list[::2][-1]])
-        ]
-    
-    res = [x['hash']() for x in hash_list[0][2]]
+    res = [pack.IntType(256).unpack(h) for h in get_merkle_tree(hashes).get_link(index)]
     
-    assert hash_list[0][1]
     if p2pool.DEBUG:
         new_hashes = [random.randrange(2**256) if x is None else x
             for x in hashes]
         assert check_merkle_link(new_hashes[index], dict(branch=res, index=index)) == merkle_hash(new_hashes)
-    assert index == sum(k*2**i for i, k in enumerate([1-x['side'] for x in hash_list[0][2]]))
     
     return dict(branch=res, index=index)
 
 def check_merkle_link(tip_hash, link):
     if link['index'] >= 2**len(link['branch']):
         raise ValueError('index too large')
-    return reduce(lambda c, (i, h): hash256(merkle_record_type.pack(
-        dict(left=h, right=c) if (link['index'] >> i) & 1 else
-        dict(left=c, right=h)
-    )), enumerate(link['branch']), tip_hash)
+    res = pack.IntType(256).pack(tip_hash)
+    for i, h in enumerate(link['branch']):
+        res = _hash_pair(pack.IntType(256).pack(h), res) if (link['index'] >> i) & 1 else _hash_pair(res, pack.IntType(256).pack(h))
+    return pack.IntType(256).unpack(res)
 
 # targets
 
@@ -329,7 +383,25 @@ def address_to_pubkey_hash(address, net):
 def get_witness_commitment_hash(witness_root_hash, witness_reserved_value):
     return hash256(merkle_record_type.pack(dict(left=witness_root_hash, right=witness_reserved_value)))
 
+def get_tx_hash(tx):
+    '''hash256 of tx packed with tx_type, which is what known transactions are looked up by'''
+    if isinstance(tx, Transaction):
+        return tx.hash
+    return hash256(tx_type.pack(tx))
+
+def get_tx_size(tx):
+    if isinstance(tx, Transaction):
+        return len(tx.packed)
+    return tx_type.packed_size(tx)
+
+def get_stripped_tx_size(tx):
+    if isinstance(tx, Transaction):
+        return tx.stripped_size
+    return tx_id_type.packed_size(tx)
+
 def get_wtxid(tx, txid=None, txhash=None):
+    if isinstance(tx, Transaction):
+        return tx.wtxid
     has_witness = False
     if is_segwit_tx(tx):
         assert len(tx['tx_ins']) == len(tx['witness'])
@@ -340,6 +412,8 @@ def get_wtxid(tx, txid=None, txhash=None):
         return hash256(tx_id_type.pack(tx)) if txid is None else txid
 
 def get_txid(tx):
+    if isinstance(tx, Transaction):
+        return tx.txid
     return hash256(tx_id_type.pack(tx))
 
 def pubkey_to_script2(pubkey):
@@ -1,11 +1,11 @@
 import sys
 import time
 
-from twisted.internet import defer
+from twisted.internet import defer, reactor, threads
 
 import p2pool
 from p2pool.bitcoin import data as bitcoin_data
-from p2pool.util import deferral, jsonrpc
+from p2pool.util import deferral, jsonrpc, pack
 
 @deferral.retry('Error while checking Bitcoin connection:', 1)
 @defer.inlineCallbacks
@@ -34,9 +34,30 @@ def check(bitcoind, net):
         print 'Coin daemon too old! Upgrade!'
         raise deferral.RetrySilentlyException()
 
+class TemplateTransactions(object):
+    '''the parsed transactions of the last block template, so that getwork only has to parse the ones that are new'''
+    
+    def __init__(self):
+        self.txs = {} # hex data -> Transaction
+    
+    def ingest(self, datas):
+        '''parses the hex transactions in datas, returning them and how many of them weren't in the last template'''
+        old_txs, self.txs = self.txs, {}
+        res = []
+        new_count = 0
+        for data in datas:
+            tx = old_txs.get(data)
+            if tx is None:
+                tx = bitcoin_data.tx_type.unpack(data.decode('hex'))
+                new_count += 1
+            self.txs[data] = tx
+            res.append(tx)
+        return res, new_count
+
 @deferral.retry('Error getting work from bitcoind:', 3)
 @defer.inlineCallbacks
-def getwork(bitcoind, use_getblocktemplate=False):
+def getwork(bitcoind, use_getblocktemplate=False, template_txs=None):
+    '''template_txs is a TemplateTransactions kept between calls, to only parse the transactions that changed'''
     def go():
         if use_getblocktemplate:
             return bitcoind.rpc_getblocktemplate(dict(mode='template', rules=['segwit']))
@@ -55,7 +76,11 @@ def getwork(bitcoind, use_getblocktemplate=False):
         except jsonrpc.Error_for_code(-32601): # Method not found
             print >>sys.stderr, 'Error: Bitcoin version too old! Upgrade to v0.5 or newer!'
             raise deferral.RetrySilentlyException()
-    packed_transactions = [x['data'].decode('hex') for x in work['transactions'] if len(x.get('depends', [])) == 0]
+    if template_txs is None:
+        template_txs = TemplateTransactions()
+    parse_start = time.time()
+    transactions, new_transaction_count = template_txs.ingest([x['data'] for x in work['transactions'] if len(x.get('depends', [])) == 0])
+    parse_time = time.time() - parse_start
     if 'height' not in work:
         work['height'] = (yield bitcoind.rpc_getblock(work['previousblockhash']))['height'] + 1
     elif p2pool.DEBUG:
@@ -63,8 +88,8 @@ def getwork(bitcoind, use_getblocktemplate=False):
     defer.returnValue(dict(
         version=work['version'],
         previous_block=int(work['previousblockhash'], 16),
-        transactions=map(bitcoin_data.tx_type.unpack, packed_transactions),
-        transaction_hashes=map(bitcoin_data.hash256, packed_transactions),
+        transactions=transactions,
+        transaction_hashes=map(bitcoin_data.get_tx_hash, transactions),
         transaction_fees=[x.get('fee', None) if isinstance(x, dict) else None for x in work['transactions']],
         subsidy=work['coinbasevalue'],
         time=work['time'] if 'time' in work else work['curtime'],
@@ -75,6 +100,8 @@ def getwork(bitcoind, use_getblocktemplate=False):
         last_update=time.time(),
         use_getblocktemplate=use_getblocktemplate,
         latency=end - start,
+        parse_time=parse_time,
+        new_transaction_count=new_transaction_count,
     ))
 
 @deferral.retry('Error submitting primary block: (will retry)', 10, 10)
@@ -98,7 +125,8 @@ def submit_block_rpc(block, ignore_failure, bitcoind, bitcoind_work, net):
     else:
         result = yield bitcoind.rpc_getmemorypool(bitcoin_data.block_type.pack(block).encode('hex'))
         success = result
-    success_expected = net.PARENT.POW_FUNC(bitcoin_data.block_header_type.pack(block['header'])) <= block['header']['bits'].target
+    pow_hash, = yield get_pow_hashes(net.PARENT, [bitcoin_data.block_header_type.pack(block['header'])])
+    success_expected = pow_hash <= block['header']['bits'].target
     if (not success and success_expected and not ignore_failure) or (success and not success_expected):
         print >>sys.stderr, 'Block submittal result: %s (%r) Expected: %s' % (success, result, success_expected)
 
@@ -114,3 +142,19 @@ def check_genesis_block(bitcoind, genesis_block_hash):
         defer.returnValue(False)
     else:
         defer.returnValue(True)
+
+def scrypt_pow_funcs(packed_headers):
+    '''POW_FUNCS of the scrypt networks'''
+    ltc_scrypt = __import__('ltc_scrypt')
+    if not hasattr(ltc_scrypt, 'getPoWHashes'): # built before getPoWHashes was added, so it can't hash in parallel
+        return [pack.IntType(256).unpack(ltc_scrypt.getPoWHash(packed_header)) for packed_header in packed_headers]
+    return map(pack.IntType(256).unpack, ltc_scrypt.getPoWHashes(packed_headers))
+
+def get_pow_hashes(net, packed_headers):
+    '''net.POW_FUNC of each of packed_headers, returned through a Deferred. if net has POW_FUNCS, which hashes a list of
+    headers without holding the GIL, the headers are split between the threads of the reactor's thread pool'''
+    if getattr(net, 'POW_FUNCS', None) is None or not packed_headers:
+        return defer.execute(map, net.POW_FUNC, packed_headers)
+    size = -(-len(packed_headers)//reactor.getThreadPool().max)
+    return defer.gatherResults([threads.deferToThread(net.POW_FUNCS, packed_headers[i:i + size]) for i in xrange(0, len(packed_headers), size)],
+        consumeErrors=True).addCallback(lambda results: sum(results, []))
@@ -1,16 +1,19 @@
 from __future__ import division
 
+import array
 import hashlib
+import heapq
 import os
 import random
 import sys
 import time
+import weakref
 
 from twisted.python import log
 
 import p2pool
 from p2pool.bitcoin import data as bitcoin_data, script, sha256
-from p2pool.util import math, forest, pack
+from p2pool.util import math, forest, memoize, pack
 
 def parse_bip0034(coinbase):
     _, opdata = script.parse(coinbase).next()
@@ -46,24 +49,62 @@ share_type = pack.ComposedType([
     ('contents', pack.VarStrType()),
 ])
 
-def load_share(share, net, peer_addr):
+def load_share(share, net, peer_addr, check_pow=True):
+    '''with check_pow=False, set_pow_hash has to be called on the share before it is used'''
     assert peer_addr is None or isinstance(peer_addr, tuple)
     if share['type'] < Share.VERSION:
         from p2pool import p2p
         raise p2p.PeerMisbehavingError('sent an obsolete share')
     elif share['type'] == Share.VERSION:
-        return Share(net, peer_addr, Share.get_dynamic_types(net)['share_type'].unpack(share['contents']))
+        return Share(net, peer_addr, Share.get_dynamic_types(net)['share_type'].unpack(share['contents']), check_pow)
     elif share['type'] == NewShare.VERSION:
-        return NewShare(net, peer_addr, NewShare.get_dynamic_types(net)['share_type'].unpack(share['contents']))
+        return NewShare(net, peer_addr, NewShare.get_dynamic_types(net)['share_type'].unpack(share['contents']), check_pow)
     else:
         raise ValueError('unknown share type: %r' % (share['type'],))
 
+# what's needed to put a share into a tracker, stored next to it so that it can be loaded without decoding it
+share_header_record_type = pack.ComposedType([
+    ('hash', pack.IntType(256)),
+    ('previous_hash', pack.PossiblyNoneType(0, pack.IntType(256))),
+    ('target', pack.IntType(256)),
+    ('max_target', pack.IntType(256)),
+    ('timestamp', pack.IntType(32)),
+    ('share', share_type),
+])
+
+def load_share_header(header, net):
+    '''like load_share, but the returned share only has its header until its materialize method is called. only for
+    shares that were already checked, like the ones in a ShareStore'''
+    if header['share']['type'] == Share.VERSION:
+        return Share.from_header(net, header)
+    elif header['share']['type'] == NewShare.VERSION:
+        return NewShare.from_header(net, header)
+    else:
+        raise ValueError('unknown share type: %r' % (header['share']['type'],))
+
 def is_segwit_activated(version, net):
     assert not(version is None or net is None)
     segwit_activation_version = getattr(net, 'SEGWIT_ACTIVATION_VERSION', 0)
     return version >= segwit_activation_version and segwit_activation_version > 0
 
+class _Payee(object):
+    # the pubkey_hash and script objects of an address, which every share paying it uses
+    __slots__ = ['pubkey_hash', 'script', '__weakref__']
+    
+    def __init__(self, pubkey_hash):
+        self.pubkey_hash = pubkey_hash
+        self.script = bitcoin_data.pubkey_hash_to_script2(pubkey_hash)
+
+_payees = weakref.WeakValueDictionary() # pubkey_hash -> _Payee, for as long as a share holds it
+
+def _get_payee(pubkey_hash):
+    payee = _payees.get(pubkey_hash)
+    if payee is None:
+        payee = _payees[pubkey_hash] = _Payee(pubkey_hash)
+    return payee
+
 DONATION_SCRIPT = '4104ffd03de44a6e11b9917f3a29f9443283d9871c9d743ef30d5eddcd37094b64d1b3d8090496b53256786bf5c82932ec23c3b74d9f05a6f95a8b5529352656664bac'.decode('hex')
+WITNESS_RESERVED_VALUE = '[P2Pool]'*4
 
 class BaseShare(object):
     VERSION = 0
@@ -80,13 +121,14 @@ class BaseShare(object):
         ('bits', bitcoin_data.FloatingIntegerType()),
         ('nonce', pack.IntType(32)),
     ])
-    share_info_type = None
-    share_type = None
-    ref_type = None
+    share_info_type = property(lambda self: self.get_dynamic_types(self.net)['share_info_type'])
+    share_type = property(lambda self: self.get_dynamic_types(self.net)['share_type'])
+    ref_type = property(lambda self: self.get_dynamic_types(self.net)['ref_type'])
 
     gentx_before_refhash = pack.VarStrType().pack(DONATION_SCRIPT) + pack.IntType(64).pack(0) + pack.VarStrType().pack('\x6a\x28' + pack.IntType(256).pack(0) + pack.IntType(64).pack(0))[:3]
 
     @classmethod
+    @memoize.memoize
     def get_dynamic_types(cls, net):
         t = dict(share_info_type=None, share_type=None, ref_type=None)
         segwit_data = ('segwit_data', pack.PossiblyNoneType(dict(txid_merkle_link=dict(branch=[], index=0), wtxid_merkle_root=2**256-1), pack.ComposedType([
@@ -96,26 +138,33 @@ class BaseShare(object):
             ])),
             ('wtxid_merkle_root', pack.IntType(256))
         ])))
-        t['share_info_type'] = pack.ComposedType([
-            ('share_data', pack.ComposedType([
-                ('previous_share_hash', pack.PossiblyNoneType(0, pack.IntType(256))),
-                ('coinbase', pack.VarStrType()),
-                ('nonce', pack.IntType(32)),
-                ('pubkey_hash', pack.IntType(160)),
-                ('subsidy', pack.IntType(64)),
-                ('donation', pack.IntType(16)),
-                ('stale_info', pack.EnumType(pack.IntType(8), dict((k, {0: None, 253: 'orphan', 254: 'doa'}.get(k, 'unk%i' % (k,))) for k in xrange(256)))),
-                ('desired_version', pack.VarIntType()),
-            ]))] + ([segwit_data] if is_segwit_activated(cls.VERSION, net) else []) + [
+        share_data = ('share_data', pack.ComposedType([
+            ('previous_share_hash', pack.PossiblyNoneType(0, pack.IntType(256))),
+            ('coinbase', pack.VarStrType()),
+            ('nonce', pack.IntType(32)),
+            ('pubkey_hash', pack.IntType(160)),
+            ('subsidy', pack.IntType(64)),
+            ('donation', pack.IntType(16)),
+            ('stale_info', pack.EnumType(pack.IntType(8), dict((k, {0: None, 253: 'orphan', 254: 'doa'}.get(k, 'unk%i' % (k,))) for k in xrange(256)))),
+            ('desired_version', pack.VarIntType()),
+        ]))
+        template_fields = ([segwit_data] if is_segwit_activated(cls.VERSION, net) else []) + [
             ('new_transaction_hashes', pack.ListType(pack.IntType(256))),
             ('transaction_hash_refs', pack.ListType(pack.VarIntType(), 2)), # pairs of share_count, tx_count
             ('far_share_hash', pack.PossiblyNoneType(0, pack.IntType(256))),
             ('max_bits', bitcoin_data.FloatingIntegerType()),
+        ]
+        tail_fields = [
             ('bits', bitcoin_data.FloatingIntegerType()),
             ('timestamp', pack.IntType(32)),
             ('absheight', pack.IntType(32)),
             ('abswork', pack.IntType(128)),
-        ])
+        ]
+        t['share_info_type'] = pack.ComposedType([share_data] + template_fields + tail_fields)
+        # share_info_type in three parts, so that get_ref_hash can reuse the packed fields that come from generate_transaction_template
+        t['share_data_type'] = share_data[1]
+        t['share_info_template_type'] = pack.ComposedType(template_fields)
+        t['share_info_tail_type'] = pack.ComposedType(tail_fields)
         t['share_type'] = pack.ComposedType([
             ('min_header', cls.small_block_header_type),
             ('share_info', t['share_info_type']),
@@ -137,38 +186,34 @@ class BaseShare(object):
         return t
 
     @classmethod
-    def generate_transaction(cls, tracker, share_data, block_target, desired_timestamp, desired_target, ref_merkle_link, desired_other_transaction_hashes_and_fees, net, known_txs=None, last_txout_nonce=0, base_subsidy=None, segwit_data=None):
-        previous_share = tracker.items[share_data['previous_share_hash']] if share_data['previous_share_hash'] is not None else None
+    def generate_transaction_template(cls, tracker, previous_share_hash, subsidy, block_target, desired_other_transaction_hashes_and_fees, net, known_txs=None, base_subsidy=None, segwit_data=None):
+        '''the part of generate_transaction that is the same for every share on previous_share_hash with this block
+        template, whatever its payout address, target, timestamp or nonces'''
+        previous_share = tracker.items[previous_share_hash] if previous_share_hash is not None else None
         
-        height, last = tracker.get_height_and_last(share_data['previous_share_hash'])
+        height, last = tracker.get_height_and_last(previous_share_hash)
         assert height >= net.REAL_CHAIN_LENGTH or last is None
         if height < net.TARGET_LOOKBEHIND:
             pre_target3 = net.MAX_TARGET
         else:
-            attempts_per_second = get_pool_attempts_per_second(tracker, share_data['previous_share_hash'], net.TARGET_LOOKBEHIND, min_work=True, integer=True)
+            attempts_per_second = get_pool_attempts_per_second(tracker, previous_share_hash, net.TARGET_LOOKBEHIND, min_work=True, integer=True)
             pre_target = 2**256//(net.SHARE_PERIOD*attempts_per_second) - 1 if attempts_per_second else 2**256-1
             pre_target2 = math.clip(pre_target, (previous_share.max_target*9//10, previous_share.max_target*11//10))
             pre_target3 = math.clip(pre_target2, (net.MIN_TARGET, net.MAX_TARGET))
-        max_bits = bitcoin_data.FloatingInteger.from_target_upper_bound(pre_target3)
-        bits = bitcoin_data.FloatingInteger.from_target_upper_bound(math.clip(desired_target, (pre_target3//30, pre_target3)))
         
         new_transaction_hashes = []
         new_transaction_size = 0
         transaction_hash_refs = []
         other_transaction_hashes = []
         
-        past_shares = list(tracker.get_chain(share_data['previous_share_hash'], min(height, 100)))
-        tx_hash_to_this = {}
-        for i, share in enumerate(past_shares):
-            for j, tx_hash in enumerate(share.new_transaction_hashes):
-                if tx_hash not in tx_hash_to_this:
-                    tx_hash_to_this[tx_hash] = [1+i, j] # share_count, tx_count
+        tx_refs = tracker.get_transaction_refs(previous_share_hash, min(height, 100))
         for tx_hash, fee in desired_other_transaction_hashes_and_fees:
-            if tx_hash in tx_hash_to_this:
-                this = tx_hash_to_this[tx_hash]
+            if tx_hash in tx_refs.refs:
+                position, tx_count = tx_refs.refs[tx_hash]
+                this = [tx_refs.top - position + 1, tx_count] # share_count, tx_count
             else:
                 if known_txs is not None:
-                    this_size = bitcoin_data.tx_type.packed_size(known_txs[tx_hash])
+                    this_size = bitcoin_data.get_tx_size(known_txs[tx_hash])
                     if new_transaction_size + this_size > cls.MAX_NEW_TXS_SIZE: # limit the size of new txns/share
                         break
                     new_transaction_size += this_size
@@ -181,10 +226,10 @@ class BaseShare(object):
         removed_fees = [fee for tx_hash, fee in desired_other_transaction_hashes_and_fees if tx_hash not in included_transactions]
         definite_fees = sum(0 if fee is None else fee for tx_hash, fee in desired_other_transaction_hashes_and_fees if tx_hash in included_transactions)
         if None not in removed_fees:
-            share_data = dict(share_data, subsidy=share_data['subsidy'] - sum(removed_fees))
+            subsidy = subsidy - sum(removed_fees)
         else:
             assert base_subsidy is not None
-            share_data = dict(share_data, subsidy=base_subsidy + definite_fees)
+            subsidy = base_subsidy + definite_fees
         
         weights, total_weight, donation_weight = tracker.get_cumulative_weights(previous_share.share_data['previous_share_hash'] if previous_share is not None else None,
             max(0, min(height, net.REAL_CHAIN_LENGTH) - 1),
@@ -192,15 +237,7 @@ class BaseShare(object):
         )
         assert total_weight == sum(weights.itervalues()) + donation_weight, (total_weight, sum(weights.itervalues()) + donation_weight)
         
-        amounts = dict((script, share_data['subsidy']*(199*weight)//(200*total_weight)) for script, weight in weights.iteritems()) # 99.5% goes according to weights prior to this share
-        this_script = bitcoin_data.pubkey_hash_to_script2(share_data['pubkey_hash'])
-        amounts[this_script] = amounts.get(this_script, 0) + share_data['subsidy']//200 # 0.5% goes to block finder
-        amounts[DONATION_SCRIPT] = amounts.get(DONATION_SCRIPT, 0) + share_data['subsidy'] - sum(amounts.itervalues()) # all that's left over is the donation weight and some extra satoshis due to rounding
-        
-        if sum(amounts.itervalues()) != share_data['subsidy'] or any(x < 0 for x in amounts.itervalues()):
-            raise ValueError()
-        
-        dests = sorted(amounts.iterkeys(), key=lambda script: (script == DONATION_SCRIPT, amounts[script], script))[-4000:] # block length limit, unlikely to ever be hit
+        amounts = dict((script, subsidy*(199*weight)//(200*total_weight)) for script, weight in weights.iteritems()) # 99.5% goes according to weights prior to this share
 
         segwit_activated = is_segwit_activated(cls.VERSION, net)
         if segwit_data is None and known_txs is None:
@@ -210,27 +247,68 @@ class BaseShare(object):
         if segwit_activated and known_txs is not None:
             share_txs = [(known_txs[h], bitcoin_data.get_txid(known_txs[h]), h) for h in other_transaction_hashes]
             segwit_data = dict(txid_merkle_link=bitcoin_data.calculate_merkle_link([None] + [tx[1] for tx in share_txs], 0), wtxid_merkle_root=bitcoin_data.merkle_hash([0] + [bitcoin_data.get_wtxid(tx[0], tx[1], tx[2]) for tx in share_txs]))
+        witness_commitment_hash = None
         if segwit_activated and segwit_data is not None:
-            witness_reserved_value_str = '[P2Pool]'*4
-            witness_reserved_value = pack.IntType(256).unpack(witness_reserved_value_str)
-            witness_commitment_hash = bitcoin_data.get_witness_commitment_hash(segwit_data['wtxid_merkle_root'], witness_reserved_value)
+            witness_commitment_hash = bitcoin_data.get_witness_commitment_hash(segwit_data['wtxid_merkle_root'], pack.IntType(256).unpack(WITNESS_RESERVED_VALUE))
+        
+        template = dict(
+            previous_share_hash=previous_share_hash,
+            subsidy=subsidy,
+            max_target=pre_target3,
+            max_bits=bitcoin_data.FloatingInteger.from_target_upper_bound(pre_target3),
+            new_transaction_hashes=new_transaction_hashes,
+            transaction_hash_refs=transaction_hash_refs,
+            other_transaction_hashes=other_transaction_hashes,
+            amounts=amounts,
+            segwit_activated=segwit_activated,
+            segwit_data=segwit_data,
+            witness_commitment_hash=witness_commitment_hash,
+            far_share_hash=None if last is None and height < 99 else tracker.get_nth_parent_hash(previous_share_hash, 99),
+        )
+        template['packed_share_info'] = cls.get_dynamic_types(net)['share_info_template_type'].pack(template) # transaction_hash_refs alone can be thousands of varints
+        return template
+    
+    @classmethod
+    def generate_transaction(cls, tracker, share_data, block_target, desired_timestamp, desired_target, ref_merkle_link, desired_other_transaction_hashes_and_fees, net, known_txs=None, last_txout_nonce=0, base_subsidy=None, segwit_data=None, template=None):
+        if template is None:
+            template = cls.generate_transaction_template(tracker, share_data['previous_share_hash'], share_data['subsidy'], block_target, desired_other_transaction_hashes_and_fees, net,
+                known_txs=known_txs, base_subsidy=base_subsidy, segwit_data=segwit_data)
+        assert template['previous_share_hash'] == share_data['previous_share_hash']
+        previous_share = tracker.items[share_data['previous_share_hash']].need_contents() if share_data['previous_share_hash'] is not None else None
+        
+        pre_target3 = template['max_target']
+        bits = bitcoin_data.FloatingInteger.from_target_upper_bound(math.clip(desired_target, (pre_target3//30, pre_target3)))
+        other_transaction_hashes = template['other_transaction_hashes']
+        share_data = dict(share_data, subsidy=template['subsidy'])
+        
+        amounts = dict(template['amounts'])
+        this_script = bitcoin_data.pubkey_hash_to_script2(share_data['pubkey_hash'])
+        amounts[this_script] = amounts.get(this_script, 0) + share_data['subsidy']//200 # 0.5% goes to block finder
+        amounts[DONATION_SCRIPT] = amounts.get(DONATION_SCRIPT, 0) + share_data['subsidy'] - sum(amounts.itervalues()) # all that's left over is the donation weight and some extra satoshis due to rounding
+        
+        if sum(amounts.itervalues()) != share_data['subsidy'] or any(x < 0 for x in amounts.itervalues()):
+            raise ValueError()
+        
+        dests = sorted(amounts.iterkeys(), key=lambda script: (script == DONATION_SCRIPT, amounts[script], script))[-4000:] # block length limit, unlikely to ever be hit
+
+        segwit_activated = template['segwit_activated']
 
         share_info = dict(
             share_data=share_data,
-            far_share_hash=None if last is None and height < 99 else tracker.get_nth_parent_hash(share_data['previous_share_hash'], 99),
-            max_bits=max_bits,
+            far_share_hash=template['far_share_hash'],
+            max_bits=template['max_bits'],
             bits=bits,
             timestamp=math.clip(desired_timestamp, (
                 (previous_share.timestamp + net.SHARE_PERIOD) - (net.SHARE_PERIOD - 1), # = previous_share.timestamp + 1
                 (previous_share.timestamp + net.SHARE_PERIOD) + (net.SHARE_PERIOD - 1),
             )) if previous_share is not None else desired_timestamp,
-            new_transaction_hashes=new_transaction_hashes,
-            transaction_hash_refs=transaction_hash_refs,
+            new_transaction_hashes=template['new_transaction_hashes'],
+            transaction_hash_refs=template['transaction_hash_refs'],
             absheight=((previous_share.absheight if previous_share is not None else 0) + 1) % 2**32,
             abswork=((previous_share.abswork if previous_share is not None else 0) + bitcoin_data.target_to_average_attempts(bits.target)) % 2**128,
         )
         if segwit_activated:
-            share_info['segwit_data'] = segwit_data
+            share_info['segwit_data'] = template['segwit_data']
         
         gentx = dict(
             version=1,
@@ -239,17 +317,18 @@ class BaseShare(object):
                 sequence=None,
                 script=share_data['coinbase'],
             )],
-            tx_outs=([dict(value=0, script='\x6a\x24\xaa\x21\xa9\xed' + pack.IntType(256).pack(witness_commitment_hash))] if segwit_activated else []) +
+            tx_outs=([dict(value=0, script='\x6a\x24\xaa\x21\xa9\xed' + pack.IntType(256).pack(template['witness_commitment_hash']))] if segwit_activated else []) +
                 [dict(value=amounts[script], script=script) for script in dests if amounts[script] or script == DONATION_SCRIPT] +
-                [dict(value=0, script='\x6a\x28' + cls.get_ref_hash(net, share_info, ref_merkle_link) + pack.IntType(64).pack(last_txout_nonce))],
+                [dict(value=0, script='\x6a\x28' + cls.get_ref_hash(net, share_info, ref_merkle_link, template['packed_share_info']) + pack.IntType(64).pack(last_txout_nonce))],
             lock_time=0,
         )
         if segwit_activated:
             gentx['marker'] = 0
             gentx['flag'] = 1
-            gentx['witness'] = [[witness_reserved_value_str]]
+            gentx['witness'] = [[WITNESS_RESERVED_VALUE]]
         
-        def get_share(header, last_txout_nonce=last_txout_nonce):
+        def get_share(header, last_txout_nonce=last_txout_nonce, pow_hash=None):
+            # pow_hash is the header's, if the caller already has it
             min_header = dict(header); del min_header['merkle_root']
             share = cls(net, None, dict(
                 min_header=min_header,
@@ -258,33 +337,94 @@ class BaseShare(object):
                 last_txout_nonce=last_txout_nonce,
                 hash_link=prefix_to_hash_link(bitcoin_data.tx_id_type.pack(gentx)[:-32-8-4], cls.gentx_before_refhash),
                 merkle_link=bitcoin_data.calculate_merkle_link([None] + other_transaction_hashes, 0),
-            ))
+            ), check_pow=pow_hash is None)
             assert share.header == header # checks merkle_root
+            if pow_hash is not None:
+                share.set_pow_hash(pow_hash)
             return share
         
         return share_info, gentx, other_transaction_hashes, get_share
     
     @classmethod
-    def get_ref_hash(cls, net, share_info, ref_merkle_link):
-        return pack.IntType(256).pack(bitcoin_data.check_merkle_link(bitcoin_data.hash256(cls.get_dynamic_types(net)['ref_type'].pack(dict(
-            identifier=net.IDENTIFIER,
-            share_info=share_info,
-        ))), ref_merkle_link))
+    def get_ref_hash(cls, net, share_info, ref_merkle_link, packed_template=None):
+        t = cls.get_dynamic_types(net)
+        if packed_template is None:
+            packed_ref = t['ref_type'].pack(dict(
+                identifier=net.IDENTIFIER,
+                share_info=share_info,
+            ))
+        else: # the same as packing ref_type, with the fields from generate_transaction_template already packed
+            packed_ref = net.IDENTIFIER + t['share_data_type'].pack(share_info['share_data']) + packed_template + t['share_info_tail_type'].pack(share_info)
+        return pack.IntType(256).pack(bitcoin_data.check_merkle_link(bitcoin_data.hash256(packed_ref), ref_merkle_link))
     
-    __slots__ = 'net peer_addr contents min_header share_info hash_link merkle_link hash share_data max_target target timestamp previous_hash new_script desired_version gentx_hash header pow_hash header_hash new_transaction_hashes time_seen absheight abswork'.split(' ')
+    __slots__ = 'net peer_addr min_header share_info ref_merkle_link last_txout_nonce hash_link merkle_link hash share_data max_target target timestamp previous_hash new_script desired_version gentx_hash merkle_root _pow_hash header_hash new_transaction_hashes time_seen absheight abswork _packed_contents _payee'.split(' ')
     
-    def __init__(self, net, peer_addr, contents):
-        dynamic_types = self.get_dynamic_types(net)
-        self.share_info_type = dynamic_types['share_info_type']
-        self.share_type = dynamic_types['share_type']
-        self.ref_type = dynamic_types['ref_type']
-
+    # rebuilt when needed instead of being stored with every share
+    contents = property(lambda self: dict(min_header=self.min_header, share_info=self.share_info, ref_merkle_link=self.ref_merkle_link,
+        last_txout_nonce=self.last_txout_nonce, hash_link=self.hash_link, merkle_link=self.merkle_link))
+    header = property(lambda self: dict(self.min_header, merkle_root=self.merkle_root))
+    materialized = property(lambda self: self._packed_contents is None)
+    
+    @classmethod
+    def from_header(cls, net, header):
+        '''makes a share that only has the fields of a share_header_record_type record set until materialize is
+        called. its PoW was checked before it was stored, so pow_hash is only calculated if it is used'''
+        self = cls.__new__(cls)
+        self.net = net
+        self.peer_addr = None
+        self.hash = header['hash']
+        self.previous_hash = header['previous_hash']
+        self.target = header['target']
+        self.max_target = header['max_target']
+        self.timestamp = header['timestamp']
+        self.time_seen = time.time()
+        self._packed_contents = header['share']['contents']
+        self._pow_hash = None
+        return self
+    
+    def __init__(self, net, peer_addr, contents, check_pow=True):
+        self._packed_contents = None
+        self._pow_hash = None
+        self._load(net, peer_addr, contents)
+        if check_pow:
+            self._check_pow()
+        
+        # XXX eww
+        self.time_seen = time.time()
+    
+    def materialize(self):
+        '''decodes the contents of a share made by from_header. returns False, leaving the share as it was, if they
+        can't be decoded or don't match the header it was made from'''
+        if self._packed_contents is None:
+            return True
+        try:
+            share = type(self)(self.net, self.peer_addr, self.get_dynamic_types(self.net)['share_type'].unpack(self._packed_contents), check_pow=False)
+        except Exception:
+            log.err(None, 'HARMLESS error while decoding stored share %s:' % (format_hash(self.hash),))
+            return False
+        if (share.hash, share.previous_hash, share.target, share.max_target, share.timestamp) != (self.hash, self.previous_hash, self.target, self.max_target, self.timestamp):
+            return False
+        for name in BaseShare.__slots__:
+            if name not in ['time_seen', '_packed_contents', '_pow_hash']:
+                setattr(self, name, getattr(share, name))
+        self._packed_contents = None
+        return True
+    
+    def need_contents(self):
+        '''materializes the share if it wasn't yet and returns it. for code that reads the contents of shares that
+        Node.materialize_shares might not have got to. raises ValueError if the record turns out to be bad'''
+        if not self.materialize():
+            raise ValueError('share contents do not match stored header')
+        return self
+    
+    def _load(self, net, peer_addr, contents):
         self.net = net
         self.peer_addr = peer_addr
-        self.contents = contents
         
         self.min_header = contents['min_header']
         self.share_info = contents['share_info']
+        self.ref_merkle_link = contents['ref_merkle_link']
+        self.last_txout_nonce = contents['last_txout_nonce']
         self.hash_link = contents['hash_link']
         self.merkle_link = contents['merkle_link']
         
@@ -303,7 +443,8 @@ class BaseShare(object):
         self.target = self.share_info['bits'].target
         self.timestamp = self.share_info['timestamp']
         self.previous_hash = self.share_data['previous_share_hash']
-        self.new_script = bitcoin_data.pubkey_hash_to_script2(self.share_data['pubkey_hash'])
+        self._payee = _get_payee(self.share_data['pubkey_hash'])
+        self.share_data['pubkey_hash'], self.new_script = self._payee.pubkey_hash, self._payee.script
         self.desired_version = self.share_data['desired_version']
         self.absheight = self.share_info['absheight']
         self.abswork = self.share_info['abswork']
@@ -317,41 +458,53 @@ class BaseShare(object):
         
         self.gentx_hash = check_hash_link(
             self.hash_link,
-            self.get_ref_hash(net, self.share_info, contents['ref_merkle_link']) + pack.IntType(64).pack(self.contents['last_txout_nonce']) + pack.IntType(32).pack(0),
+            self.get_ref_hash(net, self.share_info, self.ref_merkle_link) + pack.IntType(64).pack(self.last_txout_nonce) + pack.IntType(32).pack(0),
             self.gentx_before_refhash,
         )
-        merkle_root = bitcoin_data.check_merkle_link(self.gentx_hash, self.share_info['segwit_data']['txid_merkle_link'] if segwit_activated else self.merkle_link)
-        self.header = dict(self.min_header, merkle_root=merkle_root)
-        self.pow_hash = net.PARENT.POW_FUNC(bitcoin_data.block_header_type.pack(self.header))
+        self.merkle_root = bitcoin_data.check_merkle_link(self.gentx_hash, self.share_info['segwit_data']['txid_merkle_link'] if segwit_activated else self.merkle_link)
         self.hash = self.header_hash = bitcoin_data.hash256(bitcoin_data.block_header_type.pack(self.header))
         
         if self.target > net.MAX_TARGET:
             from p2pool import p2p
             raise p2p.PeerMisbehavingError('share target invalid')
         
-        if self.pow_hash > self.target:
+        self.new_transaction_hashes = self.share_info['new_transaction_hashes']
+    
+    def _check_pow(self):
+        self.set_pow_hash(self.net.PARENT.POW_FUNC(bitcoin_data.block_header_type.pack(self.header)))
+    
+    def set_pow_hash(self, pow_hash):
+        self._pow_hash = pow_hash
+        if self._pow_hash > self.target:
             from p2pool import p2p
             raise p2p.PeerMisbehavingError('share PoW invalid')
-        
-        self.new_transaction_hashes = self.share_info['new_transaction_hashes']
-        
-        # XXX eww
-        self.time_seen = time.time()
+    
+    @property
+    def pow_hash(self):
+        if self._pow_hash is None: # only for shares made by from_header, whose PoW was checked before
+            self._pow_hash = self.net.PARENT.POW_FUNC(bitcoin_data.block_header_type.pack(self.need_contents().header))
+        return self._pow_hash
     
     def __repr__(self):
         return 'Share' + repr((self.net, self.peer_addr, self.contents))
     
     def as_share(self):
+        if self._packed_contents is not None:
+            return dict(type=self.VERSION, contents=self._packed_contents)
         return dict(type=self.VERSION, contents=self.share_type.pack(self.contents))
     
+    def as_share_header(self):
+        return dict(hash=self.hash, previous_hash=self.previous_hash, target=self.target, max_target=self.max_target, timestamp=self.timestamp, share=self.as_share())
+    
     def iter_transaction_hash_refs(self):
         return zip(self.share_info['transaction_hash_refs'][::2], self.share_info['transaction_hash_refs'][1::2])
     
     def check(self, tracker, other_txs=None):
         from p2pool import p2p
+        self.need_contents()
         counts = None
         if self.share_data['previous_share_hash'] is not None:
-            previous_share = tracker.items[self.share_data['previous_share_hash']]
+            previous_share = tracker.items[self.share_data['previous_share_hash']].need_contents()
             if tracker.get_height(self.share_data['previous_share_hash']) >= self.net.CHAIN_LENGTH:
                 counts = get_desired_version_counts(tracker, tracker.get_nth_parent_hash(previous_share.hash, self.net.CHAIN_LENGTH*9//10), self.net.CHAIN_LENGTH//10)
                 if type(self) is type(previous_share):
@@ -365,11 +518,11 @@ class BaseShare(object):
             elif type(self) is type(previous_share).SUCCESSOR:
                 raise p2p.PeerMisbehavingError('switch without enough history')
         
-        other_tx_hashes = [tracker.items[tracker.get_nth_parent_hash(self.hash, share_count)].share_info['new_transaction_hashes'][tx_count] for share_count, tx_count in self.iter_transaction_hash_refs()]
-        if other_txs is not None and not isinstance(other_txs, dict): other_txs = dict((bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx)), tx) for tx in other_txs)
+        other_tx_hashes = [tracker.items[tracker.get_nth_parent_hash(self.hash, share_count)].need_contents().share_info['new_transaction_hashes'][tx_count] for share_count, tx_count in self.iter_transaction_hash_refs()]
+        if other_txs is not None and not isinstance(other_txs, dict): other_txs = dict((bitcoin_data.get_tx_hash(tx), tx) for tx in other_txs)
         
-        share_info, gentx, other_tx_hashes2, get_share = self.generate_transaction(tracker, self.share_info['share_data'], self.header['bits'].target, self.share_info['timestamp'], self.share_info['bits'].target, self.contents['ref_merkle_link'], [(h, None) for h in other_tx_hashes], self.net,
-            known_txs=other_txs, last_txout_nonce=self.contents['last_txout_nonce'], segwit_data=self.share_info.get('segwit_data', None))
+        share_info, gentx, other_tx_hashes2, get_share = self.generate_transaction(tracker, self.share_info['share_data'], self.header['bits'].target, self.share_info['timestamp'], self.share_info['bits'].target, self.ref_merkle_link, [(h, None) for h in other_tx_hashes], self.net,
+            known_txs=other_txs, last_txout_nonce=self.last_txout_nonce, segwit_data=self.share_info.get('segwit_data', None))
         
         assert other_tx_hashes2 == other_tx_hashes
         if share_info != self.share_info:
@@ -389,7 +542,7 @@ class BaseShare(object):
         if parents < parents_needed:
             return None
         last_shares = list(tracker.get_chain(self.hash, parents_needed + 1))
-        return [last_shares[share_count].share_info['new_transaction_hashes'][tx_count] for share_count, tx_count in self.iter_transaction_hash_refs()]
+        return [last_shares[share_count].need_contents().share_info['new_transaction_hashes'][tx_count] for share_count, tx_count in self.iter_transaction_hash_refs()]
     
     def _get_other_txs(self, tracker, known_txs):
         other_tx_hashes = self.get_other_tx_hashes(tracker)
@@ -402,6 +555,7 @@ class BaseShare(object):
         return [known_txs[tx_hash] for tx_hash in other_tx_hashes]
     
     def should_punish_reason(self, previous_block, bits, tracker, known_txs):
+        self.need_contents()
         if (self.header['previous_block'], self.header['bits']) != (previous_block, bits) and self.header_hash != previous_block and self.peer_addr is not None:
             return True, 'Block-stale detected! height(%x) < height(%x) or %08x != %08x' % (self.header['previous_block'], previous_block, self.header['bits'].bits, bits.bits)
         
@@ -412,12 +566,12 @@ class BaseShare(object):
         if other_txs is None:
             pass
         else:
-            all_txs_size = sum(bitcoin_data.tx_type.packed_size(tx) for tx in other_txs)
-            stripped_txs_size = sum(bitcoin_data.tx_id_type.packed_size(tx) for tx in other_txs)
+            all_txs_size = sum(bitcoin_data.get_tx_size(tx) for tx in other_txs)
+            stripped_txs_size = sum(bitcoin_data.get_stripped_tx_size(tx) for tx in other_txs)
             if all_txs_size + 3 * stripped_txs_size > self.MAX_BLOCK_WEIGHT:
                 return True, 'txs over block size limit'
             
-            new_txs_size = sum(bitcoin_data.tx_type.packed_size(known_txs[tx_hash]) for tx_hash in self.share_info['new_transaction_hashes'])
+            new_txs_size = sum(bitcoin_data.get_tx_size(known_txs[tx_hash]) for tx_hash in self.share_info['new_transaction_hashes'])
             if new_txs_size > self.MAX_NEW_TXS_SIZE:
                 return True, 'new txs over limit'
         
@@ -430,12 +584,16 @@ class BaseShare(object):
         return dict(header=self.header, txs=[self.check(tracker, other_txs)] + other_txs)
 
 class NewShare(BaseShare):
+    __slots__ = []
+    
     VERSION = 17
     VOTING_VERSION = 17
     SUCCESSOR = None
     MAX_NEW_TXS_SIZE = 100000
 
 class Share(BaseShare):
+    __slots__ = []
+    
     VERSION = 16
     VOTING_VERSION = 16
     SUCCESSOR = NewShare
@@ -446,7 +604,7 @@ class WeightsSkipList(forest.TrackerSkipList):
     
     def get_delta(self, element):
         from p2pool.bitcoin import data as bitcoin_data
-        share = self.tracker.items[element]
+        share = self.tracker.items[element].need_contents()
         att = bitcoin_data.target_to_average_attempts(share.target)
         return 1, {share.new_script: att*(65535-share.share_data['donation'])}, att*65535, att*share.share_data['donation']
     
@@ -478,6 +636,324 @@ class WeightsSkipList(forest.TrackerSkipList):
         assert share_count == max_shares or total_weight == desired_weight
         return math.add_dicts(*math.flatten_linked_list(weights_list)), total_weight, total_donation_weight
 
+class WeightsWindow(object):
+    '''
+    the shares get_cumulative_weights(head, max_shares, desired_weight) counts
+    in full, with their summed weights. the share after them, if there is room
+    left, only partly fits and is scaled down like WeightsSkipList.apply_delta does
+    '''
+    
+    def __init__(self, tracker, head, max_shares, desired_weight):
+        self.tracker = tracker
+        self.head = head
+        self.max_shares = max_shares
+        self.desired_weight = desired_weight
+        self.args = max_shares, desired_weight
+        
+        self.share_count = 0
+        self.end = head # hash of the share after the ones counted in full
+        self.weights = {} # script -> weight
+        self.total_weight = 0
+        self.total_donation_weight = 0
+        
+        self._fit()
+    
+    def _get_share_weights(self, share_hash):
+        share = self.tracker.items[share_hash].need_contents()
+        att = bitcoin_data.target_to_average_attempts(share.target)
+        return share.new_script, att*(65535-share.share_data['donation']), att*65535, att*share.share_data['donation'], share.previous_hash
+    
+    def _add(self, (script, weight, total_weight, donation_weight, previous_hash), sign):
+        self.weights[script] = self.weights.get(script, 0) + sign*weight
+        if not self.weights[script]:
+            del self.weights[script]
+        self.share_count += sign
+        self.total_weight += sign*total_weight
+        self.total_donation_weight += sign*donation_weight
+    
+    def _fit(self):
+        # drop shares off the end until the limits are met, then take in more while they fit
+        while self.share_count > self.max_shares or self.total_weight > self.desired_weight:
+            self.end = self.tracker.get_nth_parent_hash(self.head, self.share_count - 1)
+            self._add(self._get_share_weights(self.end), -1)
+        while self.share_count < self.max_shares and self.total_weight < self.desired_weight:
+            x = self._get_share_weights(self.end)
+            if self.total_weight + x[2] > self.desired_weight:
+                break
+            self._add(x, 1)
+            self.end = x[4]
+        self.result = self._get_result()
+    
+    def _get_result(self):
+        weights = dict(self.weights)
+        total_weight, total_donation_weight = self.total_weight, self.total_donation_weight
+        if self.share_count < self.max_shares and total_weight < self.desired_weight:
+            script, weight, share_total_weight, donation_weight, previous_hash = self._get_share_weights(self.end)
+            assert (self.desired_weight - total_weight) % 65535 == 0
+            weight = (self.desired_weight - total_weight)//65535*weight//(share_total_weight//65535)
+            if weight:
+                weights[script] = weights.get(script, 0) + weight
+            total_donation_weight += (self.desired_weight - total_weight)//65535*donation_weight//(share_total_weight//65535)
+            total_weight = self.desired_weight
+        return weights, total_weight, total_donation_weight
+    
+    def moved(self, path, max_shares, desired_weight):
+        # returns the window for path[0] with the given limits. path goes from path[0] down to a child of head
+        res = WeightsWindow.__new__(WeightsWindow)
+        res.__dict__.update(self.__dict__)
+        res.weights = dict(self.weights)
+        res.max_shares = max_shares
+        res.desired_weight = desired_weight
+        res.args = max_shares, desired_weight
+        
+        for share_hash in reversed(path):
+            x = res._get_share_weights(share_hash)
+            assert x[4] == res.head
+            res.head = share_hash
+            res._add(x, 1)
+        res._fit()
+        return res
+
+class ChainWindows(object):
+    '''
+    windows over the chain below a share, made by window_type(tracker, head,
+    *args) and having head and args attributes. the windows of the last few
+    queries are kept, and a query starting at or a few shares above one of them
+    gets it moved with window.moved(path, *args) instead of walking the chain
+    '''
+    
+    MAX_WINDOWS = 10
+    MAX_ADVANCE = 100
+    
+    def __init__(self, tracker, window_type):
+        self.tracker = tracker
+        self.window_type = window_type
+        self.windows = [] # least recently used first
+        
+        self.tracker.removed.watch_weakref(self, lambda self, items: self._handle_removed(items))
+    
+    def _handle_removed(self, items):
+        item_hashes = set(item.hash for item in items)
+        self.windows = [window for window in self.windows if window.head not in item_hashes]
+    
+    def get_window(self, start, *args):
+        for window in reversed(self.windows):
+            if (window.head, window.args) == (start, args):
+                self.windows.remove(window)
+                self.windows.append(window)
+                return window
+        
+        heads = dict((window.head, window) for window in self.windows) # most recently used wins
+        path = [] # shares between start and the window's head, start first
+        share_hash = start
+        while share_hash not in heads:
+            if len(path) == self.MAX_ADVANCE or share_hash not in self.tracker.items:
+                window = self.window_type(self.tracker, start, *args)
+                break
+            path.append(share_hash)
+            share_hash = self.tracker.items[share_hash].previous_hash
+        else:
+            try:
+                window = heads[share_hash].moved(path, *args)
+            except KeyError: # shares it would have dropped are already gone from the tracker
+                window = self.window_type(self.tracker, start, *args)
+        
+        self.windows.append(window)
+        del self.windows[:-self.MAX_WINDOWS]
+        return window
+
+class CumulativeWeights(ChainWindows):
+    '''
+    get_cumulative_weights, giving the same results as WeightsSkipList, from
+    WeightsWindows
+    '''
+    
+    def __init__(self, tracker):
+        ChainWindows.__init__(self, tracker, WeightsWindow)
+    
+    def __call__(self, start, max_shares, desired_weight):
+        assert desired_weight % 65535 == 0, divmod(desired_weight, 65535)
+        return self.get_window(start, max_shares, desired_weight).result
+
+class TransactionRefsWindow(object):
+    '''
+    where the transactions that the last max_shares shares up to and including
+    head introduced are, the way generate_transaction refers to them: the most
+    recent share wins, and the first position within it. shares are identified
+    by positions that count down from head's, so moving the window up doesn't
+    change the existing entries
+    '''
+    
+    def __init__(self, tracker, head, max_shares):
+        self.tracker = tracker
+        self.head = head
+        self.max_shares = max_shares
+        self.args = (max_shares,)
+        
+        self.share_count = 0
+        self.end = head # hash of the share after the ones in the window
+        self.top = 0 # position of head. shares below it have positions counting down from it
+        self.refs = {} # tx hash -> (position of the share that introduced it, index in its new_transaction_hashes)
+        
+        self._fit()
+    
+    def _fit(self):
+        # drop shares off the end until there are max_shares, then take in more until there are
+        while self.share_count > self.max_shares:
+            self.end = self.tracker.get_nth_parent_hash(self.head, self.share_count - 1)
+            position = self.top - self.share_count + 1
+            for tx_hash in self.tracker.items[self.end].need_contents().new_transaction_hashes:
+                if tx_hash in self.refs and self.refs[tx_hash][0] == position:
+                    del self.refs[tx_hash]
+            self.share_count -= 1
+        while self.share_count < self.max_shares:
+            share = self.tracker.items[self.end].need_contents()
+            position = self.top - self.share_count
+            for i, tx_hash in enumerate(share.new_transaction_hashes):
+                if tx_hash not in self.refs:
+                    self.refs[tx_hash] = position, i
+            self.share_count += 1
+            self.end = share.previous_hash
+    
+    def moved(self, path, max_shares):
+        # returns the window for path[0] with the given limit. path goes from path[0] down to a child of head
+        res = TransactionRefsWindow.__new__(TransactionRefsWindow)
+        res.__dict__.update(self.__dict__)
+        res.refs = dict(self.refs)
+        res.max_shares = max_shares
+        res.args = (max_shares,)
+        
+        for share_hash in reversed(path):
+            share = res.tracker.items[share_hash].need_contents()
+            assert share.previous_hash == res.head
+            res.head = share_hash
+            res.top += 1
+            res.share_count += 1
+            for i, tx_hash in reversed(list(enumerate(share.new_transaction_hashes))):
+                res.refs[tx_hash] = res.top, i
+        res._fit()
+        return res
+
+class RecentTransactionRefs(ChainWindows):
+    '''
+    get_transaction_refs(head, max_shares), the TransactionRefsWindow that
+    generate_transaction looks the transactions it includes up in. a
+    transaction's share_count is window.top - position + 1
+    '''
+    
+    def __init__(self, tracker):
+        ChainWindows.__init__(self, tracker, TransactionRefsWindow)
+    
+    def __call__(self, start, max_shares):
+        return self.get_window(start, max_shares)
+
+class BestChain(object):
+    '''
+    the last max_length shares of the best chain kept as columns, oldest first,
+    so that questions about the recent chain are answered by slicing instead of
+    following previous_hash through tracker.items. set_head is called with each
+    new best share and rewinds to the fork point on a reorg
+    '''
+    
+    STALE_INFO_CODES = {None: 0, 'orphan': 253, 'doa': 254} # same as in share_info_type
+    
+    assert array.array('I').itemsize >= 4 # 'L' would be 8 bytes on most 64-bit platforms, but 4 on Windows anyway
+    
+    def __init__(self, tracker, max_length):
+        self.tracker = tracker
+        self.max_length = max_length
+        self._clear()
+    
+    def _clear(self):
+        self.hashes = []
+        self.timestamps = array.array('I') # share timestamps are 32 bits
+        self.works = [] # attempts don't always fit in an array
+        self.stale_infos = array.array('B') # stale_info is 8 bits
+        self.pubkey_hash_ids = array.array('I') # < 2*max_length
+        self.desired_versions = [] # a varint, so it doesn't always fit either
+        self.pubkey_hashes = [] # pubkey_hash_id -> pubkey_hash
+        self._pubkey_hash_ids = {}
+        self._positions = {} # share hash -> index + self._offset
+        self._offset = 0
+    
+    def _get_columns(self):
+        return [self.hashes, self.timestamps, self.works, self.stale_infos, self.pubkey_hash_ids, self.desired_versions]
+    
+    def _get_pubkey_hash_id(self, pubkey_hash):
+        if pubkey_hash not in self._pubkey_hash_ids:
+            self._pubkey_hash_ids[pubkey_hash] = len(self.pubkey_hashes)
+            self.pubkey_hashes.append(pubkey_hash)
+        return self._pubkey_hash_ids[pubkey_hash]
+    
+    def _get_row(self, share):
+        stale_info = share.need_contents().share_data['stale_info']
+        return (
+            share.hash,
+            share.timestamp,
+            bitcoin_data.target_to_average_attempts(share.target),
+            self.STALE_INFO_CODES[stale_info] if stale_info in self.STALE_INFO_CODES else int(stale_info[len('unk'):]),
+            self._get_pubkey_hash_id(share.share_data['pubkey_hash']),
+            share.desired_version,
+        )
+    
+    def _append(self, shares):
+        for share in shares:
+            self._positions[share.hash] = len(self.hashes) + self._offset
+            for column, value in zip(self._get_columns(), self._get_row(share)):
+                column.append(value)
+    
+    def _prepend(self, shares):
+        rows = zip(*[self._get_row(share) for share in shares])
+        for column, values in zip(self._get_columns(), rows):
+            column[:0] = list(values) if isinstance(column, list) else array.array(column.typecode, values)
+        self._offset -= len(shares)
+        for i, share in enumerate(shares):
+            self._positions[share.hash] = i + self._offset
+    
+    def _truncate(self, length):
+        for share_hash in self.hashes[length:]:
+            del self._positions[share_hash]
+        for column in self._get_columns():
+            del column[length:]
+    
+    def _drop(self, n):
+        for share_hash in self.hashes[:n]:
+            del self._positions[share_hash]
+        for column in self._get_columns():
+            del column[:n]
+        self._offset += n
+    
+    def set_head(self, head_hash):
+        new_shares = [] # newest first
+        share_hash = head_hash
+        while share_hash not in self._positions and share_hash in self.tracker.items and len(new_shares) < self.max_length:
+            new_shares.append(self.tracker.items[share_hash])
+            share_hash = new_shares[-1].previous_hash
+        if share_hash in self._positions:
+            self._truncate(self._positions[share_hash] - self._offset + 1)
+        else:
+            self._clear()
+        self._append(reversed(new_shares))
+        if len(self.hashes) > 2*self.max_length:
+            self._drop(len(self.hashes) - self.max_length)
+    
+    def get_slice(self, length):
+        '''
+        slice of the columns covering the last length shares of the best chain.
+        the window is extended backwards first if parents of its oldest share
+        have been downloaded since
+        '''
+        if length > len(self.hashes):
+            shares = []
+            share = self.tracker.items.get(self.hashes[0]) if self.hashes else None
+            while share is not None and len(self.hashes) + len(shares) < length:
+                share = self.tracker.items.get(share.previous_hash)
+                if share is not None:
+                    shares.append(share)
+            self._prepend(shares[::-1])
+        assert length <= len(self.hashes)
+        return slice(len(self.hashes) - length, len(self.hashes))
+
 class OkayTracker(forest.Tracker):
     def __init__(self, net):
         forest.Tracker.__init__(self, delta_type=forest.get_attributedelta_type(dict(forest.AttributeDelta.attrs,
@@ -488,7 +964,66 @@ class OkayTracker(forest.Tracker):
         self.verified = forest.SubsetTracker(delta_type=forest.get_attributedelta_type(dict(forest.AttributeDelta.attrs,
             work=lambda share: bitcoin_data.target_to_average_attempts(share.target),
         )), subset_of=self)
-        self.get_cumulative_weights = WeightsSkipList(self)
+        self.get_cumulative_weights = CumulativeWeights(self)
+        self.get_transaction_refs = RecentTransactionRefs(self)
+        # only evaluated along chains that statistics are asked about, see get_chain_stats
+        self.stats_view = forest.TrackerView(self, forest.get_attributedelta_type(dict(forest.AttributeDelta.attrs,
+            work=lambda share: bitcoin_data.target_to_average_attempts(share.target),
+            stale_count=lambda share: 1 if share.need_contents().share_data['stale_info'] is not None else 0,
+            stale_work=lambda share: math.SumDict({share.share_data['stale_info']: bitcoin_data.target_to_average_attempts(share.target)} if share.need_contents().share_data['stale_info'] is not None else {}),
+            desired_version_work=lambda share: math.SumDict({share.need_contents().desired_version: bitcoin_data.target_to_average_attempts(share.target)}),
+        )))
+        
+        self.unverified_heads = set() # == set(self.heads) - set(self.verified.heads)
+        self._changed_heads = set() # hashes of heads that think needs to look at again
+        self._unverified_head_desired = {} # unverified head hash -> (last, timestamp, target) of the parents it needs
+        self._tail_scores = {} # verified tail hash -> ((best head, its verified height, previous block), score)
+        self._head_times = None # heap of (time_seen, hash) holding every head, and hashes that stopped being heads. made by eat_heads
+        self._head_heights = {} # head hash -> height, for the heads drop_tails has looked at
+        self.max_checks = None # most shares think checks per call, None for no limit
+        self.verify_backlog = 0 # heads and shares the last think call left unchecked because of max_checks
+        self._verify_queue = [] # hashes verify_shares was given that think hasn't got to yet, parents first
+        self.added.watch(self._handle_added)
+        self.removed.watch(self._handle_removed)
+        self.verified.added.watch(self._update_unverified_heads)
+        self.verified.removed.watch(lambda shares: [self._update_unverified_heads(share) for share in shares])
+    
+    def _handle_added(self, share):
+        self._changed_heads.update(self.tails.get(self.get_last(share.hash), ())) # the chains of these might have gotten longer
+        self._update_unverified_heads(share)
+        if self._head_times is not None and share.hash in self.heads:
+            heapq.heappush(self._head_times, (share.time_seen, share.hash))
+        self._head_heights.pop(share.previous_hash, None)
+        if share.hash in self.reverse: # added below other shares, so their heads' heights changed
+            self._head_heights.clear()
+    
+    def _handle_removed(self, shares):
+        # called once the whole batch is gone, so tails has the heads above a removed share only if it was the last
+        # one removed below them
+        removed = dict((share.hash, share) for share in shares)
+        for share in shares:
+            self._changed_heads.update(self.tails.get(share.hash, ()))
+            self._update_unverified_heads(share)
+            self._head_heights.pop(share.hash, None)
+            if share.hash in self.tails: # share was the bottom of these heads' chains, along with the removed ones below it
+                dropped, share_hash = 0, share.hash
+                while share_hash in removed:
+                    dropped, share_hash = dropped + 1, removed[share_hash].previous_hash
+                for head_hash in self.tails[share.hash]:
+                    if head_hash in self._head_heights:
+                        self._head_heights[head_hash] -= dropped
+            if self._head_times is not None and share.previous_hash in self.heads:
+                heapq.heappush(self._head_times, (self.items[share.previous_hash].time_seen, share.previous_hash))
+    
+    def _update_unverified_heads(self, share):
+        for share_hash in [share.hash, share.previous_hash]:
+            if share_hash in self.heads and share_hash not in self.verified.heads:
+                if share_hash not in self.unverified_heads:
+                    self.unverified_heads.add(share_hash)
+                    self._changed_heads.add(share_hash)
+            elif share_hash in self.unverified_heads:
+                self.unverified_heads.remove(share_hash)
+                self._unverified_head_desired.pop(share_hash, None)
     
     def attempt_verify(self, share):
         if share.hash in self.verified.items:
@@ -505,31 +1040,74 @@ class OkayTracker(forest.Tracker):
             self.verified.add(share)
             return True
     
+    def verify_shares(self, share_hashes):
+        '''has think attempt_verify these shares too, given parents first, within max_checks like the others. ones
+        without enough history for check and ones whose parent could have been verified but wasn't are skipped'''
+        self._verify_queue.extend(share_hashes)
+    
+    def _verify_queued(self, checks):
+        # goes through verify_shares' queue until that many checks were made, None for no limit
+        i = 0
+        while i < len(self._verify_queue) and checks != 0:
+            share_hash = self._verify_queue[i]
+            i += 1
+            if share_hash not in self.items or share_hash in self.verified.items:
+                continue
+            share = self.items[share_hash]
+            height, last = self.get_height_and_last(share_hash)
+            if height < self.net.CHAIN_LENGTH + 1 and last is not None:
+                continue
+            if share.previous_hash in self.items and share.previous_hash not in self.verified.items and (height - 1 >= self.net.CHAIN_LENGTH + 1 or last is None):
+                continue # built on a share that failed
+            self.attempt_verify(share)
+            if checks is not None:
+                checks -= 1
+        del self._verify_queue[:i]
+    
     def think(self, block_rel_height_func, previous_block, bits, known_txs):
         desired = set()
         bad_peer_addresses = set()
         
-        # O(len(self.heads))
-        #   make 'unverified heads' set?
-        # for each overall head, attempt verification
+        # for each overall head whose chain changed since the last call, attempt verification
         # if it fails, attempt on parent, and repeat
         # if no successful verification because of lack of parents, request parent
+        # heads that didn't change can only still be waiting for parents, so their requests are kept
+        # with max_checks set, whatever doesn't fit here and below is left in verify_backlog for the following calls
+        self.verify_backlog = 0
+        checks_left = self.max_checks
         bads = []
-        for head in set(self.heads) - set(self.verified.heads):
+        changed_heads, self._changed_heads = self._changed_heads, set()
+        for head in changed_heads:
+            if head not in self.unverified_heads:
+                self._unverified_head_desired.pop(head, None)
+                continue
+            if checks_left == 0:
+                self._changed_heads.add(head)
+                self.verify_backlog += 1
+                continue
+            self._unverified_head_desired.pop(head, None)
             head_height, last = self.get_height_and_last(head)
             
             for share in self.get_chain(head, head_height if last is None else min(5, max(0, head_height - self.net.CHAIN_LENGTH))):
+                if checks_left is not None:
+                    checks_left = max(0, checks_left - 1) # a head is checked until it's done, so this can go over a little
                 if self.attempt_verify(share):
                     break
                 bads.append(share.hash)
             else:
-                if last is not None:
-                    desired.add((
-                        self.items[random.choice(list(self.reverse[last]))].peer_addr,
+                if last is not None and head in self.unverified_heads:
+                    self._unverified_head_desired[head] = (
                         last,
                         max(x.timestamp for x in self.get_chain(head, min(head_height, 5))),
                         min(x.target for x in self.get_chain(head, min(head_height, 5))),
-                    ))
+                    )
+        for last, timestamp, target in self._unverified_head_desired.itervalues():
+            desired.add((
+                self.items[random.choice(list(self.reverse[last]))].peer_addr,
+                last,
+                timestamp,
+                target,
+            ))
         for bad in bads:
             assert bad not in self.verified.items
             #assert bad in self.heads
@@ -551,6 +1129,10 @@ class OkayTracker(forest.Tracker):
             want = max(self.net.CHAIN_LENGTH - head_height, 0)
             can = max(last_height - 1 - self.net.CHAIN_LENGTH, 0) if last_last_hash is not None else last_height
             get = min(want, can)
+            if checks_left is not None:
+                self.verify_backlog += max(0, get - checks_left)
+                get = min(get, checks_left)
+                checks_left -= get
             #print 'Z', head_height, last_hash is None, last_height, last_last_hash is None, want, can, get
             for share in self.get_chain(last_hash, get):
                 if not self.attempt_verify(share):
@@ -563,8 +1145,21 @@ class OkayTracker(forest.Tracker):
                     min(x.target for x in self.get_chain(head, min(head_height, 5))),
                 ))
         
+        # then the shares verify_shares was given, like imported ones
+        self._verify_queued(checks_left)
+        self.verify_backlog += len(self._verify_queue)
+        
         # decide best tree
-        decorated_tails = sorted((self.score(max(self.verified.tails[tail_hash], key=self.verified.get_work), block_rel_height_func), tail_hash) for tail_hash in self.verified.tails)
+        tail_scores = {}
+        for tail_hash in self.verified.tails:
+            head = max(self.verified.tails[tail_hash], key=self.verified.get_work)
+            key = head, self.verified.get_height(head), previous_block # a new block changes block_rel_height_func's results
+            if tail_hash in self._tail_scores and self._tail_scores[tail_hash][0] == key:
+                tail_scores[tail_hash] = self._tail_scores[tail_hash]
+            else:
+                tail_scores[tail_hash] = key, self.score(head, block_rel_height_func)
+        self._tail_scores = tail_scores
+        decorated_tails = sorted((score, tail_hash) for tail_hash, (key, score) in tail_scores.iteritems())
         if p2pool.DEBUG:
             print len(decorated_tails), 'tails:'
             for score, tail_hash in decorated_tails:
@@ -604,6 +1199,92 @@ class OkayTracker(forest.Tracker):
         
         return best, [(peer_addr, hash) for peer_addr, hash, ts, targ in desired if ts >= timestamp_cutoff], decorated_heads, bad_peer_addresses
     
+    def materialize_shares(self, share_hashes):
+        '''materializes the shares among share_hashes that were made by from_header. ones whose records turn out to be
+        bad are removed along with the shares built on them. returns the removed hashes'''
+        removed = []
+        for share_hash in share_hashes:
+            if share_hash not in self.items or self.items[share_hash].materialize():
+                continue
+            descendants = [share_hash]
+            for descendant_hash in descendants: # grows while being iterated over
+                descendants.extend(self.reverse.get(descendant_hash, ()))
+            self._remove_shares(descendants[::-1]) # heads first
+            removed.extend(descendants)
+        return removed
+    
+    def _remove_shares(self, share_hashes):
+        # share_hashes in an order remove_many can take them in. verified goes first, as it's a subset
+        self.verified.remove_many([share_hash for share_hash in share_hashes if share_hash in self.verified.items])
+        self.remove_many(share_hashes)
+    
+    def eat_heads(self, keep_hashes, now):
+        '''
+        removes heads first seen more than 5 minutes before now, along with
+        the heads that uncovers, except for the heads in keep_hashes and
+        unverified ones with a share at the bottom of their chain seen in the
+        last 2 minutes. returns the removed hashes
+        '''
+        if self._head_times is None:
+            self._head_times = [(self.items[head_hash].time_seen, head_hash) for head_hash in self.heads]
+            heapq.heapify(self._head_times)
+        
+        removed, removed_set = [], set()
+        uncovered = {} # hash of a share that is a head once the removed ones are gone -> its tail
+        kept = set()
+        while self._head_times and self._head_times[0][0] <= now - 300:
+            time_seen, head_hash = heapq.heappop(self._head_times)
+            if head_hash in uncovered:
+                tail_hash = uncovered.pop(head_hash)
+            elif head_hash in self.heads and head_hash not in removed_set:
+                tail_hash = self.heads[head_hash]
+            else:
+                continue # got a child or was removed since
+            if head_hash in keep_hashes or (head_hash not in self.verified.items and
+                    max(self.items[share_hash].time_seen for share_hash in self.reverse[tail_hash]) > now - 120):
+                kept.add((time_seen, head_hash))
+                continue
+            removed.append(head_hash)
+            removed_set.add(head_hash)
+            previous_hash = self.items[head_hash].previous_hash
+            if previous_hash in self.items and self.reverse[previous_hash] <= removed_set:
+                uncovered[previous_hash] = tail_hash
+                heapq.heappush(self._head_times, (self.items[previous_hash].time_seen, previous_hash))
+        self._remove_shares(removed) # heads first, as they were uncovered
+        for x in kept:
+            heapq.heappush(self._head_times, x)
+        return removed
+    
+    def drop_tails(self, min_height):
+        '''
+        removes the bottom shares of chains until the shortest head above each
+        tail is less than min_height long. returns the removed hashes
+        '''
+        def get_height(head_hash):
+            if head_hash not in self._head_heights:
+                self._head_heights[head_hash] = self.get_height(head_hash)
+            return self._head_heights[head_hash]
+        def get_min_height(tail_hash):
+            return min(get_height(head_hash) for head_hash in self.tails[tail_hash])
+        tails = [(-get_min_height(tail_hash), tail_hash) for tail_hash in self.tails]
+        heapq.heapify(tails)
+        
+        removed = []
+        while tails and -tails[0][0] >= min_height:
+            negative_height, tail_hash = heapq.heappop(tails)
+            if tail_hash not in self.tails:
+                continue
+            if get_min_height(tail_hash) != -negative_height: # heads changed while dropping other tails
+                heapq.heappush(tails, (-get_min_height(tail_hash), tail_hash))
+                continue
+            share_hashes = list(self.reverse[tail_hash])
+            self._remove_shares(share_hashes)
+            removed.extend(share_hashes)
+            for share_hash in share_hashes:
+                if share_hash in self.tails:
+                    heapq.heappush(tails, (-get_min_height(share_hash), share_hash))
+        return removed
+    
     def score(self, share_hash, block_rel_height_func):
         # returns approximate lower bound on chain's hashrate in the last self.net.CHAIN_LENGTH*15//16*self.net.SHARE_PERIOD time
         
@@ -613,7 +1294,7 @@ class OkayTracker(forest.Tracker):
         
         end_point = self.verified.get_nth_parent_hash(share_hash, self.net.CHAIN_LENGTH*15//16)
         
-        block_height = max(block_rel_height_func(share.header['previous_block']) for share in
+        block_height = max(block_rel_height_func(share.need_contents().header['previous_block']) for share in
             self.verified.get_chain(end_point, self.net.CHAIN_LENGTH//16))
         
         return self.net.CHAIN_LENGTH, self.verified.get_delta(share_hash, end_point).work/((0 - block_height + 1)*self.net.PARENT.BLOCK_PERIOD)
@@ -638,17 +1319,19 @@ def get_pool_attempts_per_second(tracker, previous_share_hash, dist, min_work=Fa
         return attempts//time
     return attempts/time
 
+def get_chain_stats(tracker, share_hash, length):
+    # OkayTracker.stats_view's attributes summed over tracker.get_chain(share_hash, length)
+    return tracker.stats_view.get_chain_delta(share_hash, length)
+
 def get_average_stale_prop(tracker, share_hash, lookbehind):
-    stales = sum(1 for share in tracker.get_chain(share_hash, lookbehind) if share.share_data['stale_info'] is not None)
+    stales = get_chain_stats(tracker, share_hash, lookbehind).stale_count
     return stales/(lookbehind + stales)
 
 def get_stale_counts(tracker, share_hash, lookbehind, rates=False):
-    res = {}
-    for share in tracker.get_chain(share_hash, lookbehind - 1):
-        res['good'] = res.get('good', 0) + bitcoin_data.target_to_average_attempts(share.target)
-        s = share.share_data['stale_info']
-        if s is not None:
-            res[s] = res.get(s, 0) + bitcoin_data.target_to_average_attempts(share.target)
+    stats = get_chain_stats(tracker, share_hash, lookbehind - 1)
+    res = dict(stats.stale_work)
+    if stats.height:
+        res['good'] = stats.work
     if rates:
         dt = tracker.items[share_hash].timestamp - tracker.items[tracker.get_nth_parent_hash(share_hash, lookbehind - 1)].timestamp
         res = dict((k, v/dt) for k, v in res.iteritems())
@@ -657,7 +1340,7 @@ def get_stale_counts(tracker, share_hash, lookbehind, rates=False):
 def get_user_stale_props(tracker, share_hash, lookbehind):
     res = {}
     for share in tracker.get_chain(share_hash, lookbehind - 1):
-        stale, total = res.get(share.share_data['pubkey_hash'], (0, 0))
+        stale, total = res.get(share.need_contents().share_data['pubkey_hash'], (0, 0))
         total += 1
         if share.share_data['stale_info'] is not None:
             stale += 1
@@ -672,10 +1355,7 @@ def get_expected_payouts(tracker, best_share_hash, block_target, subsidy, net):
     return res
 
 def get_desired_version_counts(tracker, best_share_hash, dist):
-    res = {}
-    for share in tracker.get_chain(best_share_hash, dist):
-        res[share.desired_version] = res.get(share.desired_version, 0) + bitcoin_data.target_to_average_attempts(share.target)
-    return res
+    return dict(get_chain_stats(tracker, best_share_hash, dist).desired_version_work)
 
 def get_warnings(tracker, best_share, net, bitcoind_getinfo, bitcoind_work_value):
     res = []
@@ -706,102 +1386,345 @@ def format_hash(x):
         return 'xxxxxxxx'
     return '%08x' % (x % 2**32)
 
+# share storage
+#
+# share files are either legacy text ("<type> <hex>" per line) or binary: a
+# header followed by records of a type byte and a length-prefixed payload.
+# record types: 2 = verified share hash (32 raw bytes), 5 = packed share_type,
+# 6 = packed share_header_record_type
+
+share_file_header_type = pack.ComposedType([
+    ('magic', pack.FixedStrType(4)),
+    ('version', pack.IntType(8)),
+])
+SHARE_FILE_MAGIC = '\xfap2s'
+SHARE_FILE_VERSION = 1
+SHARE_FILE_HEADER = share_file_header_type.pack(dict(magic=SHARE_FILE_MAGIC, version=SHARE_FILE_VERSION))
+
+share_record_type = pack.ComposedType([
+    ('type', pack.IntType(8)),
+    ('contents', pack.VarStrType()),
+])
+
+def is_binary_share_file(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(SHARE_FILE_MAGIC)) == SHARE_FILE_MAGIC
+
+def is_current_share_file(filename):
+    '''whether records can be appended to a share file, which needs a complete header of this version'''
+    with open(filename, 'rb') as f:
+        return f.read(len(SHARE_FILE_HEADER)) == SHARE_FILE_HEADER
+
+def read_share_records(filename, truncate=True):
+    '''returns an iterator of (type_id, contents) for every record in a share file, in either format. a binary file
+    with a cut off header raises pack.EarlyEnd and one of an unknown version ValueError here, before any record'''
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if not data.startswith(SHARE_FILE_MAGIC):
+        return _read_legacy_share_records(data)
+    header, file = share_file_header_type.read((data, 0))
+    if header['version'] != SHARE_FILE_VERSION:
+        raise ValueError('unknown share file version %i in %s' % (header['version'], filename))
+    return _read_binary_share_records(filename, file, truncate)
+
+def _read_legacy_share_records(data):
+    for line in data.splitlines():
+        try:
+            type_id_str, data_hex = line.strip().split(' ')
+            type_id = int(type_id_str)
+            if type_id == 2:
+                contents = pack.IntType(256).pack(int(data_hex, 16))
+            else:
+                contents = data_hex.decode('hex')
+        except Exception:
+            log.err(None, "HARMLESS error while reading saved shares, continuing where left off:")
+            continue
+        yield type_id, contents
+
+def _read_binary_share_records(filename, file, truncate):
+    while pack.size(file):
+        try:
+            record, file = share_record_type.read(file)
+        except pack.EarlyEnd:
+            if not truncate: # might still be being written
+                return
+            # left behind by a crash during a write. cut it off so that records appended later stay readable
+            print >>sys.stderr, 'Share file %s ends with a truncated record, removing it' % (filename,)
+            with open(filename, 'rb+') as f:
+                f.truncate(file[1])
+            return
+        yield record['type'], record['contents']
+
+def convert_share_file(filename):
+    '''rewrites a legacy text share file in the binary format, atomically. returns False if it already was binary'''
+    if is_binary_share_file(filename):
+        return False
+    with open(filename + '.new', 'wb') as f:
+        f.write(SHARE_FILE_HEADER)
+        for type_id, contents in read_share_records(filename):
+            f.write(share_record_type.pack(dict(type=type_id, contents=contents)))
+    try:
+        os.rename(filename + '.new', filename)
+    except: # XXX windows can't overwrite
+        os.remove(filename)
+        os.rename(filename + '.new', filename)
+    return True
+
+def write_share_bundle(filename, shares):
+    '''writes shares (oldest first) to a share file meant for --import-shares, atomically'''
+    with open(filename + '.new', 'wb') as f:
+        f.write(SHARE_FILE_HEADER)
+        for share in shares:
+            f.write(share_record_type.pack(dict(type=5, contents=share_type.pack(share.as_share()))))
+    try:
+        os.rename(filename + '.new', filename)
+    except: # XXX windows can't overwrite
+        os.remove(filename)
+        os.rename(filename + '.new', filename)
+
+def read_share_bundle(filename, net):
+    '''yields the shares in a file written by write_share_bundle, fully decoded and with their PoW checked since it
+    could have come from anywhere'''
+    for type_id, contents in read_share_records(filename, truncate=False):
+        if type_id != 5:
+            raise ValueError('unexpected record type %i in share bundle' % (type_id,))
+        yield load_share(share_type.unpack(contents), net, None)
+
 class ShareStore(object):
-    def __init__(self, prefix, net, share_cb, verified_hash_cb):
+    MAX_FILE_SIZE = 10e6
+    MIN_LIVE_RATIO = 0.5 # files with less of their records still desired get compacted
+    
+    def __init__(self, prefix, net, share_cb, verified_hash_cb, lazy=False, read_only=False):
         self.dirname = os.path.dirname(os.path.abspath(prefix))
         self.filename = os.path.basename(os.path.abspath(prefix))
         self.net = net
+        self.read_only = read_only # for reading the files of a running node
         
         known = {}
+        share_filenames = {}
+        verified_filenames = {}
         filenames, next = self.get_filenames_and_next()
         for filename in filenames:
+            try:
+                records = read_share_records(filename, truncate=not read_only)
+            except (pack.EarlyEnd, ValueError):
+                log.err(None, "HARMLESS error while reading saved shares, skipping %s:" % (filename,))
+                continue
             share_hashes, verified_hashes = known.setdefault(filename, (set(), set()))
-            with open(filename, 'rb') as f:
-                for line in f:
-                    try:
-                        type_id_str, data_hex = line.strip().split(' ')
-                        type_id = int(type_id_str)
-                        if type_id == 0:
-                            pass
-                        elif type_id == 1:
-                            pass
-                        elif type_id == 2:
-                            verified_hash = int(data_hex, 16)
-                            verified_hash_cb(verified_hash)
-                            verified_hashes.add(verified_hash)
-                        elif type_id == 5:
-                            raw_share = share_type.unpack(data_hex.decode('hex'))
-                            if raw_share['type'] < Share.VERSION:
-                                continue
-                            share = load_share(raw_share, self.net, None)
-                            share_cb(share)
-                            share_hashes.add(share.hash)
-                        else:
-                            raise NotImplementedError("share type %i" % (type_id,))
-                    except Exception:
-                        log.err(None, "HARMLESS error while reading saved shares, continuing where left off:")
+            for type_id, contents in records:
+                try:
+                    if type_id == 0:
+                        pass
+                    elif type_id == 1:
+                        pass
+                    elif type_id == 2:
+                        verified_hash = pack.IntType(256).unpack(contents)
+                        if verified_hash in verified_filenames:
+                            continue # duplicate record, the first one is authoritative
+                        verified_hash_cb(verified_hash)
+                        verified_hashes.add(verified_hash)
+                        verified_filenames[verified_hash] = filename
+                    elif type_id == 5:
+                        raw_share = share_type.unpack(contents)
+                        if raw_share['type'] < Share.VERSION:
+                            continue
+                        share = load_share(raw_share, self.net, None)
+                        if share.hash in share_filenames:
+                            continue # duplicate record, the first one is authoritative
+                        share_cb(share)
+                        share_hashes.add(share.hash)
+                        share_filenames[share.hash] = filename
+                    elif type_id == 6:
+                        header = share_header_record_type.unpack(contents)
+                        if header['share']['type'] < Share.VERSION:
+                            continue
+                        if header['hash'] in share_filenames:
+                            continue # duplicate record, the first one is authoritative
+                        share = load_share_header(header, self.net) if lazy else load_share(header['share'], self.net, None)
+                        share_cb(share)
+                        share_hashes.add(share.hash)
+                        share_filenames[share.hash] = filename
+                    else:
+                        raise NotImplementedError("share type %i" % (type_id,))
+                except Exception:
+                    log.err(None, "HARMLESS error while reading saved shares, continuing where left off:")
         
         self.known = known # filename -> (set of share hashes, set of verified hashes)
         self.known_desired = dict((k, (set(a), set(b))) for k, (a, b) in known.iteritems())
+        self.share_filenames = share_filenames # share hash -> filename
+        self.verified_filenames = verified_filenames # verified hash -> filename
+        
+        self._tail = None # (filename, file, size) of the file currently appended to
+        if not read_only:
+            self._open_tail()
+        self._compacting = None # (filename, record iterator) of the file currently being compacted
     
-    def _add_line(self, line):
+    def convert_legacy_files(self):
+        self._close_tail()
         filenames, next = self.get_filenames_and_next()
-        if filenames and os.path.getsize(filenames[-1]) < 10e6:
-            filename = filenames[-1]
-        else:
-            filename = next
+        res = [filename for filename in filenames if convert_share_file(filename)]
+        self._open_tail()
+        return res
+    
+    def _open_tail(self):
+        filenames, next = self.get_filenames_and_next()
+        self._next_suffix = int(next[len(os.path.join(self.dirname, self.filename)):])
+        if filenames and os.path.getsize(filenames[-1]) < self.MAX_FILE_SIZE and is_current_share_file(filenames[-1]):
+            self._tail = filenames[-1], open(filenames[-1], 'ab'), os.path.getsize(filenames[-1])
+    
+    def _close_tail(self):
+        if self._tail is not None:
+            filename, f, size = self._tail
+            f.close()
+            self._tail = None
+    
+    def _add_record(self, type_id, contents, flush=True):
+        assert not self.read_only
+        if self._tail is None or self._tail[2] >= self.MAX_FILE_SIZE:
+            self._close_tail()
+            filename = os.path.join(self.dirname, self.filename + str(self._next_suffix))
+            self._next_suffix += 1
+            f = open(filename, 'ab')
+            f.write(SHARE_FILE_HEADER)
+            self._tail = filename, f, len(SHARE_FILE_HEADER)
         
-        with open(filename, 'ab') as f:
-            f.write(line + '\n')
+        filename, f, size = self._tail
+        record = share_record_type.pack(dict(type=type_id, contents=contents))
+        f.write(record)
+        if flush:
+            f.flush()
+        self._tail = filename, f, size + len(record)
         
         return filename
     
-    def add_share(self, share):
-        for filename, (share_hashes, verified_hashes) in self.known.iteritems():
-            if share.hash in share_hashes:
-                break
-        else:
-            filename = self._add_line("%i %s" % (5, share_type.pack(share.as_share()).encode('hex')))
+    def add_share(self, share, flush=True):
+        filename = self.share_filenames.get(share.hash)
+        if filename is None:
+            filename = self.share_filenames[share.hash] = self._add_record(6, share_header_record_type.pack(share.as_share_header()), flush)
             share_hashes, verified_hashes = self.known.setdefault(filename, (set(), set()))
             share_hashes.add(share.hash)
         share_hashes, verified_hashes = self.known_desired.setdefault(filename, (set(), set()))
         share_hashes.add(share.hash)
     
+    def add_shares(self, shares):
+        for share in shares:
+            self.add_share(share, flush=False)
+        if self._tail is not None:
+            self._tail[1].flush()
+    
     def add_verified_hash(self, share_hash):
-        for filename, (share_hashes, verified_hashes) in self.known.iteritems():
-            if share_hash in verified_hashes:
-                break
-        else:
-            filename = self._add_line("%i %x" % (2, share_hash))
+        filename = self.verified_filenames.get(share_hash)
+        if filename is None:
+            filename = self.verified_filenames[share_hash] = self._add_record(2, pack.IntType(256).pack(share_hash))
             share_hashes, verified_hashes = self.known.setdefault(filename, (set(), set()))
             verified_hashes.add(share_hash)
         share_hashes, verified_hashes = self.known_desired.setdefault(filename, (set(), set()))
         verified_hashes.add(share_hash)
     
+    def compact(self, max_time):
+        '''moves the desired records of files that are mostly forgotten to the tail file, then removes the files.
+        works for about max_time seconds at a time, returning whether there is more to do'''
+        end_time = time.time() + max_time
+        while time.time() < end_time:
+            if self._compacting is None:
+                filename = self._get_compaction_candidate()
+                if filename is None:
+                    return False
+                self._compacting = filename, read_share_records(filename)
+            filename, records = self._compacting
+            if filename not in self.known: # all of it was forgotten in the meantime
+                self._compacting = None
+                continue
+            try:
+                type_id, contents = records.next()
+            except StopIteration:
+                self._compacting = None
+                self._finish_compaction(filename)
+                continue
+            try:
+                self._move_record(filename, type_id, contents)
+            except Exception:
+                log.err(None, 'Error while compacting %s, skipping record:' % (filename,))
+        if self._tail is not None:
+            self._tail[1].flush()
+        return self._compacting is not None or self._get_compaction_candidate() is not None
+    
+    def _get_compaction_candidate(self):
+        res, res_ratio = None, self.MIN_LIVE_RATIO
+        for filename, (share_hashes, verified_hashes) in self.known.iteritems():
+            if self._tail is not None and self._tail[0] == filename:
+                continue
+            desired_share_hashes, desired_verified_hashes = self.known_desired[filename]
+            total = len(share_hashes) + len(verified_hashes)
+            if not total:
+                continue
+            ratio = (len(desired_share_hashes) + len(desired_verified_hashes))/total
+            if ratio < res_ratio:
+                res, res_ratio = filename, ratio
+        return res
+    
+    def _move_record(self, filename, type_id, contents):
+        if type_id == 2:
+            index, i, item_hash = self.verified_filenames, 1, pack.IntType(256).unpack(contents)
+        elif type_id == 5:
+            raw_share = share_type.unpack(contents)
+            if raw_share['type'] < Share.VERSION:
+                return
+            index, i, item_hash = self.share_filenames, 0, load_share(raw_share, self.net, None).hash
+        elif type_id == 6:
+            index, i, item_hash = self.share_filenames, 0, pack.IntType(256).unpack(contents[:32])
+        else:
+            return
+        if index.get(item_hash) != filename or item_hash not in self.known_desired[filename][i]:
+            return # forgotten or a duplicate, so not worth keeping
+        new_filename = index[item_hash] = self._add_record(type_id, contents, flush=False)
+        for known in [self.known, self.known_desired]:
+            known[filename][i].remove(item_hash)
+            known.setdefault(new_filename, (set(), set()))[i].add(item_hash)
+    
+    def _finish_compaction(self, filename):
+        if filename not in self.known:
+            return
+        if self._tail is not None: # the moved records have to be on disk before their old copies are deleted
+            f = self._tail[1]
+            f.flush()
+            try:
+                os.fsync(f.fileno())
+            except:
+                pass
+        self._check_remove(filename) # keeps the file if something in it was re-added after its record was passed
+    
     def get_filenames_and_next(self):
         suffixes = sorted(int(x[len(self.filename):]) for x in os.listdir(self.dirname) if x.startswith(self.filename) and x[len(self.filename):].isdigit())
         return [os.path.join(self.dirname, self.filename + str(suffix)) for suffix in suffixes], os.path.join(self.dirname, self.filename + (str(suffixes[-1] + 1) if suffixes else str(0)))
     
     def forget_share(self, share_hash):
-        for filename, (share_hashes, verified_hashes) in self.known_desired.iteritems():
-            if share_hash in share_hashes:
-                share_hashes.remove(share_hash)
-        self.check_remove()
+        filename = self.share_filenames.get(share_hash)
+        if filename is not None:
+            self.known_desired[filename][0].discard(share_hash)
+            self._check_remove(filename)
     
     def forget_verified_share(self, share_hash):
-        for filename, (share_hashes, verified_hashes) in self.known_desired.iteritems():
-            if share_hash in verified_hashes:
-                verified_hashes.remove(share_hash)
-        self.check_remove()
+        filename = self.verified_filenames.get(share_hash)
+        if filename is not None:
+            self.known_desired[filename][1].discard(share_hash)
+            self._check_remove(filename)
     
     def check_remove(self):
-        to_remove = set()
-        for filename, (share_hashes, verified_hashes) in self.known_desired.iteritems():
-            #print filename, len(share_hashes) + len(verified_hashes)
-            if not share_hashes and not verified_hashes:
-                to_remove.add(filename)
-        for filename in to_remove:
-            self.known.pop(filename)
-            self.known_desired.pop(filename)
-            os.remove(filename)
-            print "REMOVED", filename
+        for filename in list(self.known_desired):
+            self._check_remove(filename)
+    
+    def _check_remove(self, filename):
+        share_hashes, verified_hashes = self.known_desired[filename]
+        if share_hashes or verified_hashes:
+            return
+        if self._tail is not None and self._tail[0] == filename:
+            self._close_tail()
+        share_hashes, verified_hashes = self.known.pop(filename)
+        for share_hash in share_hashes:
+            del self.share_filenames[share_hash]
+        for verified_hash in verified_hashes:
+            del self.verified_filenames[verified_hash]
+        self.known_desired.pop(filename)
+        os.remove(filename)
+        print "REMOVED", filename
@@ -3,6 +3,7 @@ from __future__ import division
 import base64
 import gc
 import json
+import multiprocessing
 import os
 import random
 import sys
@@ -23,7 +24,7 @@ import bitcoin.p2p as bitcoin_p2p, bitcoin.data as bitcoin_data
 from bitcoin import stratum, worker_interface, helper
 from util import fixargparse, jsonrpc, variable, deferral, math, logging, switchprotocol
 from . import networks, web, work
-import p2pool, p2pool.data as p2pool_data, p2pool.node as p2pool_node
+import p2pool, p2pool.data as p2pool_data, p2pool.node as p2pool_node, p2pool.stats as p2pool_stats
 
 class keypool():
     keys = []
@@ -64,8 +65,9 @@ class keypool():
 
     def paytotal(self):
         self.payouttotal = 0.0
+        current_txouts = node.get_current_txouts()
         for i in range(len(pubkeys.keys)):
-            self.payouttotal += node.get_current_txouts().get(bitcoin_data.pubkey_hash_to_script2(pubkeys.keys[i]), 0)*1e-8
+            self.payouttotal += current_txouts.get(bitcoin_data.pubkey_hash_to_script2(pubkeys.keys[i]), 0)*1e-8
         return self.payouttotal
 
     def getpaytotal(self):
@@ -177,14 +179,50 @@ def main(args, net, datadir_path, merged_urls, worker_endpoint):
             shares[share.hash] = share
             if len(shares) % 1000 == 0 and shares:
                 print "    %i" % (len(shares),)
-        ss = p2pool_data.ShareStore(os.path.join(datadir_path, 'shares.'), net, share_cb, known_verified.add)
+        ss = p2pool_data.ShareStore(os.path.join(datadir_path, 'shares.'), net, share_cb, known_verified.add, lazy=True)
         print "    ...done loading %i shares (%i verified)!" % (len(shares), len(known_verified))
+        converted = ss.convert_legacy_files()
+        if converted:
+            print "    ...converted %i share files to binary format" % (len(converted),)
         print
         
+        imported_hashes = []
+        if args.import_shares is not None:
+            print 'Importing shares from %s...' % (args.import_shares,)
+            imported = []
+            try:
+                for share in p2pool_data.read_share_bundle(args.import_shares, net):
+                    imported.append(share)
+            except:
+                log.err(None, 'Error while reading share bundle, importing the shares before the error:')
+            for share in imported:
+                if share.hash not in shares:
+                    share_cb(share)
+            ss.add_shares(imported)
+            imported_hashes = [share.hash for share in imported]
+            print '    ...imported %i shares!' % (len(imported),)
+            print
+        
         
         print 'Initializing work...'
         
-        node = p2pool_node.Node(factory, bitcoind, shares.values(), known_verified, net)
+        snapshot_path = os.path.join(datadir_path, 'tracker_snapshot')
+        snapshot = None
+        if os.path.exists(snapshot_path):
+            try:
+                with open(snapshot_path, 'rb') as f:
+                    snapshot = json.loads(f.read())
+            except:
+                log.err(None, 'Error while reading tracker snapshot:')
+        
+        node = p2pool_node.Node(factory, bitcoind, shares.values(), known_verified, net, snapshot, args.verify_batch or None)
+        del snapshot
+        
+        print 'Decoding recent shares...'
+        removed = yield node.materialize_shares(node.get_recent_share_hashes())
+        print '    ...done%s!' % (', removed %i shares with bad records' % (len(removed),) if removed else '',)
+        
+        node.tracker.verify_shares(imported_hashes) # checked by think along with the rest, a batch per turn of the event loop
         yield node.start()
         
         for share_hash in shares:
@@ -193,19 +231,38 @@ def main(args, net, datadir_path, merged_urls, worker_endpoint):
         for share_hash in known_verified:
             if share_hash not in node.tracker.verified.items:
                 ss.forget_verified_share(share_hash)
-        node.tracker.removed.watch(lambda share: ss.forget_share(share.hash))
-        node.tracker.verified.removed.watch(lambda share: ss.forget_verified_share(share.hash))
+        node.tracker.removed.watch(lambda shares: [ss.forget_share(share.hash) for share in shares])
+        node.tracker.verified.removed.watch(lambda shares: [ss.forget_verified_share(share.hash) for share in shares])
+        
+        @defer.inlineCallbacks
+        def materialize_rest():
+            removed = yield node.materialize_shares()
+            if removed:
+                print 'Removed %i older shares with bad records' % (len(removed),)
+        materialize_rest().addErrback(log.err, 'Error while decoding older shares:')
         
         def save_shares():
-            for share in node.tracker.get_chain(node.best_share_var.value, min(node.tracker.get_height(node.best_share_var.value), 2*net.CHAIN_LENGTH)):
-                ss.add_share(share)
-                if share.hash in node.tracker.verified.items:
-                    ss.add_verified_hash(share.hash)
+            for share_hash in node.best_chain.hashes[node.best_chain.get_slice(min(node.tracker.get_height(node.best_share_var.value), 2*net.CHAIN_LENGTH))]:
+                ss.add_share(node.tracker.items[share_hash])
+                if share_hash in node.tracker.verified.items:
+                    ss.add_verified_hash(share_hash)
         deferral.RobustLoopingCall(save_shares).start(60)
+        deferral.RobustLoopingCall(ss.compact, 0.05).start(1) # a little at a time to not hold up the reactor
+        
+        def save_tracker_snapshot():
+            with open(snapshot_path + '.new', 'wb') as f:
+                f.write(json.dumps(node.get_tracker_snapshot()))
+            try:
+                os.rename(snapshot_path + '.new', snapshot_path)
+            except: # XXX windows can't overwrite
+                os.remove(snapshot_path)
+                os.rename(snapshot_path + '.new', snapshot_path)
+        deferral.RobustLoopingCall(save_tracker_snapshot).start(600)
+        reactor.addSystemEventTrigger('before', 'shutdown', save_tracker_snapshot)
 
         if len(shares) > net.CHAIN_LENGTH:
             best_share = shares[node.best_share_var.value]
-            previous_share = shares[best_share.share_data['previous_share_hash']]
+            previous_share = shares[best_share.need_contents().share_data['previous_share_hash']]
             counts = p2pool_data.get_desired_version_counts(node.tracker, node.tracker.get_nth_parent_hash(previous_share.hash, net.CHAIN_LENGTH*9//10), net.CHAIN_LENGTH//10)
             p2pool_data.update_min_protocol_version(counts, best_share)
         
@@ -379,7 +436,7 @@ def main(args, net, datadir_path, merged_urls, worker_endpoint):
                         len(node.tracker.items),
                         len(node.p2p_node.peers),
                         sum(1 for peer in node.p2p_node.peers.itervalues() if peer.incoming),
-                    ) + (' FDs: %i R/%i W' % (len(reactor.getReaders()), len(reactor.getWriters())) if p2pool.DEBUG else '')
+                    ) + (' Verifying: %i' % (node.tracker.verify_backlog,) if node.tracker.verify_backlog else '') + (' FDs: %i R/%i W' % (len(reactor.getReaders()), len(reactor.getWriters())) if p2pool.DEBUG else '')
                     
                     datums, dt = wb.local_rate_monitor.get_datums_in_last()
                     my_att_s = sum(datum['work']/dt for datum in datums)
@@ -393,13 +450,15 @@ def main(args, net, datadir_path, merged_urls, worker_endpoint):
                     
                     if height > 2:
                         (stale_orphan_shares, stale_doa_shares), shares, _ = wb.get_stale_counts()
-                        stale_prop = p2pool_data.get_average_stale_prop(node.tracker, node.best_share_var.value, min(60*60//net.SHARE_PERIOD, height))
-                        real_att_s = p2pool_data.get_pool_attempts_per_second(node.tracker, node.best_share_var.value, min(height - 1, 60*60//net.SHARE_PERIOD)) / (1 - stale_prop)
+                        pool_rates = p2pool_stats.get_pool_rates(node.best_chain, [min(60*60//net.SHARE_PERIOD, height), min(height - 1, 60*60//net.SHARE_PERIOD)])
+                        stale_prop = pool_rates[min(60*60//net.SHARE_PERIOD, height)][1]
+                        real_att_s = pool_rates[min(height - 1, 60*60//net.SHARE_PERIOD)][0] / (1 - stale_prop)
                         
                         paystr = ''
                         paytot = 0.0
+                        current_txouts = node.get_current_txouts()
                         for i in range(len(pubkeys.keys)):
-                            curtot = node.get_current_txouts().get(bitcoin_data.pubkey_hash_to_script2(pubkeys.keys[i]), 0)
+                            curtot = current_txouts.get(bitcoin_data.pubkey_hash_to_script2(pubkeys.keys[i]), 0)
                             paytot += curtot*1e-8
                             paystr += "(%.4f)" % (curtot*1e-8,)
                         paystr += "=%.4f" % (paytot,)
@@ -434,6 +493,48 @@ def main(args, net, datadir_path, merged_urls, worker_endpoint):
         reactor.stop()
         log.err(None, 'Fatal error:')
 
+def export_shares():
+    realnets = dict((name, net) for name, net in networks.nets.iteritems() if '_testnet' not in name)
+    
+    parser = fixargparse.FixedArgumentParser(description='export the best verified share chain of a p2pool data directory for --import-shares (version %s)' % (p2pool.__version__,))
+    parser.add_argument('--net',
+        help='use specified network (default: bitcoin)',
+        action='store', choices=sorted(realnets), default='bitcoin', dest='net_name')
+    parser.add_argument('--testnet',
+        help='''use the network's testnet''',
+        action='store_const', const=True, default=False, dest='testnet')
+    parser.add_argument('--datadir',
+        help='read data from this directory (default: <directory export_shares.py is in>/data)',
+        type=str, action='store', default=None, dest='datadir')
+    parser.add_argument('--length', metavar='SHARES',
+        help='export at most this many shares, going back from the best one (default: twice the chain length)',
+        type=int, action='store', default=None, dest='length')
+    parser.add_argument(metavar='FILE',
+        help='write the shares to this file',
+        type=str, action='store', dest='filename')
+    args = parser.parse_args()
+    
+    net_name = args.net_name + ('_testnet' if args.testnet else '')
+    net = networks.nets[net_name]
+    datadir_path = os.path.join((os.path.join(os.path.dirname(sys.argv[0]), 'data') if args.datadir is None else args.datadir), net_name)
+    
+    print 'Loading shares...'
+    tracker = p2pool_data.OkayTracker(net)
+    known_verified = set()
+    p2pool_data.ShareStore(os.path.join(datadir_path, 'shares.'), net, tracker.add, known_verified.add, lazy=True, read_only=True)
+    for share_hash in known_verified:
+        if share_hash in tracker.items:
+            tracker.verified.add(tracker.items[share_hash])
+    if not tracker.verified.heads:
+        print >>sys.stderr, 'No verified shares in %s!' % (datadir_path,)
+        sys.exit(1)
+    
+    best = max(tracker.verified.heads, key=tracker.verified.get_work)
+    length = min(tracker.get_height(best), 2*net.CHAIN_LENGTH if args.length is None else args.length)
+    shares = list(tracker.get_chain(best, length))[::-1]
+    p2pool_data.write_share_bundle(args.filename, shares)
+    print '    ...wrote %i shares ending with %s to %s' % (len(shares), p2pool_data.format_hash(best), args.filename)
+
 def run():
     if not hasattr(tcp.Client, 'abortConnection'):
         print "Twisted doesn't have abortConnection! Upgrade to a newer version of Twisted to avoid memory leaks!"
@@ -465,6 +566,15 @@ def run():
     parser.add_argument('--datadir',
         help='store data in this directory (default: <directory run_p2pool.py is in>/data)',
         type=str, action='store', default=None, dest='datadir')
+    parser.add_argument('--import-shares', metavar='FILE',
+        help='add the shares in this file (made with export_shares.py) to the share chain at startup instead of downloading them from peers',
+        type=str, action='store', default=None, dest='import_shares')
+    parser.add_argument('--verify-batch', metavar='SHARES',
+        help='check at most this many shares per turn of the event loop, so catching up on a long chain or verifying imported shares does not stall mining and peers. 0 checks them all at once (default: 100)',
+        type=int, action='store', default=100, dest='verify_batch')
+    parser.add_argument('--pow-threads', metavar='THREADS',
+        help='threads that hash received shares and pseudoshares on networks whose proof of work function can run in parallel, like scrypt (default: one per CPU)',
+        type=int, action='store', default=None, dest='pow_threads')
     parser.add_argument('--logfile',
         help='''log to this file (default: data/<NET>/log)''',
         type=str, action='store', default=None, dest='logfile')
@@ -671,5 +781,8 @@ def run():
     if not args.no_bugreport:
         log.addObserver(ErrorReporter().emit)
     
+    if getattr(net.PARENT, 'POW_FUNCS', None) is not None:
+        reactor.suggestThreadPoolSize(args.pow_threads if args.pow_threads is not None else multiprocessing.cpu_count())
+    
     reactor.callWhenRunning(main, args, net, datadir_path, merged_urls, worker_endpoint)
     reactor.run()
@@ -28,7 +28,7 @@ class P2PNode(p2p.Node):
         all_new_txs = {}
         for share, new_txs in shares:
             if new_txs is not None:
-                all_new_txs.update((bitcoin_data.hash256(bitcoin_data.tx_type.pack(new_tx)), new_tx) for new_tx in new_txs)
+                all_new_txs.update((bitcoin_data.get_tx_hash(new_tx), new_tx) for new_tx in new_txs)
             
             if share.hash in self.node.tracker.items:
                 #print 'Got duplicate share, ignoring. Hash: %s' % (p2pool_data.format_hash(share.hash),)
@@ -80,9 +80,13 @@ class P2PNode(p2p.Node):
         return shares
     
     def handle_bestblock(self, header, peer):
-        if self.node.net.PARENT.POW_FUNC(bitcoin_data.block_header_type.pack(header)) > header['bits'].target:
-            raise p2p.PeerMisbehavingError('received block header fails PoW test')
-        self.node.handle_header(header)
+        df = helper.get_pow_hashes(self.node.net.PARENT, [bitcoin_data.block_header_type.pack(header)])
+        @df.addCallback
+        def _((pow_hash,)):
+            if pow_hash > header['bits'].target:
+                raise p2p.PeerMisbehavingError('received block header fails PoW test')
+            return self.node.handle_header(header)
+        return df
     
     def broadcast_share(self, share_hash):
         shares = []
@@ -99,7 +103,7 @@ class P2PNode(p2p.Node):
         p2p.Node.start(self)
         
         self.shared_share_hashes = set(self.node.tracker.items)
-        self.node.tracker.removed.watch_weakref(self, lambda self, share: self.shared_share_hashes.discard(share.hash))
+        self.node.tracker.removed.watch_weakref(self, lambda self, shares: self.shared_share_hashes.difference_update(share.hash for share in shares))
         
         @apply
         @defer.inlineCallbacks
@@ -157,22 +161,67 @@ class P2PNode(p2p.Node):
         
 
 class Node(object):
-    def __init__(self, factory, bitcoind, shares, known_verified_share_hashes, net):
+    def __init__(self, factory, bitcoind, shares, known_verified_share_hashes, net, snapshot=None, verify_batch=None):
         self.factory = factory
         self.bitcoind = bitcoind
         self.net = net
         
         self.tracker = p2pool_data.OkayTracker(self.net)
+        self.tracker.max_checks = verify_batch
+        self._verify_call = None
+        
+        if snapshot is not None:
+            shares = dict((share.hash, share) for share in shares)
+            try:
+                self.tracker.load_snapshot(snapshot['tracker'], shares)
+                self.tracker.verified.load_snapshot(snapshot['verified'], dict((share_hash, shares[share_hash]) for share_hash in known_verified_share_hashes if share_hash in self.tracker.items))
+            except Exception:
+                log.err(None, 'Error while loading tracker snapshot, adding shares one by one:')
+            shares = shares.itervalues()
         
         for share in shares:
-            self.tracker.add(share)
+            if share.hash not in self.tracker.items:
+                self.tracker.add(share)
         
         for share_hash in known_verified_share_hashes:
-            if share_hash in self.tracker.items:
+            if share_hash in self.tracker.items and share_hash not in self.tracker.verified.items:
                 self.tracker.verified.add(self.tracker.items[share_hash])
         
+        if snapshot is not None and 'stats' in snapshot:
+            # otherwise the first get_chain_stats call reads the contents of every share down to the chain's last
+            try:
+                self.tracker.stats_view.load_snapshot(snapshot['stats'])
+            except Exception:
+                log.err(None, 'Error while loading share statistics from tracker snapshot:')
+        
+        self._current_payouts = None # ((best share hash, block target, subsidy), txouts, {view name: view})
+        self.tracker_cleaned = variable.Event() # (seconds clean_tracker took, number of shares it removed)
+        
         self.p2p_node = None # overwritten externally
     
+    def get_recent_share_hashes(self):
+        '''the last CHAIN_LENGTH shares below each verified head, which think and the work read as soon as the node
+        starts'''
+        share_hashes = set()
+        for head in self.tracker.verified.heads:
+            for share in self.tracker.verified.get_chain(head, min(self.tracker.verified.get_height(head), self.net.CHAIN_LENGTH)):
+                share_hashes.add(share.hash)
+        return share_hashes
+    
+    @defer.inlineCallbacks
+    def materialize_shares(self, share_hashes=None, batch=1000):
+        '''materializes shares that were loaded from header records, by default all of them, a batch per turn of the
+        event loop. code that reads contents calls need_contents on the shares it uses, so this only decides when the
+        decoding happens and removes the shares whose records turn out to be bad. returns their hashes'''
+        if share_hashes is None:
+            share_hashes = self.tracker.items.iterkeys()
+        share_hashes = [share_hash for share_hash in share_hashes if share_hash in self.tracker.items and not self.tracker.items[share_hash].materialized]
+        removed = []
+        for i in xrange(0, len(share_hashes), batch):
+            removed.extend(self.tracker.materialize_shares(share_hashes[i:i + batch]))
+            yield deferral.sleep(0)
+        defer.returnValue(removed)
+    
     @defer.inlineCallbacks
     def start(self):
         stop_signal = variable.Event()
@@ -180,13 +229,14 @@ class Node(object):
         
         # BITCOIND WORK
         
-        self.bitcoind_work = variable.Variable((yield helper.getwork(self.bitcoind)))
+        template_txs = helper.TemplateTransactions()
+        self.bitcoind_work = variable.Variable((yield helper.getwork(self.bitcoind, template_txs=template_txs)))
         @defer.inlineCallbacks
         def work_poller():
             while stop_signal.times == 0:
                 flag = self.factory.new_block.get_deferred()
                 try:
-                    self.bitcoind_work.set((yield helper.getwork(self.bitcoind, self.bitcoind_work.value['use_getblocktemplate'])))
+                    self.bitcoind_work.set((yield helper.getwork(self.bitcoind, self.bitcoind_work.value['use_getblocktemplate'], template_txs)))
                 except:
                     log.err()
                 yield defer.DeferredList([flag, deferral.sleep(15)], fireOnOneCallback=True)
@@ -195,8 +245,10 @@ class Node(object):
         # PEER WORK
         
         self.best_block_header = variable.Variable(None)
+        self.best_block_pow_hash = None # of best_block_header, so work doesn't need to hash it again
+        @defer.inlineCallbacks
         def handle_header(new_header, valid=False):
-            new_hash = self.net.PARENT.POW_FUNC(bitcoin_data.block_header_type.pack(new_header))
+            new_hash, = yield helper.get_pow_hashes(self.net.PARENT, [bitcoin_data.block_header_type.pack(new_header)])
             # check that header matches current target
             if new_hash > self.bitcoind_work.value['bits'].target:
                 return
@@ -215,13 +267,14 @@ class Node(object):
                     bitcoin_data.hash256(bitcoin_data.block_header_type.pack(new_header)) == bitcoind_best_block and
                     self.best_block_header.value['previous_block'] != bitcoind_best_block
                 )): # new is current and previous is not a child of current
+                self.best_block_pow_hash = new_hash
                 self.best_block_header.set(new_header)
         self.handle_header = handle_header
         @defer.inlineCallbacks
         def poll_header():
             if self.factory.conn.value is None:
                 return
-            handle_header((yield self.factory.conn.value.get_block_header(self.bitcoind_work.value['previous_block'])), True)
+            yield handle_header((yield self.factory.conn.value.get_block_header(self.bitcoind_work.value['previous_block'])), True)
         self.bitcoind_work.changed.watch(lambda _: poll_header())
         yield deferral.retry('Error while requesting best block header:')(poll_header)()
         
@@ -232,6 +285,8 @@ class Node(object):
         self.get_height_rel_highest = yield height_tracker.get_height_rel_highest_func(self.bitcoind, self.factory, lambda: self.bitcoind_work.value['previous_block'], self.net)
         
         self.best_share_var = variable.Variable(None)
+        self.best_chain = p2pool_data.BestChain(self.tracker, 2*self.net.CHAIN_LENGTH)
+        self.best_share_var.changed.watch(self.best_chain.set_head)
         self.desired_var = variable.Variable(None)
         self.bitcoind_work.changed.watch(lambda _: self.set_best_share())
         self.set_best_share()
@@ -252,7 +307,7 @@ class Node(object):
         @self.factory.new_tx.watch
         def _(tx):
             new_known_txs = dict(self.known_txs_var.value)
-            new_known_txs[bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx))] = tx
+            new_known_txs[bitcoin_data.get_tx_hash(tx)] = tx
             self.known_txs_var.set(new_known_txs)
         # forward transactions seen to bitcoind
         @self.known_txs_var.transitioned.watch
@@ -284,8 +339,8 @@ class Node(object):
                 for peer in self.p2p_node.peers.itervalues():
                     new_known_txs.update(peer.remembered_txs)
             new_known_txs.update(self.mining_txs_var.value)
-            for share in self.tracker.get_chain(self.best_share_var.value, min(120, self.tracker.get_height(self.best_share_var.value))):
-                for tx_hash in share.new_transaction_hashes:
+            for share_hash in self.best_chain.hashes[self.best_chain.get_slice(min(120, self.tracker.get_height(self.best_share_var.value)))]:
+                for tx_hash in self.tracker.items[share_hash].new_transaction_hashes:
                     if tx_hash in self.known_txs_var.value:
                         new_known_txs[tx_hash] = self.known_txs_var.value[tx_hash]
             self.known_txs_var.set(new_known_txs)
@@ -309,55 +364,44 @@ class Node(object):
                     if peer.addr == bad_peer_address:
                         peer.badPeerHappened()
                         break
+        
+        if self.tracker.verify_backlog and self._verify_call is None:
+            # think stopped checking shares so the reactor isn't held up, continue on its next turn
+            self._verify_call = reactor.callLater(0, self._verify_more)
+    
+    def _verify_more(self):
+        self._verify_call = None
+        self.set_best_share()
+    
+    def get_tracker_snapshot(self):
+        return dict(tracker=self.tracker.get_snapshot(), verified=self.tracker.verified.get_snapshot(), stats=self.tracker.stats_view.get_snapshot(cached_only=True))
+    
+    def _get_current_payouts(self):
+        key = self.best_share_var.value, self.bitcoind_work.value['bits'].target, self.bitcoind_work.value['subsidy']
+        if self._current_payouts is None or self._current_payouts[0] != key:
+            self._current_payouts = key, p2pool_data.get_expected_payouts(self.tracker, key[0], key[1], key[2], self.net), {}
+        return self._current_payouts
     
     def get_current_txouts(self):
-        return p2pool_data.get_expected_payouts(self.tracker, self.best_share_var.value, self.bitcoind_work.value['bits'].target, self.bitcoind_work.value['subsidy'], self.net)
+        # script -> amount. shared between callers until the best share or the block changes, so don't modify it
+        key, txouts, views = self._get_current_payouts()
+        return txouts
+    
+    def get_current_txouts_by_address(self):
+        # address -> amount, shared like get_current_txouts
+        key, txouts, views = self._get_current_payouts()
+        if 'address' not in views:
+            views['address'] = dict((bitcoin_data.script2_to_address(script, self.net.PARENT), amount) for script, amount in txouts.iteritems())
+        return views['address']
     
     def clean_tracker(self):
+        start = time.time()
         best, desired, decorated_heads, bad_peer_addresses = self.tracker.think(self.get_height_rel_highest, self.bitcoind_work.value['previous_block'], self.bitcoind_work.value['bits'], self.known_txs_var.value)
         
-        # eat away at heads
+        removed = []
         if decorated_heads:
-            for i in xrange(1000):
-                to_remove = set()
-                for share_hash, tail in self.tracker.heads.iteritems():
-                    if share_hash in [head_hash for score, head_hash in decorated_heads[-5:]]:
-                        #print 1
-                        continue
-                    if self.tracker.items[share_hash].time_seen > time.time() - 300:
-                        #print 2
-                        continue
-                    if share_hash not in self.tracker.verified.items and max(self.tracker.items[after_tail_hash].time_seen for after_tail_hash in self.tracker.reverse.get(tail)) > time.time() - 120: # XXX stupid
-                        #print 3
-                        continue
-                    to_remove.add(share_hash)
-                if not to_remove:
-                    break
-                for share_hash in to_remove:
-                    if share_hash in self.tracker.verified.items:
-                        self.tracker.verified.remove(share_hash)
-                    self.tracker.remove(share_hash)
-                #print "_________", to_remove
-        
-        # drop tails
-        for i in xrange(1000):
-            to_remove = set()
-            for tail, heads in self.tracker.tails.iteritems():
-                if min(self.tracker.get_height(head) for head in heads) < 2*self.tracker.net.CHAIN_LENGTH + 10:
-                    continue
-                to_remove.update(self.tracker.reverse.get(tail, set()))
-            if not to_remove:
-                break
-            # if removed from this, it must be removed from verified
-            #start = time.time()
-            for aftertail in to_remove:
-                if self.tracker.items[aftertail].previous_hash not in self.tracker.tails:
-                    print "erk", aftertail, self.tracker.items[aftertail].previous_hash
-                    continue
-                if aftertail in self.tracker.verified.items:
-                    self.tracker.verified.remove(aftertail)
-                self.tracker.remove(aftertail)
-            #end = time.time()
-            #print "removed! %i %f" % (len(to_remove), (end - start)/len(to_remove))
+            removed.extend(self.tracker.eat_heads(set(head_hash for score, head_hash in decorated_heads[-5:]), time.time()))
+        removed.extend(self.tracker.drop_tails(2*self.net.CHAIN_LENGTH + 10))
         
         self.set_best_share()
+        self.tracker_cleaned.happened(time.time() - start, len(removed))
@@ -10,7 +10,7 @@ from twisted.python import failure, log
 
 import p2pool
 from p2pool import data as p2pool_data
-from p2pool.bitcoin import data as bitcoin_data
+from p2pool.bitcoin import data as bitcoin_data, helper
 from p2pool.util import deferral, p2protocol, pack, variable
 
 class PeerMisbehavingError(Exception):
@@ -208,15 +208,15 @@ class Protocol(p2protocol.Protocol):
             removed = set(before) - set(after)
             if removed:
                 self.send_forget_tx(tx_hashes=list(removed))
-                self.remote_remembered_txs_size -= sum(100 + bitcoin_data.tx_type.packed_size(before[x]) for x in removed)
+                self.remote_remembered_txs_size -= sum(100 + bitcoin_data.get_tx_size(before[x]) for x in removed)
             if added:
-                self.remote_remembered_txs_size += sum(100 + bitcoin_data.tx_type.packed_size(after[x]) for x in added)
+                self.remote_remembered_txs_size += sum(100 + bitcoin_data.get_tx_size(after[x]) for x in added)
                 assert self.remote_remembered_txs_size <= self.max_remembered_txs_size
                 fragment(self.send_remember_tx, tx_hashes=[x for x in added if x in self.remote_tx_hashes], txs=[after[x] for x in added if x not in self.remote_tx_hashes])
         watch_id2 = self.node.mining_txs_var.transitioned.watch(update_remote_view_of_my_mining_txs)
         self.connection_lost_event.watch(lambda: self.node.mining_txs_var.transitioned.unwatch(watch_id2))
         
-        self.remote_remembered_txs_size += sum(100 + bitcoin_data.tx_type.packed_size(x) for x in self.node.mining_txs_var.value.values())
+        self.remote_remembered_txs_size += sum(100 + bitcoin_data.get_tx_size(x) for x in self.node.mining_txs_var.value.values())
         assert self.remote_remembered_txs_size <= self.max_remembered_txs_size
         fragment(self.send_remember_tx, tx_hashes=[], txs=self.node.mining_txs_var.value.values())
     
@@ -284,7 +284,7 @@ class Protocol(p2protocol.Protocol):
         result = []
         for wrappedshare in shares:
             if wrappedshare['type'] < p2pool_data.Share.VERSION: continue
-            share = p2pool_data.load_share(wrappedshare, self.node.net, self.addr)
+            share = p2pool_data.load_share(wrappedshare, self.node.net, self.addr, check_pow=False)
             if wrappedshare['type'] >= 13:
                 txs = []
                 for tx_hash in share.share_info['new_transaction_hashes']:
@@ -306,11 +306,32 @@ class Protocol(p2protocol.Protocol):
             
             result.append((share, txs))
             
-        self.node.handle_shares(result, self)
+        self._handle_later(self._check_pow([share for share, txs in result]).addCallback(lambda _: self.node.handle_shares(result, self)))
+    
+    def _check_pow(self, shares):
+        # for shares loaded with check_pow=False, hashing them in other threads if the network's PoW function allows it
+        df = helper.get_pow_hashes(self.node.net.PARENT, [bitcoin_data.block_header_type.pack(share.header) for share in shares])
+        @df.addCallback
+        def _(pow_hashes):
+            for share, pow_hash in zip(shares, pow_hashes):
+                share.set_pow_hash(pow_hash)
+        return df
+    
+    def _handle_later(self, df):
+        # errors of handlers that finish after returning, treated like packetReceived and dataReceived treat them
+        @df.addErrback
+        def _(fail):
+            if fail.check(PeerMisbehavingError):
+                print 'Peer %s:%i misbehaving, will drop and ban. Reason:' % self.addr, fail.value.message
+                self.badPeerHappened()
+            else:
+                log.err(fail, 'Error handling message:')
+                self.disconnect()
     
     def sendShares(self, shares, tracker, known_txs, include_txs_with=[]):
         tx_hashes = set()
         for share in shares:
+            share.need_contents()
             if share.VERSION >= 13:
                 # send full transaction for every new_transaction_hash that peer does not know
                 for tx_hash in share.share_info['new_transaction_hashes']:
@@ -325,7 +346,7 @@ class Protocol(p2protocol.Protocol):
         
         hashes_to_send = [x for x in tx_hashes if x not in self.node.mining_txs_var.value and x in known_txs]
         
-        new_remote_remembered_txs_size = self.remote_remembered_txs_size + sum(100 + bitcoin_data.tx_type.packed_size(known_txs[x]) for x in hashes_to_send)
+        new_remote_remembered_txs_size = self.remote_remembered_txs_size + sum(100 + bitcoin_data.get_tx_size(known_txs[x]) for x in hashes_to_send)
         if new_remote_remembered_txs_size > self.max_remembered_txs_size:
             raise ValueError('shares have too many txs')
         self.remote_remembered_txs_size = new_remote_remembered_txs_size
@@ -336,7 +357,7 @@ class Protocol(p2protocol.Protocol):
         
         self.send_forget_tx(tx_hashes=hashes_to_send)
         
-        self.remote_remembered_txs_size -= sum(100 + bitcoin_data.tx_type.packed_size(known_txs[x]) for x in hashes_to_send)
+        self.remote_remembered_txs_size -= sum(100 + bitcoin_data.get_tx_size(known_txs[x]) for x in hashes_to_send)
     
     
     message_sharereq = pack.ComposedType([
@@ -360,17 +381,17 @@ class Protocol(p2protocol.Protocol):
     class ShareReplyError(Exception): pass
     def handle_sharereply(self, id, result, shares):
         if result == 'good':
-            res = [p2pool_data.load_share(share, self.node.net, self.addr) for share in shares if share['type'] >= p2pool_data.Share.VERSION]
+            res = [p2pool_data.load_share(share, self.node.net, self.addr, check_pow=False) for share in shares if share['type'] >= p2pool_data.Share.VERSION]
+            self._handle_later(self._check_pow(res).addCallback(lambda _: self.get_shares.got_response(id, res)))
         else:
-            res = failure.Failure(self.ShareReplyError(result))
-        self.get_shares.got_response(id, res)
+            self.get_shares.got_response(id, failure.Failure(self.ShareReplyError(result)))
     
     
     message_bestblock = pack.ComposedType([
         ('header', bitcoin_data.block_header_type),
     ])
     def handle_bestblock(self, header):
-        self.node.handle_bestblock(header, self)
+        self._handle_later(defer.maybeDeferred(self.node.handle_bestblock, header, self))
     
     
     message_have_tx = pack.ComposedType([
@@ -414,11 +435,11 @@ class Protocol(p2protocol.Protocol):
                     return
             
             self.remembered_txs[tx_hash] = tx
-            self.remembered_txs_size += 100 + bitcoin_data.tx_type.packed_size(tx)
+            self.remembered_txs_size += 100 + bitcoin_data.get_tx_size(tx)
         new_known_txs = dict(self.node.known_txs_var.value)
         warned = False
         for tx in txs:
-            tx_hash = bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx))
+            tx_hash = bitcoin_data.get_tx_hash(tx)
             if tx_hash in self.remembered_txs:
                 print >>sys.stderr, 'Peer referenced transaction twice, disconnecting'
                 self.disconnect()
@@ -429,7 +450,7 @@ class Protocol(p2protocol.Protocol):
                 warned = True
             
             self.remembered_txs[tx_hash] = tx
-            self.remembered_txs_size += 100 + bitcoin_data.tx_type.packed_size(tx)
+            self.remembered_txs_size += 100 + bitcoin_data.get_tx_size(tx)
             new_known_txs[tx_hash] = tx
         self.node.known_txs_var.set(new_known_txs)
         if self.remembered_txs_size >= self.max_remembered_txs_size:
@@ -439,7 +460,7 @@ class Protocol(p2protocol.Protocol):
     ])
     def handle_forget_tx(self, tx_hashes):
         for tx_hash in tx_hashes:
-            self.remembered_txs_size -= 100 + bitcoin_data.tx_type.packed_size(self.remembered_txs[tx_hash])
+            self.remembered_txs_size -= 100 + bitcoin_data.get_tx_size(self.remembered_txs[tx_hash])
             assert self.remembered_txs_size >= 0
             del self.remembered_txs[tx_hash]
     
@@ -0,0 +1,118 @@
+'''
+statistics over the columns of a data.BestChain, each computed in one pass. uses
+NumPy if it's installed and plain loops otherwise; both give the same results
+'''
+
+from __future__ import division
+
+import itertools
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from p2pool import data as p2pool_data
+
+ORPHAN = p2pool_data.BestChain.STALE_INFO_CODES['orphan']
+DOA = p2pool_data.BestChain.STALE_INFO_CODES['doa']
+
+def _get_array(column, s):
+    if isinstance(column, list): # values that don't always fit in 64 bits, kept as Python integers so sums are exact
+        return numpy.array(column[s], dtype=object)
+    return numpy.frombuffer(column, dtype=column.typecode)[s].astype(numpy.int64)
+
+def _sum_by(indices, weights, n):
+    # numpy.bincount with weights, which would turn the Python integers of an object array into floats
+    res = numpy.zeros(n, dtype=object)
+    numpy.add.at(res, indices, weights)
+    return res
+
+def get_pool_rates(best_chain, lookbehinds):
+    '''
+    {lookbehind: (attempts per second, stale proportion)} for each lookbehind,
+    same as get_pool_attempts_per_second and get_average_stale_prop
+    '''
+    assert min(lookbehinds) >= 2
+    s = best_chain.get_slice(max(lookbehinds))
+    if numpy is not None:
+        works = numpy.cumsum(_get_array(best_chain.works, s)[::-1])
+        stale_counts = numpy.cumsum(_get_array(best_chain.stale_infos, s)[::-1] != 0)
+        timestamps = _get_array(best_chain.timestamps, s)[::-1]
+        res = {}
+        for lookbehind in lookbehinds:
+            stale_count = int(stale_counts[lookbehind - 1])
+            res[lookbehind] = works[lookbehind - 2]/max(1, int(timestamps[0] - timestamps[lookbehind - 1])), stale_count/(lookbehind + stale_count)
+        return res
+    
+    res = {}
+    wanted = set(lookbehinds)
+    attempts = stale_count = 0
+    timestamps = best_chain.timestamps[s]
+    for i, (work, stale_info, timestamp) in enumerate(itertools.izip(reversed(best_chain.works[s]), reversed(best_chain.stale_infos[s]), reversed(timestamps)), 1):
+        if stale_info:
+            stale_count += 1
+        if i in wanted:
+            res[i] = attempts/max(1, timestamps[-1] - timestamp), stale_count/(i + stale_count)
+        attempts += work
+    return res
+
+def get_user_stats(best_chain, length):
+    '''{pubkey_hash: (shares, stale shares, dead on arrival shares, work)} over the last length shares'''
+    s = best_chain.get_slice(length)
+    if numpy is not None:
+        n = len(best_chain.pubkey_hashes)
+        pubkey_hash_ids = _get_array(best_chain.pubkey_hash_ids, s)
+        stale_infos = _get_array(best_chain.stale_infos, s)
+        counts = numpy.bincount(pubkey_hash_ids, minlength=n)
+        stale_counts = numpy.bincount(pubkey_hash_ids[stale_infos != 0], minlength=n)
+        doa_counts = numpy.bincount(pubkey_hash_ids[stale_infos == DOA], minlength=n)
+        works = _sum_by(pubkey_hash_ids, _get_array(best_chain.works, s), n)
+        return dict((best_chain.pubkey_hashes[i], (int(counts[i]), int(stale_counts[i]), int(doa_counts[i]), works[i]))
+            for i in numpy.flatnonzero(counts))
+    
+    res = {}
+    for pubkey_hash_id, stale_info, work in itertools.izip(best_chain.pubkey_hash_ids[s], best_chain.stale_infos[s], best_chain.works[s]):
+        count, stale_count, doa_count, total_work = res.get(pubkey_hash_id, (0, 0, 0, 0))
+        res[pubkey_hash_id] = count + 1, stale_count + (stale_info != 0), doa_count + (stale_info == DOA), total_work + work
+    return dict((best_chain.pubkey_hashes[pubkey_hash_id], x) for pubkey_hash_id, x in res.iteritems())
+
+def get_version_votes(best_chain, length):
+    '''{desired version: work} over the last length shares'''
+    s = best_chain.get_slice(length)
+    # no NumPy version, since desired versions are Python integers and numpy.unique sorting those is slower than this
+    res = {}
+    for version, work in itertools.izip(best_chain.desired_versions[s], best_chain.works[s]):
+        res[version] = res.get(version, 0) + work
+    return res
+
+def get_difficulty_history(best_chain, length, period):
+    '''[(start of period, share count, average share difficulty)], oldest first, for the last length shares grouped by timestamp'''
+    s = best_chain.get_slice(length)
+    difficulty_per_attempt = (0xffff0000 * 2**(256-64) + 1)/2**256 # see bitcoin_data.target_to_difficulty
+    if numpy is not None:
+        periods, indices = numpy.unique(_get_array(best_chain.timestamps, s)//period, return_inverse=True)
+        counts = numpy.bincount(indices)
+        works = _sum_by(indices, _get_array(best_chain.works, s), len(periods))
+        return [(int(p)*period, int(count), work/int(count)*difficulty_per_attempt) for p, count, work in itertools.izip(periods, counts, works)]
+    
+    res = {}
+    for timestamp, work in itertools.izip(best_chain.timestamps[s], best_chain.works[s]):
+        count, total_work = res.get(timestamp//period, (0, 0))
+        res[timestamp//period] = count + 1, total_work + work
+    return [(p*period, count, total_work/count*difficulty_per_attempt) for p, (count, total_work) in sorted(res.iteritems())]
+
+def get_share_intervals(best_chain, length, quantiles=(.1, .5, .9)):
+    '''
+    (mean, [quantile, ...]) of the time between consecutive shares of the last
+    length shares. can be negative, since share timestamps aren't ordered
+    '''
+    assert length >= 2
+    s = best_chain.get_slice(length)
+    if numpy is not None:
+        intervals = numpy.sort(numpy.diff(_get_array(best_chain.timestamps, s)))
+        return int(intervals.sum())/len(intervals), [int(intervals[int(q*(len(intervals) - 1) + .5)]) for q in quantiles]
+    
+    timestamps = best_chain.timestamps[s]
+    intervals = sorted(b - a for a, b in itertools.izip(timestamps, timestamps[1:]))
+    return sum(intervals)/len(intervals), [intervals[int(q*(len(intervals) - 1) + .5)] for q in quantiles]
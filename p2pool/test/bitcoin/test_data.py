@@ -1,3 +1,4 @@
+import random
 import unittest
 
 from p2pool.bitcoin import data, networks
@@ -40,6 +41,26 @@ class Test(unittest.TestCase):
             lock_time=0,
         )) == 0xb53802b2333e828d6532059f46ecf6b313a42d79f97925e457fbbfda45367e5c
     
+    def test_transaction(self):
+        tx = dict(
+            version=1,
+            tx_ins=[dict(previous_output=dict(hash=0x1234, index=i), script='', sequence=None) for i in xrange(3)],
+            tx_outs=[dict(value=5000, script=data.pubkey_hash_to_script2(0x5678))],
+            lock_time=0,
+        )
+        for x in [tx, dict(tx, marker=0, flag=1, witness=[['abc', 'de'], [], ['f']]), dict(tx, marker=0, flag=1, witness=[[], [], []])]:
+            packed = data.tx_type.pack(x)
+            tx2 = data.tx_type.unpack(packed)
+            assert isinstance(tx2, data.Transaction)
+            assert tx2 == x and tx2.packed == packed and data.tx_type.pack(tx2) == packed
+            assert data.get_tx_hash(tx2) == data.get_tx_hash(x) == data.hash256(packed)
+            assert data.get_txid(tx2) == data.get_txid(x)
+            assert data.get_wtxid(tx2) == data.get_wtxid(x)
+            assert data.get_tx_size(tx2) == data.get_tx_size(x) == len(packed)
+            assert data.get_stripped_tx_size(tx2) == data.get_stripped_tx_size(x) == len(data.tx_id_type.pack(x))
+            self.assertRaises(TypeError, tx2.__setitem__, 'lock_time', 1)
+            assert dict(tx2, lock_time=1)['lock_time'] == 1
+    
     def test_address_to_pubkey_hash(self):
         assert data.address_to_pubkey_hash('1KUCp7YP5FP8ViRxhfszSUJCTAajK6viGy', networks.nets['bitcoin']) == pack.IntType(160).unpack('ca975b00a8c203b8692f5a18d92dc5c2d2ebc57b'.decode('hex'))
     
@@ -76,3 +97,21 @@ class Test(unittest.TestCase):
             0x13375a426de15631af9afdf00c490e87cc5aab823c327b9856004d0b198d72db,
             0x67d76a64fa9b6c5d39fde87356282ef507b3dec1eead4b54e739c74e02e81db4,
         ]) == 0x37a43a3b812e4eb665975f46393b4360008824aab180f27d642de8c28073bc44
+    
+    def test_merkle_link(self):
+        def merkle_hash(hashes): # the definition, hashing merkle_record_type records
+            while len(hashes) > 1:
+                hashes = [data.hash256(data.merkle_record_type.pack(dict(left=left, right=right)))
+                    for left, right in zip(hashes[::2], hashes[1::2] + [hashes[::2][-1]])]
+            return hashes[0]
+        for n in [1, 2, 3, 4, 5, 7, 8, 9, 33]:
+            hashes = [random.randrange(2**256) for i in xrange(n)]
+            root = merkle_hash(hashes)
+            assert data.merkle_hash(hashes) == root
+            tree = data.MerkleTree(pack.IntType(256).pack(h) for h in hashes)
+            assert data.check_merkle_link(hashes[0], data.calculate_merkle_link([None] + hashes[1:], 0)) == root # like the coinbase
+            for index in xrange(n):
+                link = data.calculate_merkle_link(hashes, index)
+                assert data.check_merkle_link(hashes[index], link) == root
+                new_hash = random.randrange(2**256)
+                assert pack.IntType(256).unpack(tree.get_root(index, pack.IntType(256).pack(new_hash))) == merkle_hash(hashes[:index] + [new_hash] + hashes[index + 1:])
@@ -0,0 +1,30 @@
+import os
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from p2pool.bitcoin import data, helper, networks
+
+class Test(unittest.TestCase):
+    @defer.inlineCallbacks
+    def test_get_pow_hashes(self):
+        headers = [os.urandom(80) for i in xrange(25)]
+        for net_name in ['bitcoin', 'litecoin']:
+            net = networks.nets[net_name]
+            assert (yield helper.get_pow_hashes(net, headers)) == map(net.POW_FUNC, headers)
+            assert (yield helper.get_pow_hashes(net, headers[:1])) == [net.POW_FUNC(headers[0])]
+            assert (yield helper.get_pow_hashes(net, [])) == []
+    
+    def test_template_transactions(self):
+        datas = [data.tx_type.pack(dict(version=1, tx_ins=[dict(previous_output=None, script='', sequence=None)], tx_outs=[dict(value=i, script='')], lock_time=0)).encode('hex') for i in xrange(10)]
+        template_txs = helper.TemplateTransactions()
+        txs, new_count = template_txs.ingest(datas[:6])
+        assert new_count == 6
+        assert [tx['tx_outs'][0]['value'] for tx in txs] == range(6)
+        txs2, new_count = template_txs.ingest(datas[3:])
+        assert new_count == 4
+        assert [tx['tx_outs'][0]['value'] for tx in txs2] == range(3, 10)
+        assert all(tx2 is tx for tx, tx2 in zip(txs[3:], txs2))
+        txs3, new_count = template_txs.ingest(datas[:4])
+        assert new_count == 3 # ones that were only in older templates are forgotten
+        assert txs3[3] is txs2[0]
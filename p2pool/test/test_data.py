@@ -1,14 +1,76 @@
+from __future__ import division
+
+import gc
+import os
 import random
+import shutil
+import tempfile
+import time
 import unittest
 
-from p2pool import data
-from p2pool.bitcoin import data as bitcoin_data
+from twisted.trial import unittest as trial_unittest
+
+from p2pool import data, p2p
+from p2pool.bitcoin import data as bitcoin_data, networks
 from p2pool.test.util import test_forest
-from p2pool.util import forest
+from p2pool.util import forest, math, pack
 
 def random_bytes(length):
     return ''.join(chr(random.randrange(2**8)) for i in xrange(length))
 
+testnet = math.Object(
+    NAME='testnet',
+    PARENT=networks.nets['bitcoin'],
+    SHARE_PERIOD=10, # seconds
+    CHAIN_LENGTH=50, # shares
+    REAL_CHAIN_LENGTH=50, # shares
+    TARGET_LOOKBEHIND=20, # shares
+    SPREAD=3, # blocks
+    IDENTIFIER='1dfc2a6e6f4d4d7c'.decode('hex'),
+    PREFIX='5c1d67b2cc0a9c3e'.decode('hex'),
+    MIN_TARGET=0,
+    MAX_TARGET=2**256 - 1,
+)
+
+def generate_shares(tracker, n, previous_share_hash=None, net=testnet, pubkey_hashes=5, first_timestamp=1500000000):
+    # builds n valid shares on top of previous_share_hash, adding each to tracker
+    shares = []
+    for i in xrange(n):
+        previous_share = tracker.items[previous_share_hash] if previous_share_hash is not None else None
+        timestamp = previous_share.timestamp + net.SHARE_PERIOD if previous_share is not None else first_timestamp
+        block_target = 2**256//2**40
+        share_info, gentx, other_transaction_hashes, get_share = data.Share.generate_transaction(
+            tracker=tracker,
+            share_data=dict(
+                previous_share_hash=previous_share_hash,
+                coinbase='\x01\x02',
+                nonce=random.randrange(2**32),
+                pubkey_hash=random.randrange(pubkey_hashes),
+                subsidy=5000000000,
+                donation=655,
+                stale_info=random.choice([None, None, 'orphan', 'doa']),
+                desired_version=16,
+            ),
+            block_target=block_target,
+            desired_timestamp=timestamp,
+            desired_target=2**256 - 1,
+            ref_merkle_link=dict(branch=[], index=0),
+            desired_other_transaction_hashes_and_fees=[],
+            net=net,
+        )
+        share = get_share(dict(
+            version=0x20000000,
+            previous_block=random.randrange(2**256),
+            merkle_root=bitcoin_data.check_merkle_link(bitcoin_data.get_txid(gentx), bitcoin_data.calculate_merkle_link([None] + other_transaction_hashes, 0)),
+            timestamp=share_info['timestamp'],
+            bits=bitcoin_data.FloatingInteger.from_target_upper_bound(block_target),
+            nonce=random.randrange(2**32),
+        ))
+        tracker.add(share)
+        shares.append(share)
+        previous_share_hash = share.hash
+    return shares
+
 class Test(unittest.TestCase):
     def test_hashlink1(self):
         for i in xrange(100):
@@ -39,3 +101,535 @@ class Test(unittest.TestCase):
         for i in xrange(200):
             a = random.randrange(200)
             d(a, random.randrange(a + 1), 1000000*65535)[1]
+
+    def test_cumulative_weights(self):
+        for ii in xrange(5):
+            t = forest.Tracker()
+            d = data.CumulativeWeights(t)
+            d2 = data.WeightsSkipList(t)
+            desired_weights = [0, 65535, 2**20*65535, 2**40*65535, random.randrange(2**30)*65535, 65535*2**256]
+            for i in xrange(200):
+                t.add(test_forest.FakeShare(hash=i, previous_hash=random.choice([i - 1, i - 1, i - 2]) if i > 1 else None, new_script=random.randrange(5),
+                    share_data=dict(donation=random.choice([0, 0, 1234, 65535, random.randrange(65536)])), target=random.randrange(2**230, 2**245)))
+                if random.randrange(10) == 0 and t.get_height(i) > 1:
+                    t.remove(t.get_nth_parent_hash(i, t.get_height(i) - 1)) # forget the oldest share
+                for j in xrange(3):
+                    # mostly queries that follow the head, like get_work and Share.check make
+                    a = random.choice([i, i, t.get_nth_parent_hash(i, min(t.get_height(i) - 1, 1)), random.choice(list(t.items))])
+                    max_shares = random.choice([t.get_height(a), t.get_height(a) - 1, 50, random.randrange(t.get_height(a) + 1)])
+                    args = a, max(0, min(max_shares, t.get_height(a))), random.choice(desired_weights)
+                    assert d(*args) == d2(*args), args
+        assert d(None, 0, 2**20*65535) == d2(None, 0, 2**20*65535) == ({}, 0, 0)
+    
+    def test_transaction_refs(self):
+        for ii in xrange(5):
+            t = forest.Tracker()
+            d = data.RecentTransactionRefs(t)
+            for i in xrange(200):
+                t.add(test_forest.FakeShare(hash=i, previous_hash=random.choice([i - 1, i - 1, i - 2]) if i > 1 else None,
+                    new_transaction_hashes=[random.randrange(100) for j in xrange(random.choice([0, 1, 5, 20]))]))
+                if random.randrange(10) == 0 and t.get_height(i) > 1:
+                    t.remove(t.get_nth_parent_hash(i, t.get_height(i) - 1)) # forget the oldest share
+                for j in xrange(3):
+                    a = random.choice([i, i, t.get_nth_parent_hash(i, min(t.get_height(i) - 1, 1)), random.choice(list(t.items))])
+                    max_shares = min(t.get_height(a), random.choice([100, 100, 10, random.randrange(t.get_height(a) + 1)]))
+                    expected = {} # the way generate_transaction used to find them
+                    for k, share in enumerate(t.get_chain(a, max_shares)):
+                        for m, tx_hash in enumerate(share.new_transaction_hashes):
+                            if tx_hash not in expected:
+                                expected[tx_hash] = [1 + k, m]
+                    window = d(a, max_shares)
+                    assert dict((tx_hash, [window.top - position + 1, m]) for tx_hash, (position, m) in window.refs.iteritems()) == expected
+        assert d(None, 0).refs == {}
+    
+    def test_generate_transaction_template(self):
+        tracker = data.OkayTracker(testnet)
+        shares = generate_shares(tracker, 30)
+        txs = [bitcoin_data.tx_type.unpack(bitcoin_data.tx_type.pack(dict(version=1, tx_ins=[dict(previous_output=None, script='', sequence=None)], tx_outs=[dict(value=i, script='')], lock_time=0))) for i in xrange(20)]
+        known_txs = dict((bitcoin_data.get_tx_hash(tx), tx) for tx in txs)
+        hashes_and_fees = [(bitcoin_data.get_tx_hash(tx), 1000) for tx in txs]
+        template = data.Share.generate_transaction_template(tracker, shares[-1].hash, 5000000000, 2**256//2**40, hashes_and_fees, testnet, known_txs=known_txs)
+        for pubkey_hash in range(7) + [random.randrange(2**160)]:
+            kwargs = dict(
+                tracker=tracker,
+                share_data=dict(previous_share_hash=shares[-1].hash, coinbase='\x01\x02', nonce=5, pubkey_hash=pubkey_hash, subsidy=5000000000, donation=655, stale_info=None, desired_version=16),
+                block_target=2**256//2**40,
+                desired_timestamp=shares[-1].timestamp + 5,
+                desired_target=random.choice([2**256 - 1, 2**240]),
+                ref_merkle_link=dict(branch=[], index=0),
+                desired_other_transaction_hashes_and_fees=hashes_and_fees,
+                net=testnet,
+                known_txs=known_txs,
+            )
+            share_info, gentx, other_transaction_hashes, get_share = data.Share.generate_transaction(**kwargs)
+            share_info2, gentx2, other_transaction_hashes2, get_share2 = data.Share.generate_transaction(template=template, **kwargs)
+            assert share_info == share_info2
+            assert gentx == gentx2
+            assert data.Share.get_ref_hash(testnet, share_info, kwargs['ref_merkle_link']) == data.Share.get_ref_hash(testnet, share_info, kwargs['ref_merkle_link'], template['packed_share_info'])
+            assert other_transaction_hashes == other_transaction_hashes2 == [h for h, fee in hashes_and_fees]
+    
+    def test_chain_stats(self):
+        t = data.OkayTracker(testnet)
+        for i in xrange(300):
+            t.add(test_forest.FakeShare(hash=i, previous_hash=random.choice([i - 1, i - 1, i - 2]) if i > 1 else None, timestamp=i*10,
+                target=random.randrange(2**230, 2**245), max_target=2**245, desired_version=random.choice([16, 16, 17, 18]),
+                share_data=dict(stale_info=random.choice([None, None, None, 'orphan', 'doa', 'unk5']))))
+        for i in xrange(200):
+            share_hash = random.randrange(10, 300)
+            lookbehind = random.randrange(2, t.get_height(share_hash) + 1)
+            chain = list(t.get_chain(share_hash, lookbehind))
+            
+            stales = sum(1 for share in chain if share.share_data['stale_info'] is not None)
+            assert data.get_average_stale_prop(t, share_hash, lookbehind) == stales/(lookbehind + stales)
+            
+            counts = {}
+            for share in chain[:-1]:
+                counts['good'] = counts.get('good', 0) + bitcoin_data.target_to_average_attempts(share.target)
+                if share.share_data['stale_info'] is not None:
+                    counts[share.share_data['stale_info']] = counts.get(share.share_data['stale_info'], 0) + bitcoin_data.target_to_average_attempts(share.target)
+            assert data.get_stale_counts(t, share_hash, lookbehind) == counts
+            assert data.get_stale_counts(t, share_hash, lookbehind, rates=True) == dict((k, v/(chain[0].timestamp - chain[-1].timestamp)) for k, v in counts.iteritems())
+            
+            versions = {}
+            for share in chain:
+                versions[share.desired_version] = versions.get(share.desired_version, 0) + bitcoin_data.target_to_average_attempts(share.target)
+            assert data.get_desired_version_counts(t, share_hash, lookbehind) == versions
+        assert data.get_desired_version_counts(t, 5, 0) == {}
+    
+    def test_best_chain(self):
+        shares = [test_forest.FakeShare(hash=i, previous_hash=random.choice([i - 1, i - 1, i - 5]) if i > 4 else None, timestamp=i*10,
+            target=random.randrange(2**230, 2**245), desired_version=random.choice([16, 17]),
+            share_data=dict(stale_info=random.choice([None, None, 'orphan', 'doa', 'unk5']), pubkey_hash=random.randrange(5))) for i in xrange(400)]
+        t = forest.Tracker(shares[100:])
+        best_chain = data.BestChain(t, 50)
+        def check(head):
+            best_chain.set_head(head)
+            for length in [0, random.randrange(t.get_height(head) + 1), t.get_height(head)]:
+                chain = list(t.get_chain(head, length))[::-1]
+                s = best_chain.get_slice(length)
+                assert best_chain.hashes[s] == [share.hash for share in chain]
+                assert list(best_chain.timestamps[s]) == [share.timestamp for share in chain]
+                assert best_chain.works[s] == [bitcoin_data.target_to_average_attempts(share.target) for share in chain]
+                assert list(best_chain.stale_infos[s]) == [{None: 0, 'orphan': 253, 'doa': 254, 'unk5': 5}[share.share_data['stale_info']] for share in chain]
+                assert [best_chain.pubkey_hashes[x] for x in best_chain.pubkey_hash_ids[s]] == [share.share_data['pubkey_hash'] for share in chain]
+                assert list(best_chain.desired_versions[s]) == [share.desired_version for share in chain]
+        for i in xrange(300):
+            check(random.choice([random.randrange(100, 400), random.choice(list(t.heads))]))
+        for share in shares[:100]: # parents arriving after the window was built
+            t.add(share)
+        for i in xrange(300):
+            check(random.randrange(400))
+        check(None)
+    
+    def test_clean_tracker(self):
+        def clean_tracker_reference(t, keep_hashes, now, min_height): # what Node.clean_tracker used to do
+            for i in xrange(1000):
+                to_remove = set()
+                for share_hash, tail in t.heads.iteritems():
+                    if share_hash in keep_hashes or t.items[share_hash].time_seen > now - 300:
+                        continue
+                    if share_hash not in t.verified.items and max(t.items[after_tail_hash].time_seen for after_tail_hash in t.reverse.get(tail)) > now - 120:
+                        continue
+                    to_remove.add(share_hash)
+                if not to_remove:
+                    break
+                for share_hash in to_remove:
+                    if share_hash in t.verified.items:
+                        t.verified.remove(share_hash)
+                    t.remove(share_hash)
+            for i in xrange(1000):
+                to_remove = set()
+                for tail, heads in t.tails.iteritems():
+                    if min(t.get_height(head) for head in heads) < min_height:
+                        continue
+                    to_remove.update(t.reverse.get(tail, set()))
+                if not to_remove:
+                    break
+                for aftertail in to_remove:
+                    if aftertail in t.verified.items:
+                        t.verified.remove(aftertail)
+                    t.remove(aftertail)
+        
+        for ii in xrange(20):
+            now = 10000
+            shares = []
+            for i in xrange(random.randrange(300)):
+                previous_hash = random.choice([share.hash for share in shares[-10:]] + [random.randrange(1000000, 1000010)]) if random.randrange(10) else None
+                shares.append(test_forest.FakeShare(hash=i, previous_hash=previous_hash, time_seen=now - random.randrange(600), target=2**240, max_target=2**240,
+                    desired_version=16, share_data=dict(stale_info=None)))
+            verified = set(share.hash for share in shares if random.randrange(2))
+            t1, t2 = data.OkayTracker(testnet), data.OkayTracker(testnet)
+            for t in [t1, t2]:
+                for share in shares:
+                    t.add(share)
+                for share in shares:
+                    if share.hash in verified:
+                        t.verified.add(share)
+            keep_hashes = set(random.sample(list(t1.heads), min(5, len(t1.heads))))
+            min_height = random.randrange(5, 30)
+            
+            clean_tracker_reference(t1, keep_hashes, now, min_height)
+            removed = t2.eat_heads(keep_hashes, now) + t2.drop_tails(min_height)
+            assert set(t1.items) == set(t2.items)
+            assert set(t1.verified.items) == set(t2.verified.items)
+            assert sorted(removed) == sorted(share.hash for share in shares if share.hash not in t2.items)
+            
+            # the head index stays up to date for the next cleaning
+            now += 300
+            for t in [t1, t2]:
+                for share in shares[:20]:
+                    if share.hash not in t.items:
+                        t.add(share)
+            clean_tracker_reference(t1, set(), now, min_height)
+            t2.eat_heads(set(), now)
+            t2.drop_tails(min_height)
+            assert set(t1.items) == set(t2.items)
+    
+    def test_unverified_heads(self):
+        for ii in xrange(10):
+            t = data.OkayTracker(testnet)
+            items = []
+            for i in xrange(random.randrange(100)):
+                x = random.choice(items + [test_forest.FakeShare(hash=None), test_forest.FakeShare(hash=random.randrange(1000000, 2000000))]).hash
+                items.append(test_forest.FakeShare(hash=i, previous_hash=x, target=2**240, max_target=2**240,
+                    desired_version=16, share_data=dict(stale_info=None)))
+            for item in math.shuffled(items):
+                t.add(item)
+                if random.randrange(2):
+                    share_hash = random.choice(list(t.items))
+                    if share_hash not in t.verified.items:
+                        t.verified.add(t.items[share_hash])
+                if random.randrange(4) == 0:
+                    share_hash = random.choice(list(t.items))
+                    try:
+                        if share_hash in t.verified.items:
+                            t.verified.remove(share_hash)
+                        t.remove(share_hash)
+                    except NotImplementedError:
+                        pass
+                assert t.unverified_heads == set(t.heads) - set(t.verified.heads)
+    
+    def test_think_desired(self):
+        shares = generate_shares(data.OkayTracker(testnet), 30, first_timestamp=int(time.time()) - 3600)
+        t = data.OkayTracker(testnet)
+        for share in shares[10:]:
+            t.add(share)
+        for i in xrange(2): # the second time the head hasn't changed
+            best, desired, decorated_heads, bad_peer_addresses = t.think(lambda block_hash: 0, None, None, {})
+            assert desired == [(None, shares[9].hash)]
+        for share in shares[5:10]:
+            t.add(share)
+        best, desired, decorated_heads, bad_peer_addresses = t.think(lambda block_hash: 0, None, None, {})
+        assert desired == [(None, shares[4].hash)]
+
+    def test_think_score_cache(self):
+        shares = generate_shares(data.OkayTracker(testnet), testnet.CHAIN_LENGTH + 10)
+        t = data.OkayTracker(testnet)
+        for share in shares:
+            t.add(share)
+            t.verified.add(share)
+        calls = []
+        def block_rel_height_func(block_hash):
+            calls.append(block_hash)
+            return 0
+        
+        assert t.think(block_rel_height_func, 1, None, {})[0] == shares[-1].hash
+        assert len(calls) == testnet.CHAIN_LENGTH//16
+        t.think(block_rel_height_func, 1, None, {})
+        assert len(calls) == testnet.CHAIN_LENGTH//16 # nothing changed
+        t.think(block_rel_height_func, 2, None, {})
+        assert len(calls) == 2*(testnet.CHAIN_LENGTH//16) # new block
+        
+        more = generate_shares(t, 1, shares[-1].hash)
+        t.verified.add(more[0])
+        assert t.think(block_rel_height_func, 2, None, {})[0] == more[0].hash
+        assert len(calls) == 3*(testnet.CHAIN_LENGTH//16) # new best head
+    
+    def test_think_max_checks(self):
+        shares = generate_shares(data.OkayTracker(testnet), 2*testnet.CHAIN_LENGTH + 10)
+        trackers = []
+        for max_checks in [None, 20]:
+            t = data.OkayTracker(testnet)
+            for share in shares:
+                t.add(share)
+            t.verified.add(shares[-1])
+            t.max_checks = max_checks
+            trackers.append(t)
+        
+        full, limited = trackers
+        full.think(lambda block_hash: 0, None, None, {})
+        assert full.verify_backlog == 0
+        assert len(full.verified.items) == testnet.CHAIN_LENGTH
+        backlogs = []
+        while True:
+            limited.think(lambda block_hash: 0, None, None, {})
+            backlogs.append(limited.verify_backlog)
+            if not limited.verify_backlog:
+                break
+        assert backlogs == [29, 9, 0]
+        assert set(limited.verified.items) == set(full.verified.items)
+    
+    def test_think_max_checks_unverified_heads(self):
+        t0 = data.OkayTracker(testnet)
+        shares = generate_shares(t0, testnet.CHAIN_LENGTH + 5)
+        forks = [generate_shares(t0, 1, shares[-1].hash)[0] for i in xrange(5)]
+        trackers = []
+        for max_checks in [None, 2]:
+            t = data.OkayTracker(testnet)
+            for share in shares + forks:
+                t.add(share)
+            t.max_checks = max_checks
+            trackers.append(t)
+        
+        full, limited = trackers
+        full.think(lambda block_hash: 0, None, None, {})
+        assert full.verify_backlog == 0
+        assert set(full.verified.heads) == set(fork.hash for fork in forks)
+        calls = 0
+        while True:
+            limited.think(lambda block_hash: 0, None, None, {})
+            calls += 1
+            if calls == 1:
+                assert limited.verify_backlog >= 3 # the heads that didn't fit
+                assert len(limited.verified.items) == 2
+            if not limited.verify_backlog:
+                break
+        assert calls > 3
+        assert set(limited.verified.items) == set(full.verified.items)
+    
+    def test_share_slots(self):
+        shares = generate_shares(data.OkayTracker(testnet), 10, pubkey_hashes=2)
+        loaded = [data.load_share(share.as_share(), testnet, None) for share in shares]
+        for share, share2 in zip(shares, loaded):
+            assert not hasattr(share2, '__dict__')
+            assert share2.contents == share.contents
+            assert share2.header == share.header
+            assert share2.as_share() == share.as_share()
+            assert share2.share_type is share.share_type
+        for share in loaded:
+            for share2 in loaded:
+                if share.new_script == share2.new_script:
+                    assert share.new_script is share2.new_script
+                    assert share.share_data['pubkey_hash'] is share2.share_data['pubkey_hash']
+        
+        pubkey_hashes = set(share.share_data['pubkey_hash'] for share in shares)
+        assert all(pubkey_hash in data._payees for pubkey_hash in pubkey_hashes)
+        del shares, loaded, share, share2
+        gc.collect() # the tracker generate_shares added them to is in reference cycles
+        assert not any(pubkey_hash in data._payees for pubkey_hash in pubkey_hashes) # dropped with the last share paying it
+    
+    def test_load_share_without_pow(self):
+        shares = generate_shares(data.OkayTracker(testnet), 5)
+        for share in shares:
+            share2 = data.load_share(share.as_share(), testnet, None, check_pow=False)
+            share2.set_pow_hash(share.pow_hash)
+            assert share2.pow_hash == share.pow_hash
+            share3 = data.load_share(share.as_share(), testnet, None, check_pow=False)
+            self.assertRaises(p2p.PeerMisbehavingError, share3.set_pow_hash, share.target + 1)
+
+class ShareStoreTest(trial_unittest.TestCase): # for flushLoggedErrors
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.prefix = os.path.join(self.dirname, 'shares.')
+        self.shares = generate_shares(data.OkayTracker(testnet), 30)
+    
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+    
+    def load(self, lazy=False):
+        shares, verified = {}, set()
+        ss = data.ShareStore(self.prefix, testnet, lambda share: shares.__setitem__(share.hash, share), verified.add, lazy=lazy)
+        return ss, shares, verified
+    
+    def test_binary_roundtrip(self):
+        ss, _, _ = self.load()
+        for share in self.shares:
+            ss.add_share(share)
+            ss.add_verified_hash(share.hash)
+        filename, = os.listdir(self.dirname)
+        assert data.is_binary_share_file(os.path.join(self.dirname, filename))
+        
+        ss2, shares, verified = self.load()
+        assert set(shares) == set(share.hash for share in self.shares)
+        assert verified == set(share.hash for share in self.shares)
+        for share in self.shares:
+            assert shares[share.hash].as_share() == share.as_share()
+    
+    def test_lazy(self):
+        ss, _, _ = self.load()
+        for share in self.shares:
+            ss.add_share(share)
+        ss2, shares, verified = self.load(lazy=True)
+        assert all(share._packed_contents is not None for share in shares.itervalues())
+        
+        tracker = data.OkayTracker(testnet)
+        for share in shares.itervalues():
+            tracker.add(share)
+        best = self.shares[-1].hash
+        assert tracker.get_height(best) == len(self.shares)
+        assert tracker.get_work(best) == sum(bitcoin_data.target_to_average_attempts(share.target) for share in self.shares)
+        assert all(share._packed_contents is not None for share in shares.itervalues()) # headers were enough
+        
+        full_tracker = data.OkayTracker(testnet)
+        for share in self.shares:
+            full_tracker.add(share)
+        args = self.shares[-5].hash, len(self.shares) - 4, 65535*2**256
+        assert tracker.get_cumulative_weights(*args) == full_tracker.get_cumulative_weights(*args) # views decode what they read
+        assert shares[self.shares[-5].hash].materialized and not shares[best].materialized
+        
+        lazy_share = shares[best]
+        assert lazy_share.as_share() == self.shares[-1].as_share()
+        assert not lazy_share.materialized
+        self.assertRaises(AttributeError, getattr, lazy_share, 'share_data') # only decoded by materialize
+        
+        assert tracker.materialize_shares(list(tracker.items)) == []
+        assert lazy_share.materialized
+        assert lazy_share.share_data == self.shares[-1].share_data
+        assert lazy_share.header == self.shares[-1].header
+        assert lazy_share.pow_hash == self.shares[-1].pow_hash
+        assert type(lazy_share) is type(self.shares[-1])
+        lazy_share.check(tracker)
+    
+    def test_lazy_bad_record(self):
+        headers = [share.as_share_header() for share in self.shares]
+        headers[20] = dict(headers[20], share=headers[21]['share']) # the contents of another share
+        shares = [data.load_share_header(header, testnet) for header in headers]
+        tracker = data.OkayTracker(testnet)
+        for share in shares:
+            tracker.add(share)
+            tracker.verified.add(share)
+        
+        assert not shares[20].materialize()
+        assert shares[20].hash == self.shares[20].hash and not shares[20].materialized # left as it was
+        self.assertRaises(AttributeError, getattr, shares[20], 'share_data')
+        self.assertRaises(ValueError, shares[20].need_contents)
+        
+        removed = tracker.materialize_shares([share.hash for share in shares])
+        assert set(removed) == set(share.hash for share in self.shares[20:]) # with the shares built on it
+        assert set(tracker.items) == set(tracker.verified.items) == set(share.hash for share in self.shares[:20])
+        assert all(share.materialized for share in shares[:20])
+    
+    def test_legacy(self):
+        with open(self.prefix + '0', 'wb') as f:
+            for share in self.shares:
+                f.write('%i %s\n' % (5, data.share_type.pack(share.as_share()).encode('hex')))
+                f.write('%i %x\n' % (2, share.hash))
+        ss, shares, verified = self.load()
+        assert set(shares) == verified == set(share.hash for share in self.shares)
+        
+        ss.add_share(generate_shares(data.OkayTracker(testnet), 1)[0])
+        assert sorted(os.listdir(self.dirname)) == ['shares.0', 'shares.1'] # doesn't append binary records to a text file
+        
+        legacy_size = os.path.getsize(self.prefix + '0')
+        assert ss.convert_legacy_files() == [self.prefix + '0']
+        assert ss.convert_legacy_files() == []
+        assert os.path.getsize(self.prefix + '0') < legacy_size*6//10
+        
+        ss2, shares2, verified2 = self.load()
+        assert set(shares2) == set(shares) | set([ss.known[self.prefix + '1'][0].copy().pop()])
+        assert verified2 == verified
+    
+    def test_truncated(self):
+        ss, _, _ = self.load()
+        for share in self.shares:
+            ss.add_share(share)
+        filename, = os.listdir(self.dirname)
+        with open(os.path.join(self.dirname, filename), 'rb+') as f:
+            f.truncate(os.path.getsize(os.path.join(self.dirname, filename)) - 10)
+        ss2, shares, verified = self.load()
+        assert set(shares) == set(share.hash for share in self.shares[:-1])
+        
+        ss2.add_share(self.shares[-1])
+        ss3, shares, verified = self.load()
+        assert set(shares) == set(share.hash for share in self.shares)
+    
+    def test_bad_header(self):
+        ss, _, _ = self.load()
+        for share in self.shares[:10]:
+            ss.add_share(share)
+        ss._close_tail()
+        for i, header in enumerate([data.SHARE_FILE_MAGIC, data.SHARE_FILE_MAGIC + '\x07']): # cut off and of an unknown version
+            with open(self.prefix + str(i + 1), 'wb') as f:
+                f.write(header)
+        ss2, shares, verified = self.load()
+        assert len(self.flushLoggedErrors(pack.EarlyEnd, ValueError)) == 2
+        assert set(shares) == set(share.hash for share in self.shares[:10])
+        ss2.add_share(self.shares[10]) # goes to a new file instead of after the broken header
+        ss3, shares, verified = self.load()
+        assert set(shares) == set(share.hash for share in self.shares[:11])
+        self.flushLoggedErrors(pack.EarlyEnd, ValueError)
+    
+    def test_bundle(self):
+        net = math.Object(**dict(testnet.__dict__, CHAIN_LENGTH=100, REAL_CHAIN_LENGTH=100)) # check needs 99 parents
+        shares = generate_shares(data.OkayTracker(net), 130, net=net)
+        data.write_share_bundle(os.path.join(self.dirname, 'bundle'), shares[10:])
+        imported = list(data.read_share_bundle(os.path.join(self.dirname, 'bundle'), net))
+        assert [share.as_share() for share in imported] == [share.as_share() for share in shares[10:]]
+        
+        ss, _, _ = self.load()
+        ss.add_shares(imported)
+        ss2, loaded, verified = self.load()
+        assert set(loaded) == set(share.hash for share in imported)
+        
+        tracker = data.OkayTracker(net)
+        for share in math.shuffled(imported):
+            tracker.add(share)
+        tracker.max_checks = 7
+        tracker.verify_shares([share.hash for share in imported])
+        backlogs = []
+        while True:
+            tracker.think(lambda block_hash: 0, None, None, {})
+            backlogs.append(tracker.verify_backlog)
+            if not tracker.verify_backlog:
+                break
+        assert len(backlogs) > 1 and backlogs[0] > backlogs[1]
+        assert set(tracker.verified.items) == set(share.hash for share in imported[net.CHAIN_LENGTH:])
+    
+    def test_forget(self):
+        ss, _, _ = self.load()
+        ss.MAX_FILE_SIZE = 1500
+        for share in self.shares:
+            ss.add_share(share)
+            ss.add_verified_hash(share.hash)
+        assert len(ss.known) > 3
+        first = min(ss.known, key=lambda filename: int(filename[len(self.prefix):]))
+        share_hashes, verified_hashes = ss.known[first]
+        for share_hash in share_hashes:
+            ss.forget_share(share_hash)
+        assert os.path.exists(first)
+        for share_hash in verified_hashes:
+            ss.forget_verified_share(share_hash)
+        assert not os.path.exists(first)
+        assert not any(ss.share_filenames.get(share_hash) == first for share_hash in share_hashes)
+        
+        ss.add_share(self.shares[0])
+        ss2, shares, verified = self.load()
+        assert set(shares) == set(ss.share_filenames)
+        assert verified == set(ss.verified_filenames)
+    
+    def test_compact(self):
+        ss, _, _ = self.load()
+        ss.MAX_FILE_SIZE = 1500
+        for share in self.shares:
+            ss.add_share(share)
+            ss.add_verified_hash(share.hash)
+        filenames = sorted(ss.known, key=lambda filename: int(filename[len(self.prefix):]))
+        assert len(filenames) > 3
+        for filename in filenames[:-1]:
+            share_hashes, verified_hashes = ss.known[filename]
+            for share_hash in list(share_hashes)[1:]:
+                ss.forget_share(share_hash)
+            for share_hash in verified_hashes:
+                ss.forget_verified_share(share_hash)
+        desired_shares, desired_verified = set(ss.share_filenames), set(ss.verified_filenames)
+        desired_shares = set(h for h in desired_shares if h in ss.known_desired[ss.share_filenames[h]][0])
+        desired_verified = set(h for h in desired_verified if h in ss.known_desired[ss.verified_filenames[h]][1])
+        
+        while ss.compact(10):
+            pass
+        assert not any(os.path.exists(filename) for filename in filenames[:-1])
+        
+        ss2, shares, verified = self.load()
+        assert set(shares) == desired_shares
+        assert verified == desired_verified
+
@@ -0,0 +1,74 @@
+from __future__ import division
+
+import random
+import unittest
+
+from p2pool import data, stats
+from p2pool.bitcoin import data as bitcoin_data
+from p2pool.test import test_data
+from p2pool.test.util import test_forest
+
+def get_kinds(x):
+    if isinstance(x, dict):
+        return sorted((get_kinds(k), get_kinds(v)) for k, v in x.iteritems())
+    if isinstance(x, (list, tuple)):
+        return map(get_kinds, x)
+    return 'int' if isinstance(x, (int, long)) else type(x).__name__
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.numpy = stats.numpy
+    
+    def tearDown(self):
+        stats.numpy = self.numpy
+    
+    def get_stats(self, func, *args):
+        # with NumPy, if it's installed, after checking that the plain loops give exactly the same
+        stats.numpy = None
+        res = func(*args)
+        if self.numpy is not None:
+            stats.numpy = self.numpy
+            res2 = func(*args)
+            assert res2 == res, (func.__name__, res, res2)
+            assert get_kinds(res2) == get_kinds(res), (func.__name__, res, res2) # no floats instead of integers
+        return res
+    
+    def test_stats(self):
+        t = data.OkayTracker(test_data.testnet)
+        for i in xrange(300):
+            t.add(test_forest.FakeShare(hash=i, previous_hash=random.choice([i - 1, i - 1, i - 2]) if i > 1 else None, timestamp=1000 + i*10 + random.randrange(-15, 15),
+                target=random.randrange(2**200, 2**215), max_target=2**245, desired_version=random.choice([16, 16, 17, 18, 2**70]),
+                share_data=dict(stale_info=random.choice([None, None, None, 'orphan', 'doa', 'unk5']), pubkey_hash=random.randrange(10))))
+        best_chain = data.BestChain(t, 100)
+        for i in xrange(50):
+            share_hash = random.randrange(20, 300)
+            best_chain.set_head(share_hash)
+            height = t.get_height(share_hash)
+            lookbehinds = [random.randrange(2, height + 1) for j in xrange(3)]
+            chain = list(t.get_chain(share_hash, max(lookbehinds)))
+            
+            for lookbehind, (rate, stale_prop) in self.get_stats(stats.get_pool_rates, best_chain, lookbehinds).iteritems():
+                assert rate == data.get_pool_attempts_per_second(t, share_hash, lookbehind)
+                assert stale_prop == data.get_average_stale_prop(t, share_hash, lookbehind)
+            
+            user_stats = self.get_stats(stats.get_user_stats, best_chain, height - 1)
+            assert dict((pubkey_hash, stale_count/(count + stale_count)) for pubkey_hash, (count, stale_count, doa_count, work) in user_stats.iteritems()) == data.get_user_stale_props(t, share_hash, height)
+            for pubkey_hash, (count, stale_count, doa_count, work) in self.get_stats(stats.get_user_stats, best_chain, max(lookbehinds)).iteritems():
+                shares = [share for share in chain if share.share_data['pubkey_hash'] == pubkey_hash]
+                assert doa_count == sum(1 for share in shares if share.share_data['stale_info'] == 'doa')
+                assert work == sum(bitcoin_data.target_to_average_attempts(share.target) for share in shares)
+            
+            assert self.get_stats(stats.get_version_votes, best_chain, lookbehinds[0]) == data.get_desired_version_counts(t, share_hash, lookbehinds[0])
+            
+            history = self.get_stats(stats.get_difficulty_history, best_chain, max(lookbehinds), 60)
+            assert [start for start, count, difficulty in history] == sorted(set(share.timestamp//60*60 for share in chain))
+            assert sum(count for start, count, difficulty in history) == len(chain)
+            for start, count, difficulty in history:
+                difficulties = [bitcoin_data.target_to_difficulty(share.target) for share in chain if start <= share.timestamp < start + 60]
+                assert abs(difficulty/(sum(difficulties)/len(difficulties)) - 1) < 1e-6
+            
+            intervals = sorted(a.timestamp - b.timestamp for a, b in zip(chain, chain[1:]))
+            mean, (low, median, high) = self.get_stats(stats.get_share_intervals, best_chain, max(lookbehinds))
+            assert mean == sum(intervals)/len(intervals)
+            assert low <= median <= high
+            assert median in intervals and sum(1 for x in intervals if x < median) <= len(intervals)//2 <= sum(1 for x in intervals if x <= median)
@@ -1,3 +1,4 @@
+import json
 import random
 import unittest
 
@@ -34,6 +35,14 @@ class DumbTracker(object):
     def tails(self):
         return dict((x, set(y for y in self.items if self.get_last(y) == x and y not in self.reverse)) for x in self.reverse if x not in self.items)
     
+    @property
+    def bottoms(self):
+        res = {}
+        for head in self.heads:
+            height, last = self.get_height_and_last(head)
+            res.setdefault(self.get_nth_parent_hash(head, height - 1), set()).add(head)
+        return res
+    
     def get_nth_parent_hash(self, item_hash, n):
         for i in xrange(n):
             item_hash = self.items[item_hash].previous_hash
@@ -76,6 +85,9 @@ class FakeShare(object):
         for k, v in kwargs.iteritems():
             setattr(self, k, v)
         self._attrs = kwargs
+    
+    def need_contents(self):
+        return self
 
 def test_tracker(self):
     t = DumbTracker(self.items.itervalues())
@@ -84,6 +96,8 @@ def test_tracker(self):
     assert self.reverse == t.reverse, (self.reverse, t.reverse)
     assert self.heads == t.heads, (self.heads, t.heads)
     assert self.tails == t.tails, (self.tails, t.tails)
+    assert dict((bottom_hash, heads) for bottom_hash, (bottom_hash2, heads) in self._bottoms.iteritems() if bottom_hash2 == bottom_hash) == t.bottoms, (self._bottoms, t.bottoms)
+    assert dict((head, bottom_hash) for head, (bottom_hash, heads) in self._head_bottoms.iteritems() if head in heads) == dict((head, bottom_hash) for bottom_hash, heads in t.bottoms.iteritems() for head in heads)
     
     if random.random() < 0.9:
         return
@@ -132,6 +146,39 @@ class Test(unittest.TestCase):
             res = t.get_nth_parent_hash(a, b)
             assert res == a - b, (a, b, res)
     
+    def test_ancestor_index(self):
+        for ii in xrange(10):
+            items = []
+            for i in xrange(random.randrange(1, 300)):
+                x = random.choice(items[-5:] + [FakeShare(hash=None)]).hash
+                items.append(FakeShare(hash=i, previous_hash=x))
+            
+            # parents arrive after children, joining chains, and tails get removed from under them
+            t = forest.Tracker()
+            for item in math.shuffled(items):
+                t.add(item)
+                if random.randrange(5) == 0:
+                    try:
+                        t.remove(random.choice(list(t.items)))
+                    except NotImplementedError:
+                        pass
+                t2 = DumbTracker(t.items.itervalues())
+                for i in xrange(5 if t.items else 0):
+                    a = random.choice(list(t.items))
+                    b = random.randrange(t2.get_height(a) + 1)
+                    assert t.get_nth_parent_hash(a, b) == t2.get_nth_parent_hash(a, b)
+                # every row already reaches as far back as the tracker does
+                jumps = t.get_nth_parent_hash._jumps
+                assert set(jumps) == set(t.items)
+                for a, row in jumps.iteritems():
+                    height = t2.get_height(a)
+                    assert 2**(len(row) - 1) <= height < 2**len(row), (a, height, row)
+                    assert row == [t2.get_nth_parent_hash(a, 2**k) for k in xrange(len(row))]
+                ends = {}
+                for a, row in jumps.iteritems():
+                    ends.setdefault((row[-1], len(row) - 1), set()).add(a)
+                assert t.get_nth_parent_hash._ends == ends
+    
     def test_tracker2(self):
         for ii in xrange(20):
             t = generate_tracker_random(random.randrange(100))
@@ -192,3 +239,117 @@ class Test(unittest.TestCase):
                     else:
                         break
                 test_tracker(t)
+    
+    def test_remove_many(self):
+        # 3's and 4's cached deltas end at 0, which arrives after them. removing 0 in the same batch as 4 has to cope
+        # with 4's delta still being there
+        t = forest.Tracker(FakeShare(hash=i, previous_hash=i - 1) for i in [1, 2, 3])
+        t.add(FakeShare(hash=4, previous_hash=0))
+        assert (t.get_height(3), t.get_height(4)) == (3, 1)
+        t.add(FakeShare(hash=0, previous_hash=None))
+        assert t.get_height(1) == 2
+        t.remove_many([4, 0])
+        test_tracker(t)
+        assert t.get_height_and_last(3) == (3, 0)
+        
+        for ii in xrange(20):
+            t = generate_tracker_random(random.randrange(1, 100))
+            t2 = DumbTracker(t.items.itervalues())
+            events = []
+            t.removed.watch(events.append)
+            while t.items:
+                for item_hash in random.sample(t.items, min(len(t.items), 10)):
+                    t.get_height(item_hash) # caches deltas that the removals have to move or drop
+                
+                # heads and tails, each one as of the removals before it
+                batch = []
+                for i in xrange(random.randrange(1, 10)):
+                    removable = [item_hash for item_hash in t2.items if item_hash not in t2.reverse or t2.items[item_hash].previous_hash not in t2.items]
+                    if not removable:
+                        break
+                    batch.append(random.choice(removable))
+                    t2.remove(batch[-1])
+                
+                t.remove_many(batch)
+                assert [[item.hash for item in items] for items in events] == [batch]
+                del events[:]
+                test_tracker(t)
+                for item_hash in t.items:
+                    assert t.get_height_and_last(item_hash) == t2.get_height_and_last(item_hash)
+                    height = t2.get_height(item_hash)
+                    assert t.get_nth_parent_hash(item_hash, height) == t2.get_nth_parent_hash(item_hash, height)
+                assert set(t.get_nth_parent_hash._jumps) == set(t.items)
+    
+    def test_attributedelta(self):
+        delta_type = forest.get_attributedelta_type(dict(forest.AttributeDelta.attrs,
+            work=lambda item: item.work,
+            votes=lambda item: math.SumDict({item.vote: item.work}),
+        ))
+        a = delta_type.from_element(FakeShare(hash=2, previous_hash=1, work=5, vote='x'))
+        b = delta_type.from_element(FakeShare(hash=1, previous_hash=0, work=7, vote='y'))
+        assert (a.head, a.tail, a.height, a.work, a.votes) == (2, 1, 1, 5, {'x': 5})
+        c = a + b
+        assert (c.head, c.tail, c.height, c.work, c.votes) == (2, 0, 2, 12, {'x': 5, 'y': 7})
+        for d, expected in [(c - a, (1, 0, 1, 7, {'y': 7})), (c - b, (2, 1, 1, 5, {'x': 5})), (c - c, (0, 0, 0, 0, {}))]:
+            assert (d.head, d.tail, d.height, d.work, d.votes) == expected
+        self.assertRaises(AssertionError, lambda: b + a)
+        self.assertRaises(AssertionError, lambda: b - a)
+        assert (c + delta_type.get_none(0)).votes == c.votes
+        e = delta_type(head=2, tail=0, height=2, work=12, votes=math.SumDict(x=5, y=7))
+        assert repr(e) == repr(c)
+    
+    def test_snapshot(self):
+        for ii in xrange(20):
+            t = generate_tracker_random(random.randrange(1, 100))
+            snapshot = json.loads(json.dumps(t.get_snapshot()))
+            
+            t2 = forest.Tracker()
+            assert t2.load_snapshot(snapshot, t.items) == set(t.items)
+            test_tracker(t2)
+            for item_hash in t.items:
+                assert t2.get_height_and_last(item_hash) == t.get_height_and_last(item_hash)
+            
+            # items missing since the snapshot was taken are cut off, new ones get added normally
+            items = dict((item_hash, item) for item_hash, item in t.items.iteritems() if random.randrange(4))
+            items[1000] = FakeShare(hash=1000, previous_hash=random.choice(t.items.keys()))
+            t3 = forest.Tracker()
+            t3.load_snapshot(snapshot, items)
+            test_tracker(t3)
+            t3.add(items[1000])
+            test_tracker(t3)
+            t4 = DumbTracker(items.itervalues())
+            for item_hash in items:
+                assert t3.get_height_and_last(item_hash) == t4.get_height_and_last(item_hash)
+            
+            bad_snapshot = dict(snapshot, deltas=[x[:2] + [x[2] + 1] for x in snapshot['deltas']])
+            t5 = forest.Tracker()
+            self.assertRaises(ValueError, t5.load_snapshot, bad_snapshot, t.items)
+            assert not t5.items
+    
+    def test_view_snapshot(self):
+        delta_type = forest.get_attributedelta_type(dict(forest.AttributeDelta.attrs,
+            votes=lambda item: math.SumDict({item.hash % 3: 1}),
+        ))
+        for ii in xrange(20):
+            t = generate_tracker_random(random.randrange(1, 100))
+            view = forest.TrackerView(t, delta_type)
+            queried = random.sample(t.items.keys(), random.randrange(len(t.items) + 1))
+            for item_hash in queried:
+                view.get_delta_to_last(item_hash)
+            snapshot = json.loads(json.dumps(view.get_snapshot(cached_only=True)))
+            assert set(x[0] for x in snapshot['deltas']) >= set(queried)
+            assert len(json.loads(json.dumps(view.get_snapshot()))['deltas']) == len(t.items)
+            
+            # entries for chains that were cut off since are left out, the rest are used as they are
+            items = [item for item in t.items.itervalues() if random.randrange(8)]
+            t2 = forest.Tracker(items)
+            view2 = forest.TrackerView(t2, delta_type)
+            loaded = view2.load_snapshot(snapshot)
+            assert loaded <= set(x[0] for x in snapshot['deltas'])
+            if len(items) == len(t.items):
+                assert loaded == set(x[0] for x in snapshot['deltas'])
+            view3 = forest.TrackerView(t2, delta_type)
+            for item_hash in t2.items:
+                delta2, delta3 = view2.get_delta_to_last(item_hash), view3.get_delta_to_last(item_hash)
+                assert (delta2.tail, delta2.height, delta2.votes) == (delta3.tail, delta3.height, delta3.votes)
+            self.assertRaises(ValueError, view2.load_snapshot, snapshot)
@@ -4,7 +4,7 @@ forest data structure
 
 import itertools
 
-from p2pool.util import skiplist, variable
+from p2pool.util import math, skiplist, variable
 
 
 class TrackerSkipList(skiplist.SkipList):
@@ -12,80 +12,148 @@ class TrackerSkipList(skiplist.SkipList):
         skiplist.SkipList.__init__(self)
         self.tracker = tracker
         
-        self.tracker.removed.watch_weakref(self, lambda self, item: self.forget_item(item.hash))
+        self.tracker.removed.watch_weakref(self, lambda self, items: [self.forget_item(item.hash) for item in items])
     
     def previous(self, element):
         return self.tracker._delta_type.from_element(self.tracker.items[element]).tail
 
 
-class DistanceSkipList(TrackerSkipList):
-    def get_delta(self, element):
-        return element, 1, self.previous(element)
+class AncestorIndex(object):
+    '''
+    get_nth_parent_hash by binary lifting: each item's row holds the hashes of
+    its 1st, 2nd, 4th, 8th, ... ancestors, as far back as the tracker reaches.
+    rows are built from the parent's row when an item is added, and the rows
+    above it are extended then too, so a lookup always takes one jump per set
+    bit of n.
+    '''
     
-    def combine_deltas(self, (from_hash1, dist1, to_hash1), (from_hash2, dist2, to_hash2)):
-        if to_hash1 != from_hash2:
-            raise AssertionError()
-        return from_hash1, dist1 + dist2, to_hash2
+    def __init__(self, tracker):
+        self.tracker = tracker
+        self._jumps = {} # item hash -> [1st ancestor hash, 2nd ancestor hash, 4th ancestor hash, ...]
+        self._ends = {} # (hash, k) -> set of hashes of items whose row ends with that hash as its kth entry
+        
+        self.tracker.added.watch_weakref(self, lambda self, item: self._add(item))
+        self.tracker.removed.watch_weakref(self, lambda self, items: self._remove(items))
     
-    def initial_solution(self, start, (n,)):
-        return 0, start
+    def _set_end(self, item_hash, old_end, new_end):
+        if old_end is not None:
+            ends = self._ends[old_end]
+            ends.remove(item_hash)
+            if not ends:
+                self._ends.pop(old_end)
+        if new_end is not None:
+            self._ends.setdefault(new_end, set()).add(item_hash)
     
-    def apply_delta(self, (dist1, to_hash1), (from_hash2, dist2, to_hash2), (n,)):
-        if to_hash1 != from_hash2:
-            raise AssertionError()
-        return dist1 + dist2, to_hash2
+    def _add(self, item):
+        item_hash = self.tracker._delta_type.get_head(item)
+        self._jumps[item_hash] = []
+        self._extend(item_hash, [self.tracker._delta_type.get_tail(item)])
+    
+    def _extend(self, item_hash, new_jumps):
+        # a row can only grow after the row of the item its last entry points to does, so growth is passed up
+        # through _ends, only ever visiting rows that get longer
+        jumps, ends = self._jumps, self._ends
+        pending = [(item_hash, new_jumps)]
+        while pending:
+            item_hash, new_jumps = pending.pop()
+            row = jumps[item_hash]
+            start = len(row)
+            row.extend(new_jumps)
+            while row[-1] in jumps and len(jumps[row[-1]]) >= len(row):
+                row.append(jumps[row[-1]][len(row) - 1])
+            self._set_end(item_hash, (row[start - 1], start - 1) if start else None, (row[-1], len(row) - 1))
+            for k in xrange(start, len(row)):
+                if (item_hash, k) in ends:
+                    pending.extend((child_hash, [row[k]]) for child_hash in ends[item_hash, k])
+    
+    def _remove(self, items):
+        # in the order they were removed in, going by the rows rather than the tracker, which already lacks all of them
+        for item in items:
+            item_hash = self.tracker._delta_type.get_head(item)
+            row = self._jumps.pop(item_hash)
+            self._set_end(item_hash, (row[-1], len(row) - 1), None)
+            
+            if row[0] in self._jumps:
+                continue
+            # it was a tail, so the items above it lose the entries that reached past it. those all point at its
+            # parent and are the last ones in their rows, but other children of that parent have some too
+            for k in itertools.count(1):
+                ends = self._ends.get((row[0], k))
+                if not ends:
+                    break
+                for end_hash in list(ends):
+                    if self(end_hash, 2**k - 1) == item_hash:
+                        end_row = self._jumps[end_hash]
+                        end_row.pop()
+                        self._set_end(end_hash, (row[0], k), (end_row[-1], k - 1))
+    
+    def __call__(self, item_hash, n):
+        assert n >= 0
+        k = 0
+        try:
+            while n:
+                if n & 1:
+                    item_hash = self._jumps[item_hash][k]
+                n >>= 1
+                k += 1
+        except IndexError: # reaches past the tracker, like a missing item_hash
+            raise KeyError(item_hash)
+        return item_hash
+
+_attributedelta_template = '''
+class AttributeDelta(object):
+    __slots__ = ['head', 'tail', %(names)s]
+    
+    def __init__(self, head, tail, %(args)s):
+        self.head, self.tail, %(fields)s = head, tail, %(args)s
+    
+    @classmethod
+    def get_none(cls, element_id):
+        return cls(element_id, element_id, %(zeros)s)
+    
+    @classmethod
+    def from_element(cls, item):
+        return cls(item.hash, item.previous_hash, %(funcs)s)
     
-    def judge(self, (dist, hash), (n,)):
-        if dist > n:
-            return 1
-        elif dist == n:
-            return 0
+    @staticmethod
+    def get_head(item):
+        return item.hash
+    
+    @staticmethod
+    def get_tail(item):
+        return item.previous_hash
+    
+    def __add__(self, other):
+        assert self.tail == other.head
+        return self.__class__(self.head, other.tail, %(sums)s)
+    
+    def __sub__(self, other):
+        if self.head == other.head:
+            return self.__class__(other.tail, self.tail, %(differences)s)
+        elif self.tail == other.tail:
+            return self.__class__(self.head, other.head, %(differences)s)
         else:
-            return -1
+            raise AssertionError()
     
-    def finalize(self, (dist, hash), (n,)):
-        assert dist == n
-        return hash
+    def __repr__(self):
+        return '%%s(%%r, %%r%%s)' %% (self.__class__, self.head, self.tail, ''.join(', %%s=%%r' %% (k, getattr(self, k)) for k in sorted(self.attrs)))
+'''
 
 def get_attributedelta_type(attrs): # attrs: {name: func}
-    class ProtoAttributeDelta(object):
-        __slots__ = ['head', 'tail'] + attrs.keys()
-        
-        @classmethod
-        def get_none(cls, element_id):
-            return cls(element_id, element_id, **dict((k, 0) for k in attrs))
-        
-        @classmethod
-        def from_element(cls, item):
-            return cls(item.hash, item.previous_hash, **dict((k, v(item)) for k, v in attrs.iteritems()))
-        
-        @staticmethod
-        def get_head(item):
-            return item.hash
-        
-        @staticmethod
-        def get_tail(item):
-            return item.previous_hash
-        
-        def __init__(self, head, tail, **kwargs):
-            self.head, self.tail = head, tail
-            for k, v in kwargs.iteritems():
-                setattr(self, k, v)
-        
-        def __add__(self, other):
-            assert self.tail == other.head
-            return self.__class__(self.head, other.tail, **dict((k, getattr(self, k) + getattr(other, k)) for k in attrs))
-        
-        def __sub__(self, other):
-            if self.head == other.head:
-                return self.__class__(other.tail, self.tail, **dict((k, getattr(self, k) - getattr(other, k)) for k in attrs))
-            elif self.tail == other.tail:
-                return self.__class__(self.head, other.head, **dict((k, getattr(self, k) - getattr(other, k)) for k in attrs))
-            else:
-                raise AssertionError()
-        
-        def __repr__(self):
-            return '%s(%r, %r%s)' % (self.__class__, self.head, self.tail, ''.join(', %s=%r' % (k, getattr(self, k)) for k in attrs))
+    # the class is generated so that the arithmetic, which get_delta_to_last does a lot of, works on fixed positional
+    # fields instead of building a kwargs dict for every new delta
+    names = sorted(attrs)
+    namespace = dict(('_func_' + k, v) for k, v in attrs.iteritems())
+    exec _attributedelta_template % dict(
+        names=', '.join(repr(k) for k in names),
+        args=', '.join(names),
+        fields=', '.join('self.' + k for k in names),
+        zeros=', '.join('0' for k in names),
+        funcs=', '.join('_func_%s(item)' % (k,) for k in names),
+        sums=', '.join('self.%s + other.%s' % (k, k) for k in names),
+        differences=', '.join('self.%s - other.%s' % (k, k) for k in names),
+    ) in namespace
+    ProtoAttributeDelta = namespace['AttributeDelta']
     ProtoAttributeDelta.attrs = attrs
     return ProtoAttributeDelta
 
@@ -107,17 +175,20 @@ class TrackerView(object):
         
         self._tracker.remove_special.watch_weakref(self, lambda self, item: self._handle_remove_special(item))
         self._tracker.remove_special2.watch_weakref(self, lambda self, item: self._handle_remove_special2(item))
-        self._tracker.removed.watch_weakref(self, lambda self, item: self._handle_removed(item))
+        self._tracker.removed.watch_weakref(self, lambda self, items: self._handle_removed(items))
     
     def _handle_remove_special(self, item):
-        delta = self._delta_type.from_element(item)
-        
-        if delta.tail not in self._reverse_delta_refs:
+        if self._delta_type.get_tail(item) not in self._reverse_delta_refs:
             return
         
+        delta = self._delta_type.from_element(item)
+        
         # move delta refs referencing children down to this, so they can be moved up in one step
         for x in list(self._reverse_deltas.get(self._reverse_delta_refs.get(delta.head, object()), set())):
-            self.get_last(x)
+            if x in self._tracker.items:
+                self.get_last(x)
+            else: # removed earlier in the same remove_many, so removed hasn't been fired for it yet
+                self._forget(x)
         
         assert delta.head not in self._reverse_delta_refs, list(self._reverse_deltas.get(self._reverse_delta_refs.get(delta.head, object()), set()))
         
@@ -135,24 +206,26 @@ class TrackerView(object):
         self._reverse_delta_refs[delta.head] = ref
     
     def _handle_remove_special2(self, item):
-        delta = self._delta_type.from_element(item)
+        tail = self._delta_type.get_tail(item)
         
-        if delta.tail not in self._reverse_delta_refs:
+        if tail not in self._reverse_delta_refs:
             return
         
-        ref = self._reverse_delta_refs.pop(delta.tail)
+        ref = self._reverse_delta_refs.pop(tail)
         del self._delta_refs[ref]
         
         for x in self._reverse_deltas.pop(ref):
             del self._deltas[x]
     
-    def _handle_removed(self, item):
-        delta = self._delta_type.from_element(item)
-        
+    def _handle_removed(self, items):
+        for item in items:
+            self._forget(self._delta_type.get_head(item))
+    
+    def _forget(self, head):
         # delete delta entry and ref if it is empty
-        if delta.head in self._deltas:
-            delta1, ref = self._deltas.pop(delta.head)
-            self._reverse_deltas[ref].remove(delta.head)
+        if head in self._deltas:
+            delta1, ref = self._deltas.pop(head)
+            self._reverse_deltas[ref].remove(head)
             if not self._reverse_deltas[ref]:
                 del self._reverse_deltas[ref]
                 delta2 = self._delta_refs.pop(ref)
@@ -205,8 +278,25 @@ class TrackerView(object):
         self._deltas[item_hash] = delta - ref_delta, ref
         self._reverse_deltas.setdefault(ref, set()).add(item_hash)
     
+    def _load_deltas(self, deltas):
+        # bulk _set_delta for an empty view. deltas: item_hash -> delta to its last
+        assert not self._deltas
+        for item_hash, delta in deltas.iteritems():
+            if delta.tail not in self._reverse_delta_refs:
+                ref = self._ref_generator.next()
+                self._delta_refs[ref] = self._delta_type.get_none(delta.tail)
+                self._reverse_delta_refs[delta.tail] = ref
+            ref = self._reverse_delta_refs[delta.tail]
+            self._deltas[item_hash] = delta, ref # delta - get_none(delta.tail) == delta
+            self._reverse_deltas.setdefault(ref, set()).add(item_hash)
+    
     def get_delta_to_last(self, item_hash):
         assert isinstance(item_hash, (int, long, type(None)))
+        if item_hash in self._deltas:
+            delta1, ref = self._deltas[item_hash]
+            delta2 = self._delta_refs[ref]
+            if delta2.tail not in self._tracker.items:
+                return delta1 + delta2 # already reaches the last, so there's no path to compress
         delta = self._delta_type.get_none(item_hash)
         updates = []
         while delta.tail in self._tracker.items:
@@ -220,6 +310,58 @@ class TrackerView(object):
     def get_delta(self, item, ancestor):
         assert self._tracker.is_child_of(ancestor, item)
         return self.get_delta_to_last(item) - self.get_delta_to_last(ancestor)
+    
+    def get_chain_delta(self, item_hash, length):
+        # sum over the items get_chain(item_hash, length) yields
+        return self.get_delta(item_hash, self._tracker.get_nth_parent_hash(item_hash, length))
+    
+    def get_snapshot(self, cached_only=False):
+        '''returns a JSON-able description of every item's delta to its last. with cached_only, only of the items whose
+        delta to the last was already worked out, for views whose attributes are expensive to compute'''
+        attrs = sorted(self._delta_type.attrs)
+        res = []
+        for item_hash in self._tracker.items:
+            if item_hash in self._deltas: # read cached deltas directly when they reach the last, avoiding delta arithmetic
+                delta1, ref = self._deltas[item_hash]
+                delta2 = self._delta_refs[ref]
+                if delta2.tail not in self._tracker.items:
+                    res.append([item_hash, delta2.tail] + [_encode_value(getattr(delta1, k) + getattr(delta2, k)) for k in attrs])
+                    continue
+            if cached_only:
+                continue
+            delta = self.get_delta_to_last(item_hash)
+            res.append([item_hash, delta.tail] + [_encode_value(getattr(delta, k)) for k in attrs])
+        return dict(attrs=attrs, deltas=res)
+    
+    def load_snapshot(self, snapshot):
+        '''fills an empty view of a tracker that already has the items with get_snapshot's deltas, without computing
+        the attributes of any item. entries that don't agree with the tracker's own deltas on the last and the
+        attributes both have, like ones for chains that were cut off since, are left out. returns the set of item
+        hashes whose deltas were loaded'''
+        if self._deltas:
+            raise ValueError('view not empty')
+        attrs = sorted(self._delta_type.attrs)
+        if snapshot['attrs'] != attrs:
+            raise ValueError('snapshot has different delta attributes')
+        common = [k for k in attrs if k in self._tracker._delta_type.attrs]
+        deltas = {}
+        for x in snapshot['deltas']:
+            item_hash, last, vals = x[0], x[1], dict(zip(attrs, x[2:]))
+            if item_hash not in self._tracker.items:
+                continue
+            tracker_delta = self._tracker.get_delta_to_last(item_hash)
+            if last != tracker_delta.tail or any(vals[k] != getattr(tracker_delta, k) for k in common):
+                continue
+            deltas[item_hash] = self._delta_type(item_hash, last, **dict((k, _decode_value(v)) for k, v in vals.iteritems()))
+        self._load_deltas(deltas)
+        return set(deltas)
+
+def _encode_value(value):
+    # SumDict attributes as lists of pairs, since JSON objects only have string keys
+    return sorted(value.iteritems()) if isinstance(value, dict) else value
+
+def _decode_value(value):
+    return math.SumDict(value) if isinstance(value, list) else value
 
 class Tracker(object):
     def __init__(self, items=[], delta_type=AttributeDelta):
@@ -228,13 +370,15 @@ class Tracker(object):
         
         self.heads = {} # head hash -> tail_hash
         self.tails = {} # tail hash -> set of head hashes
+        self._bottoms = {} # hash of an item whose parent is a tail -> [that hash, set of hashes of the heads above it]
+        self._head_bottoms = {} # head hash -> its entry in _bottoms
         
         self.added = variable.Event()
         self.remove_special = variable.Event()
         self.remove_special2 = variable.Event()
-        self.removed = variable.Event()
+        self.removed = variable.Event() # fired with a list of the items removed by one remove or remove_many call
         
-        self.get_nth_parent_hash = DistanceSkipList(self)
+        self.get_nth_parent_hash = AncestorIndex(self)
         
         self._delta_type = delta_type
         self._default_view = TrackerView(self, delta_type)
@@ -261,8 +405,20 @@ class Tracker(object):
         
         if delta.tail in self.heads:
             tail = self.heads.pop(delta.tail)
+            bottom = self._head_bottoms.pop(delta.tail)
+            bottom[1].remove(delta.tail)
         else:
             tail = self.get_last(delta.tail)
+            if delta.tail in self.items:
+                bottom = self._bottoms[self.get_nth_parent_hash(delta.tail, self.get_height(delta.tail) - 1)]
+            else:
+                bottom = self._bottoms[delta.head] = [delta.head, set()]
+        
+        for child in self.reverse.get(delta.head, set()):
+            self._bottoms.pop(child) # their heads are all in heads
+        bottom[1].update(heads)
+        for head in heads:
+            self._head_bottoms[head] = bottom
         
         self.items[delta.head] = item
         self.reverse.setdefault(delta.tail, set()).add(delta.head)
@@ -277,6 +433,20 @@ class Tracker(object):
         self.added.happened(item)
     
     def remove(self, item_hash):
+        self.remove_many([item_hash])
+    
+    def remove_many(self, item_hashes):
+        '''removes the items in order, each of which has to be a head or a tail by the time it's removed, and then fires
+        removed once for all of them'''
+        items = []
+        try:
+            for item_hash in item_hashes:
+                items.append(self._remove_item(item_hash))
+        finally:
+            if items:
+                self.removed.happened(items)
+    
+    def _remove_item(self, item_hash):
         assert isinstance(item_hash, (int, long, type(None)))
         if item_hash not in self.items:
             raise KeyError()
@@ -284,50 +454,157 @@ class Tracker(object):
         item = self.items[item_hash]
         del item_hash
         
-        delta = self._delta_type.from_element(item)
-        
-        children = self.reverse.get(delta.head, set())
-        
-        if delta.head in self.heads and delta.tail in self.tails:
-            tail = self.heads.pop(delta.head)
-            self.tails[tail].remove(delta.head)
-            if not self.tails[delta.tail]:
-                self.tails.pop(delta.tail)
-        elif delta.head in self.heads:
-            tail = self.heads.pop(delta.head)
-            self.tails[tail].remove(delta.head)
-            if self.reverse[delta.tail] != set([delta.head]):
+        head_hash, tail_hash = self._delta_type.get_head(item), self._delta_type.get_tail(item)
+        
+        children = self.reverse.get(head_hash, set())
+        
+        if head_hash in self.heads and tail_hash in self.tails:
+            tail = self.heads.pop(head_hash)
+            self.tails[tail].remove(head_hash)
+            if not self.tails[tail_hash]:
+                self.tails.pop(tail_hash)
+            self._bottoms.pop(self._head_bottoms.pop(head_hash)[0])
+        elif head_hash in self.heads:
+            tail = self.heads.pop(head_hash)
+            self.tails[tail].remove(head_hash)
+            bottom = self._head_bottoms.pop(head_hash)
+            bottom[1].remove(head_hash)
+            if self.reverse[tail_hash] != set([head_hash]):
                 pass # has sibling
             else:
-                self.tails[tail].add(delta.tail)
-                self.heads[delta.tail] = tail
-        elif delta.tail in self.tails and len(self.reverse[delta.tail]) <= 1:
-            heads = self.tails.pop(delta.tail)
+                self.tails[tail].add(tail_hash)
+                self.heads[tail_hash] = tail
+                bottom[1].add(tail_hash)
+                self._head_bottoms[tail_hash] = bottom
+        elif tail_hash in self.tails and len(self.reverse[tail_hash]) <= 1:
+            heads = self.tails.pop(tail_hash)
             for head in heads:
-                self.heads[head] = delta.head
-            self.tails[delta.head] = set(heads)
+                self.heads[head] = head_hash
+            self.tails[head_hash] = set(heads)
+            self._split_bottom(head_hash)
             
             self.remove_special.happened(item)
-        elif delta.tail in self.tails and len(self.reverse[delta.tail]) > 1:
-            heads = [x for x in self.tails[delta.tail] if self.is_child_of(delta.head, x)]
-            self.tails[delta.tail] -= set(heads)
-            if not self.tails[delta.tail]:
-                self.tails.pop(delta.tail)
+        elif tail_hash in self.tails and len(self.reverse[tail_hash]) > 1:
+            heads = self._bottoms[head_hash][1]
+            self.tails[tail_hash] -= heads
+            if not self.tails[tail_hash]:
+                self.tails.pop(tail_hash)
             for head in heads:
-                self.heads[head] = delta.head
-            assert delta.head not in self.tails
-            self.tails[delta.head] = set(heads)
+                self.heads[head] = head_hash
+            assert head_hash not in self.tails
+            self.tails[head_hash] = set(heads)
+            self._split_bottom(head_hash)
             
             self.remove_special2.happened(item)
         else:
             raise NotImplementedError()
         
-        self.items.pop(delta.head)
-        self.reverse[delta.tail].remove(delta.head)
-        if not self.reverse[delta.tail]:
-            self.reverse.pop(delta.tail)
+        self.items.pop(head_hash)
+        self.reverse[tail_hash].remove(head_hash)
+        if not self.reverse[tail_hash]:
+            self.reverse.pop(tail_hash)
         
-        self.removed.happened(item)
+        return item
+    
+    def _split_bottom(self, item_hash):
+        # item_hash is a bottom that is being removed, so its children become the bottoms of its heads. walks up from
+        # every child a step at a time until only one walk is left, whose child keeps item_hash's entry along with the
+        # heads that weren't found, so this takes time proportional to the smaller subtrees
+        bottom = self._bottoms.pop(item_hash)
+        children = self.reverse[item_hash]
+        found = dict((child, set()) for child in children)
+        stacks = dict((child, [child]) for child in children)
+        while len(stacks) > 1:
+            for child, stack in stacks.items():
+                x = stack.pop()
+                if x in self.reverse:
+                    stack.extend(self.reverse[x])
+                else:
+                    found[child].add(x)
+                if not stack:
+                    del stacks[child]
+        for child in children:
+            if child in stacks:
+                bottom[0] = child
+                self._bottoms[child] = bottom
+                continue
+            bottom[1] -= found[child]
+            self._bottoms[child] = new_bottom = [child, found[child]]
+            for head in found[child]:
+                self._head_bottoms[head] = new_bottom
+    
+    def get_snapshot(self):
+        '''returns a JSON-able description of every item's delta to its last, which together with the items
+        themselves is enough for load_snapshot to rebuild the tracker'''
+        return self._default_view.get_snapshot()
+    
+    def load_snapshot(self, snapshot, items):
+        '''adds the items (hash -> item) that are in the snapshot without walking their chains to compute their deltas.
+        items that aren't in the snapshot aren't added, and snapshot entries without an item are cut off. raises
+        ValueError and leaves the tracker untouched if the snapshot doesn't agree with the items. returns the set of
+        added item hashes'''
+        if self.items:
+            raise ValueError('tracker not empty')
+        attrs = sorted(self._delta_type.attrs)
+        if snapshot['attrs'] != attrs:
+            raise ValueError('snapshot has different delta attributes')
+        values = dict((x[0], (x[1], x[2:])) for x in snapshot['deltas']) # item hash -> (last, attribute values)
+        
+        present = set(item_hash for item_hash in values if item_hash in items)
+        tails = dict((item_hash, self._delta_type.get_tail(items[item_hash])) for item_hash in present)
+        
+        # check every entry against its item and its parent's entry
+        funcs = [self._delta_type.attrs[k] for k in attrs]
+        for item_hash in present:
+            item, tail = items[item_hash], tails[item_hash]
+            last, vals = values[item_hash]
+            if tail in values:
+                parent_last, parent_vals = values[tail]
+                expected = parent_last, [func(item) + v for func, v in zip(funcs, parent_vals)]
+            else:
+                expected = tail, [func(item) for func in funcs]
+            if (last, vals) != expected:
+                raise ValueError('snapshot disagrees with item %r' % (item_hash,))
+        
+        # find where each chain leaves the present items
+        cuts = {}
+        bottoms = {} # item hash -> last present item of its chain
+        for item_hash in present:
+            path = []
+            while item_hash in present and item_hash not in cuts:
+                path.append(item_hash)
+                item_hash = tails[item_hash]
+            if item_hash in present:
+                cut, bottom = cuts[item_hash], bottoms[item_hash]
+            else:
+                cut, bottom = item_hash, path[-1]
+            for x in path:
+                cuts[x] = cut
+                bottoms[x] = bottom
+        
+        for item_hash in present:
+            self.items[item_hash] = items[item_hash]
+            self.reverse.setdefault(tails[item_hash], set()).add(item_hash)
+        for item_hash in present:
+            if item_hash not in self.reverse:
+                self.heads[item_hash] = cuts[item_hash]
+                self.tails.setdefault(cuts[item_hash], set()).add(item_hash)
+                bottom = self._bottoms.setdefault(bottoms[item_hash], [bottoms[item_hash], set()])
+                bottom[1].add(item_hash)
+                self._head_bottoms[item_hash] = bottom
+        
+        deltas = {}
+        for item_hash in present:
+            last, vals = values[item_hash]
+            if cuts[item_hash] in values: # chain continued in the snapshot past what's present, so subtract that part
+                vals = [v - cut_v for v, cut_v in zip(vals, values[cuts[item_hash]][1])]
+            deltas[item_hash] = self._delta_type(item_hash, cuts[item_hash], **dict(zip(attrs, vals)))
+        self._default_view._load_deltas(deltas)
+        
+        for item_hash in sorted(present, key=lambda item_hash: deltas[item_hash].height): # parents first, as with add
+            self.added.happened(self.items[item_hash])
+        
+        return present
     
     def get_chain(self, start_hash, length):
         assert length <= self.get_height(start_hash)
@@ -355,7 +632,13 @@ class SubsetTracker(Tracker):
             assert self._delta_type.get_head(item) in self._subset_of.items
         Tracker.add(self, item)
     
-    def remove(self, item_hash):
+    def remove_many(self, item_hashes):
+        if self._subset_of is not None:
+            item_hashes = list(item_hashes)
+            assert all(item_hash in self._subset_of.items for item_hash in item_hashes)
+        Tracker.remove_many(self, item_hashes)
+    
+    def load_snapshot(self, snapshot, items):
         if self._subset_of is not None:
-            assert item_hash in self._subset_of.items
-        Tracker.remove(self, item_hash)
+            assert all(item_hash in self._subset_of.items for item_hash in items)
+        return Tracker.load_snapshot(self, snapshot, items)
@@ -72,6 +72,27 @@ add_dicts = add_dicts_ext()
 
 mult_dict = lambda c, x: dict((k, c*v) for k, v in x.iteritems())
 
+class SumDict(dict):
+    '''dict that adds and subtracts key by key, without keeping zeros. 0 works as the empty SumDict, so these can be
+    forest.get_attributedelta_type attributes'''
+    
+    def __add__(self, other):
+        if not isinstance(other, dict):
+            assert other == 0
+            return self
+        return SumDict(add_dicts(self, other))
+    __radd__ = __add__
+    
+    def __sub__(self, other):
+        if not isinstance(other, dict):
+            assert other == 0
+            return self
+        return SumDict(add_dicts(self, mult_dict(-1, other)))
+    
+    def __rsub__(self, other):
+        assert other == 0
+        return SumDict(mult_dict(-1, self))
+
 def format(x, add_space=False):
     prefixes = 'kMGTPEZY'
     count = 0
@@ -13,7 +13,7 @@ from twisted.web import resource, static
 
 import p2pool
 from bitcoin import data as bitcoin_data
-from . import data as p2pool_data, p2p
+from . import data as p2pool_data, p2p, stats
 from util import deferral, deferred_resource, graph, math, memory, pack, variable
 
 def _atomic_read(filename):
@@ -97,8 +97,7 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
             return None
         lookbehind = min(node.tracker.get_height(node.best_share_var.value), 3600//node.net.SHARE_PERIOD)
         
-        nonstale_hash_rate = p2pool_data.get_pool_attempts_per_second(node.tracker, node.best_share_var.value, lookbehind)
-        stale_prop = p2pool_data.get_average_stale_prop(node.tracker, node.best_share_var.value, lookbehind)
+        nonstale_hash_rate, stale_prop = stats.get_pool_rates(node.best_chain, [lookbehind])[lookbehind]
         diff = bitcoin_data.target_to_difficulty(wb.current_work.value['bits'].target)
 
         return dict(
@@ -115,19 +114,18 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
             return None
         lookbehind = min(node.tracker.get_height(node.best_share_var.value), 3600//node.net.SHARE_PERIOD)
         
-        global_stale_prop = p2pool_data.get_average_stale_prop(node.tracker, node.best_share_var.value, lookbehind)
+        _, global_stale_prop = stats.get_pool_rates(node.best_chain, [lookbehind])[lookbehind]
         
-        my_unstale_count = sum(1 for share in node.tracker.get_chain(node.best_share_var.value, lookbehind) if share.hash in wb.my_share_hashes)
-        my_orphan_count = sum(1 for share in node.tracker.get_chain(node.best_share_var.value, lookbehind) if share.hash in wb.my_share_hashes and share.share_data['stale_info'] == 'orphan')
-        my_doa_count = sum(1 for share in node.tracker.get_chain(node.best_share_var.value, lookbehind) if share.hash in wb.my_share_hashes and share.share_data['stale_info'] == 'doa')
+        delta = wb.tracker_view.get_chain_delta(node.best_share_var.value, lookbehind)
+        my_unstale_count = delta.my_count
+        my_orphan_count = delta.my_orphan_announce_count
+        my_doa_count = delta.my_dead_announce_count
         my_share_count = my_unstale_count + my_orphan_count + my_doa_count
         my_stale_count = my_orphan_count + my_doa_count
         
         my_stale_prop = my_stale_count/my_share_count if my_share_count != 0 else None
         
-        my_work = sum(bitcoin_data.target_to_average_attempts(share.target)
-            for share in node.tracker.get_chain(node.best_share_var.value, lookbehind - 1)
-            if share.hash in wb.my_share_hashes)
+        my_work = wb.tracker_view.get_chain_delta(node.best_share_var.value, lookbehind - 1).my_work
         actual_time = (node.tracker.items[node.best_share_var.value].timestamp -
             node.tracker.items[node.tracker.get_nth_parent_hash(node.best_share_var.value, lookbehind - 1)].timestamp)
         share_att_s = my_work / actual_time
@@ -183,6 +181,27 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
             fee=wb.worker_fee,
         )
     
+    def get_chain_stats():
+        height = node.tracker.get_height(node.best_share_var.value)
+        if height < 10:
+            return None
+        lookbehind = min(height, 24*60*60//node.net.SHARE_PERIOD)
+        
+        windows = dict((dt, dt//node.net.SHARE_PERIOD) for dt in [10*60, 60*60, 24*60*60] if 2 <= dt//node.net.SHARE_PERIOD <= height)
+        pool_rates = stats.get_pool_rates(node.best_chain, windows.values()) if windows else {}
+        mean_interval, interval_quantiles = stats.get_share_intervals(node.best_chain, lookbehind)
+        
+        return dict(
+            pool_hash_rates=dict((dt, pool_rates[n][0]/(1 - pool_rates[n][1])) for dt, n in windows.iteritems()),
+            pool_stale_props=dict((dt, pool_rates[n][1]) for dt, n in windows.iteritems()),
+            difficulty_history=[dict(time=t, shares=count, difficulty=difficulty) for t, count, difficulty in stats.get_difficulty_history(node.best_chain, lookbehind, 60*60)],
+            desired_versions=stats.get_version_votes(node.best_chain, lookbehind),
+            share_interval=dict(
+                mean=mean_interval,
+                quantiles=dict(zip(['10', '50', '90'], interval_quantiles)),
+            ),
+        )
+    
     class WebInterface(deferred_resource.DeferredResource):
         def __init__(self, func, mime_type='application/json', args=()):
             deferred_resource.DeferredResource.__init__(self)
@@ -203,12 +222,13 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
     web_root.putChild('rate', WebInterface(lambda: p2pool_data.get_pool_attempts_per_second(node.tracker, node.best_share_var.value, decent_height())/(1-p2pool_data.get_average_stale_prop(node.tracker, node.best_share_var.value, decent_height()))))
     web_root.putChild('difficulty', WebInterface(lambda: bitcoin_data.target_to_difficulty(node.tracker.items[node.best_share_var.value].max_target)))
     web_root.putChild('users', WebInterface(get_users))
-    web_root.putChild('user_stales', WebInterface(lambda: dict((bitcoin_data.pubkey_hash_to_address(ph, node.net.PARENT), prop) for ph, prop in
-        p2pool_data.get_user_stale_props(node.tracker, node.best_share_var.value, node.tracker.get_height(node.best_share_var.value)).iteritems())))
+    web_root.putChild('user_stales', WebInterface(lambda: dict((bitcoin_data.pubkey_hash_to_address(ph, node.net.PARENT), stale_count/(count + stale_count)) for ph, (count, stale_count, doa_count, work) in
+        stats.get_user_stats(node.best_chain, max(0, node.tracker.get_height(node.best_share_var.value) - 1)).iteritems())))
     web_root.putChild('fee', WebInterface(lambda: wb.worker_fee))
-    web_root.putChild('current_payouts', WebInterface(lambda: dict((bitcoin_data.script2_to_address(script, node.net.PARENT), value/1e8) for script, value in node.get_current_txouts().iteritems())))
+    web_root.putChild('current_payouts', WebInterface(lambda: dict((address, value/1e8) for address, value in node.get_current_txouts_by_address().iteritems())))
     web_root.putChild('patron_sendmany', WebInterface(get_patron_sendmany, 'text/plain'))
     web_root.putChild('global_stats', WebInterface(get_global_stats))
+    web_root.putChild('chain_stats', WebInterface(get_chain_stats))
     web_root.putChild('local_stats', WebInterface(get_local_stats))
     web_root.putChild('peer_addresses', WebInterface(lambda: ' '.join('%s%s' % (peer.transport.getPeer().host, ':'+str(peer.transport.getPeer().port) if peer.transport.getPeer().port != node.net.P2P_PORT else '') for peer in node.p2p_node.peers.itervalues())))
     web_root.putChild('peer_txpool_sizes', WebInterface(lambda: dict(('%s:%i' % (peer.transport.getPeer().host, peer.transport.getPeer().port), peer.remembered_txs_size) for peer in node.p2p_node.peers.itervalues())))
@@ -230,7 +250,7 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
         hash='%064x' % s.header_hash,
         number=p2pool_data.parse_bip0034(s.share_data['coinbase'])[0],
         share='%064x' % s.hash,
-    ) for s in node.tracker.get_chain(node.best_share_var.value, min(node.tracker.get_height(node.best_share_var.value), 24*60*60//node.net.SHARE_PERIOD)) if s.pow_hash <= s.header['bits'].target]))
+    ) for s in (node.tracker.items[share_hash].need_contents() for share_hash in node.best_chain.hashes[node.best_chain.get_slice(min(node.tracker.get_height(node.best_share_var.value), 24*60*60//node.net.SHARE_PERIOD))][::-1]) if s.pow_hash <= s.header['bits'].target]))
     web_root.putChild('uptime', WebInterface(lambda: time.time() - start_time))
     web_root.putChild('stale_rates', WebInterface(lambda: p2pool_data.get_stale_counts(node.tracker, node.best_share_var.value, decent_height(), rates=True)))
     
@@ -252,16 +272,17 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
         if node.tracker.get_height(node.best_share_var.value) < lookbehind:
             return None
         
-        global_stale_prop = p2pool_data.get_average_stale_prop(node.tracker, node.best_share_var.value, lookbehind)
+        pool_rate, global_stale_prop = stats.get_pool_rates(node.best_chain, [lookbehind])[lookbehind]
         (stale_orphan_shares, stale_doa_shares), shares, _ = wb.get_stale_counts()
         miner_hash_rates, miner_dead_hash_rates = wb.get_local_rates()
         
         my_current_payout=0.0
+        current_txouts = node.get_current_txouts()
         for add in wb.pubkeys.keys:
-            my_current_payout+=node.get_current_txouts().get(bitcoin_data.pubkey_hash_to_script2(add), 0)*1e-8
+            my_current_payout+=current_txouts.get(bitcoin_data.pubkey_hash_to_script2(add), 0)*1e-8
         stat_log.append(dict(
             time=time.time(),
-            pool_hash_rate=p2pool_data.get_pool_attempts_per_second(node.tracker, node.best_share_var.value, lookbehind)/(1-global_stale_prop),
+            pool_hash_rate=pool_rate/(1-global_stale_prop),
             pool_stale_prop=global_stale_prop,
             local_hash_rates=miner_hash_rates,
             local_dead_hash_rates=miner_dead_hash_rates,
@@ -288,7 +309,10 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
     def get_share(share_hash_str):
         if int(share_hash_str, 16) not in node.tracker.items:
             return None
-        share = node.tracker.items[int(share_hash_str, 16)]
+        try:
+            share = node.tracker.items[int(share_hash_str, 16)].need_contents()
+        except ValueError: # bad record, removed once the older shares are decoded
+            return None
         
         return dict(
             parent='%064x' % share.previous_hash,
@@ -335,7 +359,10 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
     def get_share_address(share_hash_str):
         if int(share_hash_str, 16) not in node.tracker.items:
             return None
-        share = node.tracker.items[int(share_hash_str, 16)]
+        try:
+            share = node.tracker.items[int(share_hash_str, 16)].need_contents()
+        except ValueError:
+            return None
         return bitcoin_data.script2_to_address(share.new_script, node.net.PARENT)
 
     new_root.putChild('payout_address', WebInterface(lambda share_hash_str: get_share_address(share_hash_str)))
@@ -393,6 +420,11 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
             multivalue_undefined_means_0=True),
         'traffic_rate': graph.DataStreamDescription(dataview_descriptions, is_gauge=False, multivalues=True),
         'getwork_latency': graph.DataStreamDescription(dataview_descriptions),
+        'getwork_parse_time': graph.DataStreamDescription(dataview_descriptions),
+        'getwork_transactions': graph.DataStreamDescription(dataview_descriptions, multivalues=True),
+        'clean_tracker_time': graph.DataStreamDescription(dataview_descriptions),
+        'verify_backlog': graph.DataStreamDescription(dataview_descriptions),
+        'verify_latency': graph.DataStreamDescription(dataview_descriptions),
         'memory_usage': graph.DataStreamDescription(dataview_descriptions),
     }, hd_obj)
     x = deferral.RobustLoopingCall(lambda: _atomic_write(hd_path, json.dumps(hd.to_obj())))
@@ -429,6 +461,7 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
     def _(name, bytes):
         hd.datastreams['traffic_rate'].add_datum(time.time(), {name: bytes})
     def add_point():
+        hd.datastreams['verify_backlog'].add_datum(time.time(), node.tracker.verify_backlog)
         if node.tracker.get_height(node.best_share_var.value) < 10:
             return None
         lookbehind = min(node.net.CHAIN_LENGTH, 60*60//node.net.SHARE_PERIOD, node.tracker.get_height(node.best_share_var.value))
@@ -444,7 +477,7 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
              my_current_payouts += current_txouts.get(bitcoin_data.pubkey_hash_to_script2(add), 0)*1e-8
         hd.datastreams['current_payout'].add_datum(t, my_current_payouts)
         miner_hash_rates, miner_dead_hash_rates = wb.get_local_rates()
-        current_txouts_by_address = dict((bitcoin_data.script2_to_address(script, node.net.PARENT), amount) for script, amount in current_txouts.iteritems())
+        current_txouts_by_address = node.get_current_txouts_by_address()
         hd.datastreams['current_payouts'].add_datum(t, dict((user, current_txouts_by_address[user]*1e-8) for user in miner_hash_rates if user in current_txouts_by_address))
         
         hd.datastreams['peers'].add_datum(t, dict(
@@ -466,6 +499,14 @@ def get_web_root(wb, datadir_path, bitcoind_getinfo_var, stop_event=variable.Eve
     @node.bitcoind_work.changed.watch
     def _(new_work):
         hd.datastreams['getwork_latency'].add_datum(time.time(), new_work['latency'])
+        hd.datastreams['getwork_parse_time'].add_datum(time.time(), new_work['parse_time'])
+        hd.datastreams['getwork_transactions'].add_datum(time.time(), dict(new=new_work['new_transaction_count'], reused=len(new_work['transactions']) - new_work['new_transaction_count']))
+    @node.tracker_cleaned.watch
+    def _(duration, removed_count):
+        hd.datastreams['clean_tracker_time'].add_datum(time.time(), duration)
+    @node.tracker.verified.added.watch
+    def _(share):
+        hd.datastreams['verify_latency'].add_datum(time.time(), time.time() - share.time_seen)
     new_root.putChild('graph_data', WebInterface(lambda source, view: hd.datastreams[source].dataviews[view].get_data(time.time())))
     
     if static_dir is None:
@@ -45,6 +45,7 @@ class WorkerBridge(worker_interface.WorkerBridge):
         self.removed_doa_unstales_var = variable.Variable(0)
         
         self.last_work_shares = variable.Variable( {} )
+        self.work_template = None
         self.my_share_hashes = set()
         self.my_doa_share_hashes = set()
 
@@ -55,19 +56,21 @@ class WorkerBridge(worker_interface.WorkerBridge):
             my_doa_count=lambda share: 1 if share.hash in self.my_doa_share_hashes else 0,
             my_orphan_announce_count=lambda share: 1 if share.hash in self.my_share_hashes and share.share_data['stale_info'] == 'orphan' else 0,
             my_dead_announce_count=lambda share: 1 if share.hash in self.my_share_hashes and share.share_data['stale_info'] == 'doa' else 0,
+            my_work=lambda share: bitcoin_data.target_to_average_attempts(share.target) if share.hash in self.my_share_hashes else 0,
         )))
         
         @self.node.tracker.verified.removed.watch
-        def _(share):
-            if share.hash in self.my_share_hashes and self.node.tracker.is_child_of(share.hash, self.node.best_share_var.value):
-                assert share.share_data['stale_info'] in [None, 'orphan', 'doa'] # we made these shares in this instance
-                self.removed_unstales_var.set((
-                    self.removed_unstales_var.value[0] + 1,
-                    self.removed_unstales_var.value[1] + (1 if share.share_data['stale_info'] == 'orphan' else 0),
-                    self.removed_unstales_var.value[2] + (1 if share.share_data['stale_info'] == 'doa' else 0),
-                ))
-            if share.hash in self.my_doa_share_hashes and self.node.tracker.is_child_of(share.hash, self.node.best_share_var.value):
-                self.removed_doa_unstales_var.set(self.removed_doa_unstales_var.value + 1)
+        def _(shares):
+            for share in shares:
+                if share.hash in self.my_share_hashes and self.node.tracker.is_child_of(share.hash, self.node.best_share_var.value):
+                    assert share.share_data['stale_info'] in [None, 'orphan', 'doa'] # we made these shares in this instance
+                    self.removed_unstales_var.set((
+                        self.removed_unstales_var.value[0] + 1,
+                        self.removed_unstales_var.value[1] + (1 if share.share_data['stale_info'] == 'orphan' else 0),
+                        self.removed_unstales_var.value[2] + (1 if share.share_data['stale_info'] == 'doa' else 0),
+                    ))
+                if share.hash in self.my_doa_share_hashes and self.node.tracker.is_child_of(share.hash, self.node.best_share_var.value):
+                    self.removed_doa_unstales_var.set(self.removed_doa_unstales_var.value + 1)
         
         # MERGED WORK
         
@@ -98,7 +101,7 @@ class WorkerBridge(worker_interface.WorkerBridge):
         def compute_work():
             t = self.node.bitcoind_work.value
             bb = self.node.best_block_header.value
-            if bb is not None and bb['previous_block'] == t['previous_block'] and self.node.net.PARENT.POW_FUNC(bitcoin_data.block_header_type.pack(bb)) <= t['bits'].target:
+            if bb is not None and bb['previous_block'] == t['previous_block'] and self.node.best_block_pow_hash <= t['bits'].target:
                 print 'Skipping from block %x to block %x!' % (bb['previous_block'],
                     bitcoin_data.hash256(bitcoin_data.block_header_type.pack(bb)))
                 t = dict(
@@ -237,6 +240,39 @@ class WorkerBridge(worker_interface.WorkerBridge):
             addr_hash_rates[datum['pubkey_hash']] = addr_hash_rates.get(datum['pubkey_hash'], 0) + datum['work']/dt
         return addr_hash_rates
  
+    def _get_work_template(self, share_type):
+        '''the parts of get_work that don't depend on the miner, shared by all get_work calls until the block template,
+        the best share or the share type changes'''
+        t = self.current_work.value
+        previous_share_hash = self.node.best_share_var.value
+        height = self.node.tracker.get_height(previous_share_hash)
+        key = share_type, previous_share_hash, height # the height changes when older shares arrive, which changes the payouts
+        if self.work_template is not None and self.work_template['key'] == key and self.work_template['work'] is t:
+            return self.work_template
+        
+        tx_hashes = [bitcoin_data.get_tx_hash(tx) for tx in t['transactions']]
+        tx_map = dict(zip(tx_hashes, t['transactions']))
+        template = share_type.generate_transaction_template(
+            tracker=self.node.tracker,
+            previous_share_hash=previous_share_hash,
+            subsidy=t['subsidy'],
+            block_target=t['bits'].target,
+            desired_other_transaction_hashes_and_fees=zip(tx_hashes, t['transaction_fees']),
+            net=self.node.net,
+            known_txs=tx_map,
+            base_subsidy=self.node.net.PARENT.SUBSIDY_FUNC(t['height']),
+        )
+        lookbehind = 3600//self.node.net.SHARE_PERIOD
+        self.work_template = dict(
+            key=key,
+            work=t,
+            transaction=template,
+            other_transactions=[tx_map[tx_hash] for tx_hash in template['other_transaction_hashes']],
+            merkle_link=bitcoin_data.calculate_merkle_link([None] + template['other_transaction_hashes'], 0) if not template['segwit_activated'] else template['segwit_data']['txid_merkle_link'],
+            pool_attempts_per_second=p2pool_data.get_pool_attempts_per_second(self.node.tracker, previous_share_hash, lookbehind) if previous_share_hash is not None and height > lookbehind else None,
+        )
+        return self.work_template
+    
     def get_work(self, pubkey_hash, desired_share_target, desired_pseudoshare_target):
         global print_throttle
         if (self.node.p2p_node is None or len(self.node.p2p_node.peers) == 0) and self.node.net.PERSIST:
@@ -259,9 +295,6 @@ class WorkerBridge(worker_interface.WorkerBridge):
             mm_data = ''
             mm_later = []
         
-        tx_hashes = [bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx)) for tx in self.current_work.value['transactions']]
-        tx_map = dict(zip(tx_hashes, self.current_work.value['transactions']))
-        
         previous_share = self.node.tracker.items[self.node.best_share_var.value] if self.node.best_share_var.value is not None else None
         if previous_share is None:
             share_type = p2pool_data.Share
@@ -284,6 +317,8 @@ class WorkerBridge(worker_interface.WorkerBridge):
                 else:
                     share_type = previous_share_type
         
+        work_template = self._get_work_template(share_type)
+        
         if desired_share_target is None:
             desired_share_target = 2**256-1
             local_hash_rate = self._estimate_local_hash_rate()
@@ -294,8 +329,8 @@ class WorkerBridge(worker_interface.WorkerBridge):
             local_addr_rates = self.get_local_addr_rates()
             lookbehind = 3600//self.node.net.SHARE_PERIOD
             block_subsidy = self.node.bitcoind_work.value['subsidy']
-            if previous_share is not None and self.node.tracker.get_height(previous_share.hash) > lookbehind:
-                expected_payout_per_block = local_addr_rates.get(pubkey_hash, 0)/p2pool_data.get_pool_attempts_per_second(self.node.tracker, self.node.best_share_var.value, lookbehind) \
+            if work_template['pool_attempts_per_second'] is not None:
+                expected_payout_per_block = local_addr_rates.get(pubkey_hash, 0)/work_template['pool_attempts_per_second'] \
                     * block_subsidy*(1-self.donation_percentage/100) # XXX doesn't use global stale rate to compute pool hash
                 if expected_payout_per_block < self.node.net.PARENT.DUST_THRESHOLD:
                     desired_share_target = min(desired_share_target,
@@ -326,14 +361,13 @@ class WorkerBridge(worker_interface.WorkerBridge):
                 desired_timestamp=int(time.time() + 0.5),
                 desired_target=desired_share_target,
                 ref_merkle_link=dict(branch=[], index=0),
-                desired_other_transaction_hashes_and_fees=zip(tx_hashes, self.current_work.value['transaction_fees']),
+                desired_other_transaction_hashes_and_fees=None,
                 net=self.node.net,
-                known_txs=tx_map,
-                base_subsidy=self.node.net.PARENT.SUBSIDY_FUNC(self.current_work.value['height']),
+                template=work_template['transaction'],
             )
         
         packed_gentx = bitcoin_data.tx_id_type.pack(gentx) # stratum miners work with stripped transactions
-        other_transactions = [tx_map[tx_hash] for tx_hash in other_transaction_hashes]
+        other_transactions = work_template['other_transactions']
         
         mm_later = [(dict(aux_work, target=aux_work['target'] if aux_work['target'] != 'p2pool' else share_info['bits'].target), index, hashes) for aux_work, index, hashes in mm_later]
         
@@ -352,7 +386,7 @@ class WorkerBridge(worker_interface.WorkerBridge):
         
         getwork_time = time.time()
         lp_count = self.new_work_event.times
-        merkle_link = bitcoin_data.calculate_merkle_link([None] + other_transaction_hashes, 0) if share_info.get('segwit_data', None) is None else share_info['segwit_data']['txid_merkle_link']
+        merkle_link = work_template['merkle_link']
         
         if print_throttle is 0.0:
             print_throttle = time.time()
@@ -383,17 +417,17 @@ class WorkerBridge(worker_interface.WorkerBridge):
         
         received_header_hashes = set()
         
+        @defer.inlineCallbacks
         def got_response(header, user, coinbase_nonce):
             assert len(coinbase_nonce) == self.COINBASE_NONCE_LENGTH
+            on_time = self.new_work_event.times == lp_count # before waiting for the PoW hash, so that work changing meanwhile doesn't make this late
             new_packed_gentx = packed_gentx[:-self.COINBASE_NONCE_LENGTH-4] + coinbase_nonce + packed_gentx[-4:] if coinbase_nonce != '\0'*self.COINBASE_NONCE_LENGTH else packed_gentx
             new_gentx = bitcoin_data.tx_type.unpack(new_packed_gentx) if coinbase_nonce != '\0'*self.COINBASE_NONCE_LENGTH else gentx
             if bitcoin_data.is_segwit_tx(gentx): # reintroduce witness data to the gentx produced by stratum miners
-                new_gentx['marker'] = 0
-                new_gentx['flag'] = gentx['flag']
-                new_gentx['witness'] = gentx['witness']
+                new_gentx = dict(new_gentx, marker=0, flag=gentx['flag'], witness=gentx['witness'])
             
             header_hash = bitcoin_data.hash256(bitcoin_data.block_header_type.pack(header))
-            pow_hash = self.node.net.PARENT.POW_FUNC(bitcoin_data.block_header_type.pack(header))
+            pow_hash, = yield helper.get_pow_hashes(self.node.net.PARENT, [bitcoin_data.block_header_type.pack(header)])
             try:
                 if pow_hash <= header['bits'].target or p2pool.DEBUG:
                     helper.submit_block(dict(header=header, txs=[new_gentx] + other_transactions), False, self.node.factory, self.node.bitcoind, self.node.bitcoind_work, self.node.net)
@@ -409,8 +443,6 @@ class WorkerBridge(worker_interface.WorkerBridge):
             assert header['merkle_root'] == bitcoin_data.check_merkle_link(bitcoin_data.hash256(new_packed_gentx), merkle_link)
             assert header['bits'] == ba['bits']
             
-            on_time = self.new_work_event.times == lp_count
-            
             for aux_work, index, hashes in mm_later:
                 try:
                     if pow_hash <= aux_work['target'] or p2pool.DEBUG:
@@ -440,7 +472,7 @@ class WorkerBridge(worker_interface.WorkerBridge):
             
             if pow_hash <= share_info['bits'].target and header_hash not in received_header_hashes:
                 last_txout_nonce = pack.IntType(8*self.COINBASE_NONCE_LENGTH).unpack(coinbase_nonce)
-                share = get_share(header, last_txout_nonce)
+                share = get_share(header, last_txout_nonce, pow_hash)
                 
                 print 'GOT SHARE! %s %s prev %s age %.2fs%s' % (
                     user,
@@ -480,6 +512,6 @@ class WorkerBridge(worker_interface.WorkerBridge):
                 self.local_rate_monitor.add_datum(dict(work=bitcoin_data.target_to_average_attempts(target), dead=not on_time, user=user, share_target=share_info['bits'].target))
                 self.local_addr_rate_monitor.add_datum(dict(work=bitcoin_data.target_to_average_attempts(target), pubkey_hash=pubkey_hash))
             
-            return on_time
+            defer.returnValue(on_time)
         
         return ba, got_response
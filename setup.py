@@ -46,7 +46,7 @@ try:
             ]),
         ],
 
-        console=['run_p2pool.py'],
+        console=['run_p2pool.py', 'export_shares.py'],
         options=dict(py2exe=dict(
             bundle_files=bundle,
             dll_excludes=['w9xpopen.exe', "mswsock.dll", "MSWSOCK.dll"],